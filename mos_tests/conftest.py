@@ -23,14 +23,25 @@ from six.moves import configparser
 
 from mos_tests.environment.devops_client import DevopsClient
 from mos_tests.environment.fuel_client import FuelClient
+from mos_tests.environment.fuel_client import topology_cache
+from mos_tests.environment.os_actions import os_conn_pool
+from mos_tests.environment.readiness import Readiness
+from mos_tests.environment.ssh import connection_pool
+from mos_tests.environment.ssh import vm_connection_pool
 from mos_tests.functions.common import gen_temp_file
 from mos_tests.functions.common import get_os_conn
 from mos_tests.functions.common import wait
+from mos_tests.functions.guards import dynamic_guard
+from mos_tests.functions.guards import GuardsEngine
 from mos_tests.functions import os_cli
+from mos_tests.functions.profiling import counters
+from mos_tests.functions.waiter import wait_stats
 from mos_tests.settings import KEYSTONE_PASS
 from mos_tests.settings import KEYSTONE_USER
 from mos_tests.settings import SERVER_ADDRESS
 from mos_tests.settings import SSH_CREDENTIALS
+from plugins.env_pool import get_leased_env
+from plugins.env_pool import get_worker_input
 
 logger = logging.getLogger(__name__)
 
@@ -38,7 +49,11 @@ logger = logging.getLogger(__name__)
 # Define pytest plugins to use
 pytest_plugins = ("plugins.incremental",
                   "plugins.testrail_id",
-                  "plugins.fuel_snapshot")
+                  "plugins.fuel_snapshot",
+                  "plugins.snapshot_scheduler",
+                  "plugins.env_pool",
+                  "plugins.timing_db",
+                  "plugins.testrail_report")
 
 
 def pytest_addoption(parser):
@@ -50,9 +65,23 @@ def pytest_addoption(parser):
                      help="Fuel devops snapshot name")
     parser.addoption("--cluster", '-C', action="append",
                      help="Fuel cluster name to test on it")
+    parser.addoption("--wait-profile", action="store_true",
+                     help="Show time spent in waits for each test")
+    parser.addoption("--no-guards-deselect", action="store_true",
+                     help="Don't deselect tests with failed `check_env_` "
+                          "guards on collection (skip them on setup)")
+    parser.addoption("--full-ostf", action="store_true",
+                     help="Always check env with OSTF after revert "
+                          "instead of comparing env fingerprint")
 
 
 def pytest_configure(config):
+    # used by env_pool plugin to distribute tests between workers and by
+    # snapshot_scheduler plugin to skip reverts around skipped tests
+    config.env_guards_evaluator = None
+    if not (config.option.collectonly or
+            getattr(config.option, 'check_testrail_id', False)):
+        config.env_guards_evaluator = GuardsEvaluator(config)
     # register an additional marker
     config.addinivalue_line("markers",
                             "check_env_(check1, check2): mark test "
@@ -69,6 +98,59 @@ def pytest_configure(config):
                             "apply case_id only if it matches test params.")
 
 
+class GuardsEvaluator(object):
+    """Evaluates static `check_env_` guards on env before tests run
+
+    Guards with dynamic ones are treated as passed, they are evaluated
+    on test setup (after revert).
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._env = None
+
+    def __call__(self, guards):
+        if not guards_engine.is_static(guards):
+            return True
+        if self._env is None:
+            fuel = get_fuel_client(get_fuel_master_ip(self.config))
+            self._env = get_cluster(self.config, fuel)
+        return guards_engine.evaluate(self._env, guards)[0]
+
+
+def pytest_collection_modifyitems(session, config, items):
+    guarded = []
+    for item in items:
+        marker = item.keywords.get('check_env_')
+        if marker is None:
+            continue
+        try:
+            guards_engine.compile(marker.args)
+        except ValueError:
+            # will be reported on test setup
+            continue
+        if guards_engine.is_static(marker.args):
+            guarded.append((item, marker.args))
+
+    evaluator = config.env_guards_evaluator
+    # xdist workers should collect same tests
+    if (not guarded or evaluator is None or
+            config.getoption('--no-guards-deselect') or
+            get_worker_input(config) is not None):
+        return
+    deselected = []
+    try:
+        for item, guards in guarded:
+            if not evaluator(guards):
+                deselected.append(item)
+    except Exception as e:
+        logger.warning("Can't evaluate guards on collection: {}".format(e))
+        return
+    if deselected:
+        config.hook.pytest_deselected(items=deselected)
+        items[:] = [x for x in items if x not in deselected]
+
+
 @pytest.hookimpl(tryfirst=True, hookwrapper=True)
 def pytest_runtest_makereport(item, call):
     # execute all other hooks to obtain the report object
@@ -84,14 +166,70 @@ def pytest_runtest_teardown(item, nextitem):
     setattr(item.session, "nextitem", nextitem)
 
 
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_protocol(item, nextitem):
+    # bind waits and counters (including fixtures ones) to test
+    wait_stats.test = counters.test = item.nodeid
+    yield
+    test_counters = counters.pop(item.nodeid)
+    recorder = getattr(item.config, 'timing_recorder', None)
+    if recorder is not None:
+        recorder.record_test(item.nodeid,
+                             waits=wait_stats.get(test=item.nodeid),
+                             counters=test_counters)
+    lines = wait_stats.report(test=item.nodeid)
+    if lines:
+        logger.debug('Waits profile for {0}:\n{1}'.format(item.nodeid,
+                                                          '\n'.join(lines)))
+    wait_stats.test = counters.test = None
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not terminalreporter.config.getoption('--wait-profile'):
+        return
+    terminalreporter.write_sep('=', 'waits profile')
+    for test, elapsed in wait_stats.total_by_test():
+        terminalreporter.write_line('{0:8.1f}s {1}'.format(elapsed, test))
+        for line in wait_stats.report(test=test, limit=5):
+            terminalreporter.write_line('    ' + line)
+
+
 @pytest.fixture
 def suffix():
     return str(uuid.uuid4())
 
 
+def get_env_name(config):
+    leased = get_leased_env(config)
+    if leased is not None:
+        return leased.name
+    return config.getoption("--env")
+
+
+def get_snapshot_name(config):
+    leased = get_leased_env(config)
+    if leased is not None and leased.snapshot is not None:
+        return leased.snapshot
+    return config.getoption("--snapshot")
+
+
+def get_fuel_master_ip(config):
+    leased = get_leased_env(config)
+    if leased is None:
+        fuel_ip = config.getoption("--fuel-ip")
+    else:
+        fuel_ip = leased.fuel_ip
+    if not fuel_ip:
+        fuel_ip = DevopsClient.get_admin_node_ip(
+            env_name=get_env_name(config))
+    if not fuel_ip:
+        fuel_ip = SERVER_ADDRESS
+    return fuel_ip
+
+
 @pytest.fixture(scope="session")
 def env_name(request):
-    return request.config.getoption("--env")
+    return get_env_name(request.config)
 
 
 @pytest.fixture(scope='session')
@@ -101,23 +239,40 @@ def devops_env(env_name):
 
 @pytest.fixture(scope="session")
 def snapshot_name(request):
-    return request.config.getoption("--snapshot")
+    return get_snapshot_name(request.config)
 
 
 @pytest.fixture(scope="session")
 def fuel_master_ip(request, env_name, snapshot_name):
     """Get fuel master ip"""
-    fuel_ip = request.config.getoption("--fuel-ip")
-    if not fuel_ip:
-        fuel_ip = DevopsClient.get_admin_node_ip(env_name=env_name)
-    if not fuel_ip:
-        fuel_ip = SERVER_ADDRESS
-    return fuel_ip
+    return get_fuel_master_ip(request.config)
 
 
 def revert_snapshot(env_name, snapshot_name):
-    DevopsClient.revert_snapshot(env_name=env_name,
-                                 snapshot_name=snapshot_name)
+    with counters.span('revert'):
+        DevopsClient.revert_snapshot(env_name=env_name,
+                                     snapshot_name=snapshot_name)
+    # All connections to nodes are broken after revert
+    vm_connection_pool.clear()
+    connection_pool.clear()
+    topology_cache.invalidate()
+    guards_engine.invalidate()
+    os_conn_pool.rebind()
+
+
+@pytest.yield_fixture(scope='session', autouse=True)
+def ssh_pool():
+    """Pool of ssh connections to env nodes, closed on session finish"""
+    yield connection_pool
+    vm_connection_pool.clear()
+    connection_pool.clear()
+
+
+@pytest.yield_fixture(scope='session')
+def topology():
+    """Cache of env nodes data, invalidated on session finish"""
+    yield topology_cache
+    topology_cache.invalidate()
 
 
 @pytest.fixture(scope="session", autouse=True)
@@ -130,7 +285,11 @@ def setup_session(request, env_name, snapshot_name):
 
 
 def reinit_fixtures(request):
-    """Refresh some session fixtures (after revert, for example)"""
+    """Refresh some session fixtures (after revert, for example)
+
+    New env takes OpenStackActions from `os_conn_pool`, so OpenStack
+    clients and connections are not recreated.
+    """
     logger.info('refresh clients fixtures')
     for fixture in ('fuel', 'env', 'os_conn'):
         try:
@@ -153,6 +312,10 @@ def cleanup(request, env_name, snapshot_name):
         return
     skipped = any(x for x in test_results if x is not None and x.skipped)
     destructive = 'undestructive' not in item.keywords
+    plan = getattr(item.session, 'snapshot_plan', None)
+    if plan is not None and not plan.needs_revert_after(item):
+        # env is left intact or all next tests will be skipped
+        destructive = False
     reverted = False
     if destructive and not skipped:
         if all([env_name, snapshot_name]):
@@ -173,14 +336,14 @@ def get_fuel_client(fuel_ip):
 
 
 @pytest.fixture(scope="session")
-def credentials(setup_session, fuel_master_ip):
+def credentials(request, setup_session, fuel_master_ip):
     Credentials = namedtuple(
         'Credentials',
         ['fuel_ip', 'controller_ip', 'keystone_url', 'username', 'password',
             'project', 'cert'])
 
     fuel = get_fuel_client(fuel_master_ip)
-    env = fuel.get_last_created_cluster()
+    env = get_cluster(request.config, fuel)
     controller_ip = env.get_primary_controller_ip()
     cert = env.certificate
     if cert is None:
@@ -211,27 +374,60 @@ def restart_ceph(env):
     if len(ceph_nodes) == 0:
         return
     controllers = env.get_nodes_by_role('controller')
-    for node in set(ceph_nodes) | set(controllers):
-        with node.ssh() as remote:
-            remote.execute('restart ceph-all')
+    nodes = {x.data['ip']: x for x in ceph_nodes + controllers}
+    env.run_on_nodes(nodes.values(), 'restart ceph-all')
+
+
+def wait_env_ready(config, env, key):
+    """Wait env to be ready after revert
+
+    Env fingerprint is compared with fingerprint of same snapshot, recorded
+    after OSTF pass. Failed checks mean that env is not ready yet, so OSTF
+    runs only if there is no recorded fingerprint or it is not matched until
+    timeout. Fingerprint with errors is never recorded.
+    """
+    readiness = Readiness(env)
+    cache_key = 'mos_tests/readiness/{0}'.format(key)
+    expected = config.cache.get(cache_key, None)
+    if expected is not None and not config.getoption('--full-ostf'):
+        with counters.span('env_ready'):
+            ready = readiness.is_ready(expected)
+        if ready:
+            return
+        logger.info('Env fingerprint is not matched, fallback to OSTF')
+    with counters.span('ostf'):
+        env.wait_for_ostf_pass()
+    fingerprint = readiness.fingerprint()
+    errors = readiness.errors(fingerprint)
+    if errors:
+        logger.warning("Env fingerprint isn't recorded, checks failed: "
+                       "{0}".format(', '.join(str(x) for x in errors)))
+        return
+    config.cache.set(cache_key, fingerprint)
+
+
+def get_cluster(config, fuel):
+    """Return Environment to test on (selected by `--cluster` option)"""
+    names = config.getoption('--cluster')
+    if not names:
+        return fuel.get_last_created_cluster()
+    envs = fuel.get_clustres_by_names(names)
+    if len(envs) == 0:
+        raise Exception(
+            "Can't find fuel cluster with name in {}".format(names))
+    return envs[0]
 
 
 @pytest.fixture(scope='session')
-def env(request, fuel):
+def env(request, fuel, env_name, snapshot_name):
     """Environment instance"""
-    names = request.config.getoption('--cluster')
-    if not names:
-        env = fuel.get_last_created_cluster()
-    else:
-        envs = fuel.get_clustres_by_names(names)
-        if len(envs) == 0:
-            raise Exception(
-                "Can't find fuel cluster with name in {}".format(names))
-        env = envs[0]
+    env = get_cluster(request.config, fuel)
     assert env.is_operational
     if getattr(request.session, 'reverted', True):
         restart_ceph(env)
-        env.wait_for_ostf_pass()
+        wait_env_ready(request.config, env,
+                       key='{0}/{1}/{2}'.format(env_name, snapshot_name,
+                                                env.data['name']))
         wait(env.os_conn.is_nova_ready,
              timeout_seconds=60 * 5,
              expected_exceptions=Exception,
@@ -240,9 +436,9 @@ def env(request, fuel):
 
 
 @pytest.fixture(scope="session")
-def set_openstack_environ(fuel_master_ip):
+def set_openstack_environ(request, fuel_master_ip):
     fuel = get_fuel_client(fuel_master_ip)
-    env = fuel.get_last_created_cluster()
+    env = get_cluster(request.config, fuel)
     """Set os.environ variables from openrc file"""
     logger.info("read OpenStack openrc file")
     controllers = env.get_nodes_by_role('controller')[0]
@@ -261,7 +457,7 @@ def set_openstack_environ(fuel_master_ip):
 @pytest.fixture(scope='class')
 def os_conn_for_unittests(request, fuel_master_ip):
     fuel_client = get_fuel_client(fuel_master_ip)
-    environment = fuel_client.get_last_created_cluster()
+    environment = get_cluster(request.config, fuel_client)
     request.cls.env = environment
     request.cls.os_conn = environment.os_conn
 
@@ -278,6 +474,10 @@ def clean_os(os_conn):
     os_conn.cleanup_network()
 
 
+# Evaluates `check_env_` guards - `is_*` and `has_*` functions below
+guards_engine = GuardsEngine(globals())
+
+
 def is_ha(env):
     """Env deployed with HA (3 controllers)"""
     return env.is_ha and len(env.get_nodes_by_role('controller')) >= 3
@@ -313,6 +513,7 @@ def has_2_or_more_ironic_conductors(env):
     return len(env.get_nodes_by_role('ironic')) >= 2
 
 
+@dynamic_guard
 def is_any_compute_suitable_for_max_flavor(env):
     attrs_to_check = {
         "vcpus": 8,
@@ -411,35 +612,12 @@ def executable_requirements(request, env_name):
 
 @pytest.fixture(autouse=True)
 def env_requirements(request, env):
-    reserved = {'or', 'and', 'not', '(', ')'}
     marker = request.node.get_marker('check_env_')
     if not marker:
         return
-    marker_str = ' and '.join(marker.args)
-    marker_str = marker_str.replace(
-        '(', ' ( '
-    ).replace(
-        ')', ' ) '
-    ).replace(
-        '  ', ' ')
-    functions = marker_str.split()
-    marker_str_evalued = marker_str
-    for func in functions:
-        if func in reserved:
-            continue
-        function = globals().get(func)
-        if function is None:
-            logger.critical('Guard with name {} not found'.format(func))
-            raise ValueError('Parse error')
-        if not (func.startswith('is_') or func.startswith('has_')):
-            logger.critical(
-                'Guard must start with "is_" or "has_", got {} instead'.format(
-                    func))
-            raise ValueError('Parse error')
-        marker_str_evalued = marker_str_evalued.replace(
-            func, str(function(env)))
-
-    if not eval(marker_str_evalued):
+    result, marker_str, marker_str_evalued = guards_engine.evaluate(
+        env, marker.args)
+    if not result:
         pytest.skip('Requires criteria: {}, computed instead: {}'.format(
             marker_str, marker_str_evalued))
 
@@ -0,0 +1,283 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import defaultdict
+import logging
+from multiprocessing.pool import ThreadPool
+import random
+import time
+
+from neutronclient.common.exceptions import NotFound as NeutronNotFound
+from novaclient.exceptions import NotFound as NovaNotFound
+
+logger = logging.getLogger(__name__)
+
+# Fuel admin router. Did not find the better way to detect it - looks like it
+# just always has fixed name
+ADMIN_ROUTER_NAME = 'router04'
+
+
+class Resource(object):
+    """Cleanup graph node
+
+    :param kind: resource type name (used for reporting)
+    :param id: resource id
+    :param delete: function to delete resource
+    :param deps: keys of resources, which should be deleted before this one
+    """
+
+    def __init__(self, kind, id, delete, deps=()):
+        self.kind = kind
+        self.id = id
+        self.delete = delete
+        self.deps = set(deps)
+        self.error = None
+
+    @property
+    def key(self):
+        return (self.kind, self.id)
+
+    def __repr__(self):
+        return '<{0.kind} {0.id}>'.format(self)
+
+
+class CleanupReport(object):
+    """Result of cleanup: phases durations and not deleted resources"""
+
+    def __init__(self):
+        self.phases = {}
+        self.left = []
+
+    @property
+    def is_ok(self):
+        return len(self.left) == 0
+
+    def log(self):
+        for kind, duration in sorted(self.phases.items(),
+                                     key=lambda x: x[1], reverse=True):
+            logger.info('Cleanup of {0} took {1:.1f}s'.format(kind, duration))
+        for resource in self.left:
+            logger.info('{0} is not deletable: {1}'.format(resource,
+                                                           resource.error))
+
+
+class NetworkCleanup(object):
+    """Deletes tenant resources in parallel with respect to dependencies
+
+    All resources are listed once. Then independent resources are deleted
+    concurrently, and each resource is deleted only after resources, which
+    depend on it: servers -> security groups, router interfaces -> subnets
+    -> networks, router interfaces -> routers.
+
+    :param os_conn: OpenStackActions instance
+    :param networks_to_skip: names of networks to keep
+    :param concurrency: max count of simultaneous delete requests
+    :param attempts: count of delete attempts for each resource
+    """
+
+    def __init__(self, os_conn, networks_to_skip=(), concurrency=10,
+                 attempts=3):
+        self.os_conn = os_conn
+        self.networks_to_skip = networks_to_skip
+        self.concurrency = concurrency
+        self.attempts = attempts
+        self.resources = {}
+
+    @property
+    def nova(self):
+        return self.os_conn.nova
+
+    @property
+    def neutron(self):
+        return self.os_conn.neutron
+
+    def add(self, kind, id, delete, deps=()):
+        resource = Resource(kind, id, delete, deps)
+        self.resources[resource.key] = resource
+        return resource
+
+    def snapshot(self, pool):
+        """List all resources at once"""
+        listers = {
+            'keypairs': self.nova.keypairs.list,
+            'floating_ips': self.nova.floating_ips.list,
+            'servers': self.nova.servers.list,
+            'security_groups': self.nova.security_groups.list,
+            'networks': lambda: self.neutron.list_networks()['networks'],
+            'subnets': lambda: self.neutron.list_subnets()['subnets'],
+            'ports': lambda: self.neutron.list_ports()['ports'],
+            'routers': lambda: self.neutron.list_routers()['routers'],
+        }
+        names = list(listers.keys())
+        results = pool.map(lambda name: listers[name](), names)
+        return dict(zip(names, results))
+
+    def build(self, data):
+        """Build resources dependency graph from snapshot"""
+        for key_pair in data['keypairs']:
+            self.add('keypair', key_pair.id,
+                     lambda x=key_pair: self.nova.keypairs.delete(x))
+
+        for floating_ip in data['floating_ips']:
+            self.add('floating_ip', floating_ip.id,
+                     lambda x=floating_ip: self._delete_floating_ip(x))
+        floating_ips = [x.key for x in self._by_kind('floating_ip')]
+
+        servers = data['servers']
+        for server in servers:
+            self.add('server', server.id,
+                     lambda x=server: self.nova.servers.delete(x))
+        self.add('servers_deleted', 'all',
+                 lambda: self._wait_servers_deleted(servers),
+                 deps=[x.key for x in self._by_kind('server')])
+        servers_deleted = [('servers_deleted', 'all')]
+
+        for sg in data['security_groups']:
+            if sg.description == 'Default security group':
+                continue
+            self.add('security_group', sg.id,
+                     lambda x=sg: self.nova.security_groups.delete(x),
+                     deps=servers_deleted)
+
+        # Resources attached to skipped networks and to admin router are kept
+        kept_routers = set(x['id'] for x in data['routers']
+                           if x['name'] == ADMIN_ROUTER_NAME)
+        kept_networks = set(x['id'] for x in data['networks']
+                            if x['name'] in self.networks_to_skip)
+        for router in data['routers']:
+            gateway = router['external_gateway_info']
+            if router['id'] in kept_routers and gateway:
+                kept_networks.add(gateway['network_id'])
+        kept_subnets = set()
+        for port in data['ports']:
+            if port['device_id'] in kept_routers:
+                kept_networks.add(port['network_id'])
+        for subnet in data['subnets']:
+            if subnet['network_id'] in kept_networks:
+                kept_subnets.add(subnet['id'])
+
+        subnet_deps = defaultdict(list)
+        network_deps = defaultdict(list)
+        router_deps = defaultdict(list)
+        for port in data['ports']:
+            if port['network_id'] in kept_networks:
+                continue
+            owner = port['device_owner']
+            if owner.startswith('network:router_interface'):
+                resource = self.add(
+                    'router_interface', port['id'],
+                    lambda x=port: self.neutron.remove_interface_router(
+                        x['device_id'], {'port_id': x['id']}),
+                    deps=floating_ips + servers_deleted)
+                router_deps[port['device_id']].append(resource.key)
+            elif owner == '' or owner.startswith('compute:'):
+                resource = self.add(
+                    'port', port['id'],
+                    lambda x=port: self.neutron.delete_port(x['id']),
+                    deps=servers_deleted)
+            else:
+                continue
+            network_deps[port['network_id']].append(resource.key)
+            for fixed_ip in port['fixed_ips']:
+                subnet_deps[fixed_ip['subnet_id']].append(resource.key)
+
+        for subnet in data['subnets']:
+            if subnet['id'] in kept_subnets:
+                continue
+            resource = self.add(
+                'subnet', subnet['id'],
+                lambda x=subnet: self.neutron.delete_subnet(x['id']),
+                deps=subnet_deps[subnet['id']] + servers_deleted)
+            network_deps[subnet['network_id']].append(resource.key)
+
+        for router in data['routers']:
+            if router['id'] in kept_routers:
+                continue
+            self.add('router', router['id'],
+                     lambda x=router: self.neutron.delete_router(x['id']),
+                     deps=router_deps[router['id']] + floating_ips)
+
+        for network in data['networks']:
+            if network['id'] in kept_networks:
+                continue
+            self.add('network', network['id'],
+                     lambda x=network: self.neutron.delete_network(x['id']),
+                     deps=network_deps[network['id']] + servers_deleted)
+
+    def _by_kind(self, kind):
+        return [x for x in self.resources.values() if x.kind == kind]
+
+    def _delete_floating_ip(self, floating_ip):
+        try:
+            self.nova.floating_ips.delete(floating_ip)
+        except NovaNotFound:
+            raise
+        except Exception:
+            self.neutron.delete_floatingip(floating_ip.id)
+
+    def _wait_servers_deleted(self, servers):
+        if servers:
+            self.os_conn.wait_servers_deleted(servers)
+
+    def _delete(self, resource):
+        start = time.time()
+        for attempt in range(self.attempts):
+            try:
+                resource.delete()
+                resource.error = None
+                break
+            except (NovaNotFound, NeutronNotFound):
+                resource.error = None
+                break
+            except Exception as e:
+                resource.error = e
+                delay = 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.debug('Deleting of {0} failed ({1}), retry in '
+                             '{2:.1f}s'.format(resource, e, delay))
+                if attempt < self.attempts - 1:
+                    time.sleep(delay)
+        return resource, start, time.time()
+
+    def run(self):
+        """Delete all resources
+
+        :rtype: CleanupReport
+        """
+        report = CleanupReport()
+        pool = ThreadPool(self.concurrency)
+        try:
+            self.build(self.snapshot(pool))
+            spans = defaultdict(list)
+            done = set()
+            pending = dict(self.resources)
+            while pending:
+                ready = [x for x in pending.values() if x.deps <= done]
+                if not ready:
+                    # dependency on not listed resource - just go ahead
+                    ready = list(pending.values())
+                for resource, start, end in pool.imap_unordered(self._delete,
+                                                                ready):
+                    spans[resource.kind].append((start, end))
+                    done.add(resource.key)
+                    del pending[resource.key]
+                    if resource.error is not None:
+                        report.left.append(resource)
+        finally:
+            pool.close()
+            pool.join()
+        for kind, kind_spans in spans.items():
+            report.phases[kind] = (max(x[1] for x in kind_spans) -
+                                   min(x[0] for x in kind_spans))
+        report.log()
+        return report
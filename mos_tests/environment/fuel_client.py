@@ -12,9 +12,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from collections import defaultdict
 from itertools import groupby
 import logging
 import os
+import threading
+import time
 
 import dpath.util
 from fuelclient import client
@@ -26,7 +29,9 @@ from fuelclient.objects import task as fuel_task
 from paramiko import RSAKey
 from paramiko import ssh_exception
 
-from mos_tests.environment.os_actions import OpenStackActions
+from mos_tests.environment.os_actions import os_conn_pool
+from mos_tests.environment.ssh import connection_pool
+from mos_tests.environment.ssh import execute_parallel
 from mos_tests.environment.ssh import SSHClient
 from mos_tests.functions.common import gen_temp_file
 from mos_tests.functions.common import wait
@@ -66,7 +71,8 @@ class NodeProxy(object):
         return SSHClient(
             host=self.data['ip'],
             username='root',
-            private_keys=self._env.admin_ssh_keys
+            private_keys=self._env.admin_ssh_keys,
+            pool=connection_pool
         )
 
     def is_ssh_avaliable(self):
@@ -85,6 +91,163 @@ class NodeProxy(object):
                 for x in interfaces}
 
 
+class NodesView(object):
+    """Snapshot of cluster nodes with lookup indexes"""
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.created = time.time()
+        self.by_role = defaultdict(list)
+        self.by_fqdn = {}
+        self.by_ip = {}
+        self.by_mac = {}
+        for node in nodes:
+            for role in node.data['roles']:
+                self.by_role[role].append(node)
+            self.by_fqdn[node.data['fqdn']] = node
+            self.by_ip[node.data['ip']] = node
+            for ip in node.ip_list:
+                self.by_ip.setdefault(ip, node)
+            self.by_mac[node.data['mac']] = node
+
+    @property
+    def age(self):
+        return time.time() - self.created
+
+
+class Topology(object):
+    """Cache of clusters nodes
+
+    Nodes are fetched from Fuel API once per `ttl` seconds (or after
+    invalidation), so lookups by role, fqdn, ip and mac are dict hits.
+
+    :param ttl: time in seconds to keep nodes data
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def get(self, env, fresh=False):
+        """Return NodesView for env
+
+        :param fresh: force nodes data reloading
+        """
+        with self._lock:
+            view = self._views.get(env.id)
+            if fresh or view is None or view.age > self.ttl:
+                nodes = [NodeProxy(x, env) for x in env.get_fresh_nodes()]
+                view = self._views[env.id] = NodesView(nodes)
+            return view
+
+    def invalidate(self, env_id=None):
+        """Drop cached nodes of env with `env_id` or of all envs"""
+        with self._lock:
+            if env_id is None:
+                self._views.clear()
+            else:
+                self._views.pop(env_id, None)
+
+
+topology_cache = Topology()
+
+
+class ControllerRoles(object):
+    """Memoized discovery of primary and leader (pacemaker DC) controllers
+
+    All controllers are queried simultaneously once, result is kept until
+    `invalidate` call. It should be called after actions which can change
+    pacemaker cluster (nodes destroying/restarting, pacemaker resources
+    moving, etc). Environment properties also verify cached result, so
+    missed invalidation doesn't give stale controller.
+    """
+
+    discover_cmd = ('hiera roles; '
+                    'pcs status cluster 2>/dev/null | grep "Current DC:"; '
+                    'true')
+
+    def __init__(self, env):
+        self.env = env
+        self._primary = None
+        self._leader = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._primary = None
+            self._leader = None
+
+    def discover(self):
+        controllers = self.env.get_nodes_by_role('controller')
+        results = self.env.run_on_nodes(controllers, self.discover_cmd)
+        primary = leader = None
+        for controller, result in zip(controllers, results):
+            if result['exit_code'] is None:
+                logger.debug('Controller {0} is unreachable: {1}'.format(
+                    controller.data['fqdn'], result.error))
+                continue
+            roles = []
+            for line in result['stdout']:
+                if 'Current DC:' not in line:
+                    roles.append(line)
+                elif leader is None:
+                    leader = self._find_by_fqdn(controllers, line)
+            roles = ' '.join(roles)
+            logger.debug('hiera roles for {} is {}'.format(
+                controller.data['fqdn'], roles))
+            if 'primary-controller' in roles:
+                primary = controller
+        self._primary = primary
+        self._leader = leader
+
+    @staticmethod
+    def _find_by_fqdn(controllers, text):
+        for controller in controllers:
+            if controller.data['fqdn'] in text:
+                return controller
+
+    def _check(self, node, cmd, expected):
+        try:
+            with node.ssh() as remote:
+                result = remote.execute(cmd, verbose=False)
+        except Exception as e:
+            logger.debug('Verification on {0} failed: {1}'.format(node, e))
+            return False
+        return expected in result.stdout_string
+
+    def primary(self, verify=False):
+        """Return primary controller
+
+        :param verify: check that cached controller still has primary role
+        """
+        with self._lock:
+            if self._primary is not None and verify:
+                if not self._check(self._primary, 'hiera roles',
+                                   'primary-controller'):
+                    self._primary = None
+            if self._primary is None:
+                self.discover()
+            if self._primary is None:
+                raise Exception("Can't find primary controller")
+            return self._primary
+
+    def leader(self, verify=False):
+        """Return pacemaker DC controller
+
+        :param verify: check that cached controller is still DC
+        """
+        with self._lock:
+            if self._leader is not None and verify:
+                if not self._check(self._leader,
+                                   'pcs status cluster | grep "Current DC:"',
+                                   self._leader.data['fqdn']):
+                    self._leader = None
+            if self._leader is None:
+                self.discover()
+            return self._leader
+
+
 class Environment(environment.Environment):
     """Extended fuelclient Environment model with some helpful methods"""
 
@@ -94,17 +257,18 @@ class Environment(environment.Environment):
     def __init__(self, *args, **kwargs):
         super(Environment, self).__init__(*args, **kwargs)
         self._os_conn = None
+        self.controller_roles = ControllerRoles(self)
 
     @property
     def os_conn(self):
-        controller_address = self.get_primary_controller_ip()
-        if self.ssl_enabled:
-            controller_address = self.ssl_hostname
         if self._os_conn is None:
-            self._os_conn = OpenStackActions(
-                controller_ip=controller_address,
-                cert=self.certificate,
-                env=self)
+            if self.ssl_enabled:
+                controller_address = self.ssl_hostname
+            else:
+                controller_address = self.get_primary_controller_ip()
+            self._os_conn = os_conn_pool.get(controller_address,
+                                             cert=self.certificate,
+                                             env=self)
         return self._os_conn
 
     @property
@@ -118,26 +282,42 @@ class Environment(environment.Environment):
                 self._admin_ssh_keys_paths.append(path)
         return self._admin_ssh_keys_paths
 
-    def get_all_nodes(self):
-        nodes = super(Environment, self).get_all_nodes()
-        return [NodeProxy(x, self) for x in nodes]
+    @property
+    def topology(self):
+        """Cached nodes view (see `Topology`)"""
+        return topology_cache.get(self)
+
+    def get_fresh_nodes(self):
+        """Returns list of fuelclient Node instances from Fuel API"""
+        return super(Environment, self).get_all_nodes()
+
+    def get_all_nodes(self, fresh=False):
+        """Returns list of NodeProxy for cluster nodes
+
+        :param fresh: skip nodes cache and get actual nodes data
+        """
+        return list(topology_cache.get(self, fresh=fresh).nodes)
 
     def get_primary_controller_ip(self):
         """Return public ip of primary controller"""
         return self.get_network_data()['public_vip']
 
     def find_node_by_fqdn(self, fqdn):
-        """Returns list of fuelclient.objects.Node instances for cluster"""
-        for node in self.get_all_nodes():
-            if node.data['fqdn'] == fqdn:
-                return node
-        raise Exception("Node doesn't found")
+        """Returns NodeProxy instance with `fqdn`"""
+        node = self.topology.by_fqdn.get(fqdn)
+        if node is None:
+            # cluster may be changed - look at actual data
+            node = topology_cache.get(self, fresh=True).by_fqdn.get(fqdn)
+        if node is None:
+            raise Exception("Node doesn't found")
+        return node
 
     def get_ssh_to_node(self, ip):
         return SSHClient(
             host=ip,
             username='root',
-            private_keys=self.admin_ssh_keys
+            private_keys=self.admin_ssh_keys,
+            pool=connection_pool
         )
 
     def get_ssh_to_vm(self, ip, username=None, password=None,
@@ -148,8 +328,25 @@ class Environment(environment.Environment):
 
     def get_nodes_by_role(self, role):
         """Returns nodes by assigned role"""
-        return [x for x in self.get_all_nodes()
-                if role in x.data['roles']]
+        return list(self.topology.by_role.get(role, []))
+
+    def run_on_nodes(self, nodes, command, concurrency=None, fail_fast=False,
+                     check=False, timeout=None):
+        """Execute command on nodes simultaneously
+
+        :param nodes: list of NodeProxy
+        :param concurrency: max count of simultaneous executions
+        :param fail_fast: stop on first failure and raise CalledProcessError
+        :param check: raise CalledProcessError if command failed on any node
+        :param timeout: execution timeout in seconds
+        :return: list of CommandResult (with `host` and `duration`
+            attributes) in `nodes` order
+        """
+        return execute_parallel([x.ssh() for x in nodes], command,
+                                concurrency=concurrency,
+                                fail_fast=fail_fast,
+                                check=check,
+                                timeout=timeout)
 
     def get_tests(self):
         return self.connection.get_request('tests/{0}'.format(self.id),
@@ -250,29 +447,11 @@ class Environment(environment.Environment):
 
     @property
     def leader_controller(self):
-        controllers = self.get_nodes_by_role('controller')
-        controller_ip = controllers[0].data['ip']
-        with self.get_ssh_to_node(controller_ip) as remote:
-            response = remote.check_call(
-                'pcs status cluster | grep "Current DC:"')
-        stdout = response.stdout_string
-        for controller in controllers:
-            if controller.data['fqdn'] in stdout:
-                return controller
+        return self.controller_roles.leader(verify=True)
 
     @property
     def primary_controller(self):
-        controllers = self.get_nodes_by_role('controller')
-        for controller in controllers:
-            with controller.ssh() as remote:
-                response = remote.execute('hiera roles')
-                stdout = ' '.join(response['stdout'])
-                logger.debug('hiera roles for {} is {}'.format(
-                    controller.data['fqdn'], stdout))
-                if 'primary-controller' in stdout:
-                    return controller
-        else:
-            raise Exception("Can't find primary controller")
+        return self.controller_roles.primary(verify=True)
 
     @property
     def non_primary_controllers(self):
@@ -289,6 +468,10 @@ class Environment(environment.Environment):
                     for node in devops_nodes]
         for node in devops_nodes:
             node.destroy()
+        for ip in node_ips:
+            connection_pool.clear(host=ip)
+        topology_cache.invalidate(self.id)
+        self.controller_roles.invalidate()
         wait(lambda: self.check_nodes_get_offline_state(node_ips),
              timeout_seconds=10 * 60,
              waiting_for='the nodes get offline state')
@@ -296,7 +479,7 @@ class Environment(environment.Environment):
         def keyfunc(node):
             return node.data['online']
 
-        all_nodes = self.get_all_nodes()
+        all_nodes = self.get_all_nodes(fresh=True)
         all_nodes.sort(key=keyfunc)
         for online, nodes in groupby(all_nodes, keyfunc):
             logger.info('online is {0} for nodes {1}'
@@ -310,14 +493,17 @@ class Environment(environment.Environment):
             with self.get_ssh_to_node(node_ip) as remote:
                 remote.check_call('/sbin/shutdown -Ph now')
         self.destroy_nodes(devops_nodes)
+        topology_cache.invalidate(self.id)
 
     def warm_start_nodes(self, devops_nodes):
         for node in devops_nodes:
             logger.info('Starting node {}'.format(node.name))
             node.create()
+        self.controller_roles.invalidate()
         wait(self.check_nodes_get_online_state, timeout_seconds=10 * 60)
+        topology_cache.invalidate(self.id)
         logger.info('wait until the nodes get online state')
-        for node in self.get_all_nodes():
+        for node in self.get_all_nodes(fresh=True):
             logger.info('online state of node {0} now is {1}'
                         .format(node.data['name'], node.data['online']))
 
@@ -329,20 +515,40 @@ class Environment(environment.Environment):
 
     def check_nodes_get_offline_state(self, node_ips=()):
         nodes_states = [not x.data['online']
-                        for x in self.get_all_nodes()
+                        for x in self.get_all_nodes(fresh=True)
                         if x.data['ip'] in node_ips]
         return all(nodes_states)
 
     def check_nodes_get_online_state(self):
-        return all([node.data['online'] for node in self.get_all_nodes()])
+        return all([node.data['online']
+                    for node in self.get_all_nodes(fresh=True)])
 
     def get_node_ip_by_host_name(self, hostname):
-        controller_ip = ''
-        for node in self.get_all_nodes():
-            if node.data['fqdn'] == hostname:
-                controller_ip = node.data['ip']
-                break
-        return controller_ip
+        node = self.topology.by_fqdn.get(hostname)
+        if node is None:
+            return ''
+        return node.data['ip']
+
+    def get_node_by_ip(self, ip):
+        """Returns NodeProxy with admin or any other network `ip`"""
+        return self.topology.by_ip.get(ip)
+
+    def get_node_by_mac(self, mac):
+        """Returns NodeProxy with admin interface `mac`"""
+        return self.topology.by_mac.get(mac)
+
+    def assign(self, nodes, roles):
+        super(Environment, self).assign(nodes, roles)
+        topology_cache.invalidate(self.id)
+
+    def unassign(self, nodes):
+        super(Environment, self).unassign(nodes)
+        topology_cache.invalidate(self.id)
+
+    def deploy_changes(self, *args, **kwargs):
+        result = super(Environment, self).deploy_changes(*args, **kwargs)
+        topology_cache.invalidate(self.id)
+        return result
 
     def get_node_by_devops_node(self, devops_node, interface='admin'):
         interfaces = devops_node.interface_by_network_name(interface)
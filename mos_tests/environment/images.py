@@ -0,0 +1,204 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import defaultdict
+import hashlib
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import threading
+import time
+
+from mos_tests.functions import file_cache
+
+logger = logging.getLogger(__name__)
+
+_checksums = {}
+_checksums_lock = threading.Lock()
+
+
+def file_md5(path):
+    """Return md5 (glance image checksum) of file, memoized"""
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    with _checksums_lock:
+        if key in _checksums:
+            return _checksums[key]
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(file_cache.CHUNK_SIZE), b''):
+            digest.update(chunk)
+    with _checksums_lock:
+        _checksums[key] = digest.hexdigest()
+    return _checksums[key]
+
+
+def log_progress(name, done, total, rate):
+    logger.debug('Image {0} upload: {1}/{2} MiB, {3:.1f} MiB/s'.format(
+        name, done // 1024 ** 2, total // 1024 ** 2, rate / 1024 ** 2))
+
+
+class ProgressFile(object):
+    """File wrapper, which reports read progress
+
+    :param callback: callable with (name, done bytes, total bytes,
+        bytes per second) args
+    :param interval: min time between callback calls in seconds
+    """
+
+    def __init__(self, f, name, size, callback=None, interval=10):
+        self._file = f
+        self.name = name
+        self.size = size
+        self.callback = callback
+        self.interval = interval
+        self.done = 0
+        self.start = self._reported = time.time()
+
+    def _report(self, force=False):
+        now = time.time()
+        if self.callback is None:
+            return
+        if not force and now - self._reported < self.interval:
+            return
+        self._reported = now
+        rate = self.done / max(now - self.start, 0.001)
+        self.callback(self.name, self.done, self.size, rate)
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self.done += len(data)
+        self._report(force=not data)
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(file_cache.CHUNK_SIZE), b'')
+
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+
+class ImageProvisioner(object):
+    """Uploads images from files cache to glance
+
+    Image isn't uploaded if glance already has active image with same
+    checksum and formats, existing image is returned instead. Images
+    created by provisioner are reference counted: `release` deletes image
+    when it is released by all users. Images, which existed before, are
+    never deleted. Images created by provisioners of other processes (they
+    are marked with `PROVISIONED_PROPERTY`) are never reused, because they
+    may be deleted by their owners at any moment.
+
+    :param os_conn: OpenStackActions instance
+    :param concurrency: count of parallel uploads for `provision_many`
+    """
+
+    PROVISIONED_PROPERTY = 'mos_tests_provisioned'
+
+    def __init__(self, os_conn, concurrency=3):
+        self.os_conn = os_conn
+        self.concurrency = concurrency
+        self._owned = defaultdict(int)
+        self._lock = threading.Lock()
+        self._checksum_locks = defaultdict(threading.Lock)
+
+    @property
+    def glance(self):
+        return self.os_conn.glance
+
+    def find_image(self, checksum, disk_format, container_format):
+        """Return active image, which may be reused, or None"""
+        for image in self.glance.images.list():
+            if (image.get(self.PROVISIONED_PROPERTY) and
+                    image.id not in self._owned):
+                continue
+            if (image.get('checksum') == checksum and
+                    image.get('status') == 'active' and
+                    image.get('disk_format') == disk_format and
+                    image.get('container_format') == container_format):
+                return image
+
+    def provision(self, url, name, disk_format='qcow2',
+                  container_format='bare', progress=log_progress,
+                  **properties):
+        """Return glance image with file from url
+
+        :param progress: upload progress callback (see `ProgressFile`)
+        :param properties: additional image properties
+        """
+        # file is kept opened to not be evicted by other processes
+        with file_cache.get_file(url) as f:
+            return self._provision(f, name, disk_format, container_format,
+                                   progress, properties)
+
+    def _provision(self, f, name, disk_format, container_format, progress,
+                   properties):
+        checksum = file_md5(f.name)
+        with self._lock:
+            checksum_lock = self._checksum_locks[checksum]
+        with checksum_lock:
+            image = self.find_image(checksum, disk_format, container_format)
+            if image is not None:
+                logger.info('Use existing image {0} ({1}) for {2}'.format(
+                    image.name, image.id, name))
+                with self._lock:
+                    if image.id in self._owned:
+                        self._owned[image.id] += 1
+                return image
+
+            properties[self.PROVISIONED_PROPERTY] = 'true'
+            image = self.glance.images.create(
+                name=name, disk_format=disk_format,
+                container_format=container_format, **properties)
+            size = os.fstat(f.fileno()).st_size
+            start = time.time()
+            try:
+                f.seek(0)
+                self.glance.images.upload(
+                    image.id, ProgressFile(f, name, size, callback=progress))
+            except Exception:
+                self.glance.images.delete(image.id)
+                raise
+            logger.info('Image {0} ({1} MiB) uploaded in {2:.0f}s'.format(
+                name, size // 1024 ** 2, time.time() - start))
+            with self._lock:
+                self._owned[image.id] += 1
+            return self.glance.images.get(image.id)
+
+    def provision_many(self, specs):
+        """Provision several images concurrently
+
+        :param specs: list of dicts with `provision` kwargs
+        :returns: list of images in same order
+        """
+        pool = ThreadPool(min(self.concurrency, len(specs)) or 1)
+        try:
+            return pool.map(lambda x: self.provision(**x), specs)
+        finally:
+            pool.close()
+            pool.join()
+
+    def release(self, image_id):
+        """Delete image if it was created by provisioner and not used"""
+        with self._lock:
+            if image_id not in self._owned:
+                return
+            self._owned[image_id] -= 1
+            if self._owned[image_id] > 0:
+                return
+            del self._owned[image_id]
+        self.glance.images.delete(image_id)
@@ -12,8 +12,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from collections import OrderedDict
 import logging
+from multiprocessing.pool import ThreadPool
 import random
+import re
+import threading
 import time
 
 from cinderclient import client as cinderclient
@@ -31,10 +35,15 @@ from novaclient import exceptions as nova_exceptions
 import paramiko
 import six
 
+from mos_tests.environment.cleanup import NetworkCleanup
+from mos_tests.environment.images import ImageProvisioner
+from mos_tests.environment.ssh import NodeJump
 from mos_tests.environment.ssh import SSHClient
+from mos_tests.environment.ssh import vm_connection_pool
 from mos_tests.functions.common import gen_temp_file
 from mos_tests.functions.common import wait
 from mos_tests.functions import os_cli
+from mos_tests.functions.profiling import counters
 
 logger = logging.getLogger(__name__)
 
@@ -54,8 +63,139 @@ class InstanceError(Exception):
         return msg
 
 
+class ServersStatusTracker(object):
+    """Tracks statuses of many servers with single nova request per poll
+
+    First poll lists all servers (servers missed in list are requested
+    separately), next polls request only servers changed since the latest
+    seen update (deleted servers are included in such response with DELETED
+    status).
+
+    :param nova: nova client
+    :param servers: list of servers or servers ids
+    :param all_tenants: list servers of all tenants (admin only)
+    """
+
+    deleted_statuses = ('DELETED', 'SOFT_DELETED')
+
+    def __init__(self, nova, servers, all_tenants=False):
+        self.nova = nova
+        self.all_tenants = all_tenants
+        self.ids = [getattr(x, 'id', x) for x in servers]
+        self.servers = {}
+        self.deleted = set()
+        self.history = {x: [] for x in self.ids}
+        self.start = time.time()
+        self._changes_since = None
+
+    def _set_status(self, server_id, status):
+        history = self.history[server_id]
+        if not history or history[-1][0] != status:
+            history.append((status, time.time() - self.start))
+
+    def poll(self):
+        """Update servers statuses
+
+        :raises: InstanceError, if any of tracked servers is in ERROR status
+        """
+        search_opts = {}
+        if self.all_tenants:
+            search_opts['all_tenants'] = True
+        if self._changes_since is not None:
+            search_opts['changes-since'] = self._changes_since
+        servers = self.nova.servers.list(search_opts=search_opts)
+        seen = set()
+        for server in servers:
+            if server.id not in self.history:
+                continue
+            seen.add(server.id)
+            self.servers[server.id] = server
+            self._set_status(server.id, server.status)
+            if server.status in self.deleted_statuses:
+                self.deleted.add(server.id)
+            elif server.status == 'ERROR':
+                raise InstanceError(server)
+        if self._changes_since is None:
+            # server may be missed in list, so deletion is confirmed
+            for server_id in set(self.ids) - seen:
+                try:
+                    server = self.nova.servers.get(server_id)
+                except nova_exceptions.NotFound:
+                    self.deleted.add(server_id)
+                    self._set_status(server_id, 'DELETED')
+                    continue
+                self.servers[server_id] = server
+                self._set_status(server_id, server.status)
+                if server.status in self.deleted_statuses:
+                    self.deleted.add(server_id)
+                elif server.status == 'ERROR':
+                    raise InstanceError(server)
+        updates = [x.updated for x in servers if getattr(x, 'updated', None)]
+        if updates:
+            self._changes_since = max(updates + [self._changes_since or ''])
+
+    def all_in_status(self, status):
+        self.poll()
+        return all(x not in self.deleted and
+                   self.servers[x].status == status for x in self.ids)
+
+    def all_deleted(self):
+        self.poll()
+        return all(x in self.deleted for x in self.ids)
+
+    def log_transitions(self):
+        for server_id in self.ids:
+            transitions = ' -> '.join(
+                '{0} ({1:.1f}s)'.format(*x) for x in self.history[server_id])
+            logger.debug('Server {0} statuses: {1}'.format(server_id,
+                                                           transitions))
+
+
+class ProfiledSession(session.Session):
+    """Keystone session, which counts API calls and time for each service"""
+
+    def request(self, url, method, **kwargs):
+        endpoint_filter = kwargs.get('endpoint_filter') or {}
+        service = endpoint_filter.get('service_type', 'identity')
+        start = time.time()
+        try:
+            return super(ProfiledSession, self).request(url, method, **kwargs)
+        finally:
+            counters.add('api_calls')
+            counters.add('api_calls.{0}'.format(service))
+            counters.add('api_time.{0}'.format(service), time.time() - start)
+
+
+class lazy_client(object):
+    """OpenStackActions client property, created on first access"""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.name = factory.__name__
+        self.__doc__ = factory.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        with obj._clients_lock:
+            if self.name not in obj._clients:
+                logger.debug('Init {0} client'.format(self.name))
+                obj._clients[self.name] = self.factory(obj)
+            return obj._clients[self.name]
+
+    def __set__(self, obj, value):
+        with obj._clients_lock:
+            obj._clients[self.name] = value
+
+
 class OpenStackActions(object):
-    """OpenStack base services clients and helper actions"""
+    """OpenStack base services clients and helper actions
+
+    Services clients are created on first use and share one keystone
+    session, so token and service catalog are fetched once, token is
+    refreshed by session when it expires (or is rejected) and HTTP
+    connections are reused.
+    """
 
     def __init__(self, controller_ip, user='admin', password='admin',
                  tenant='admin', cert=None, env=None, proxy_session=None):
@@ -83,25 +223,84 @@ class OpenStackActions(object):
                                 auth_url=auth_url,
                                 tenant_name=tenant)
 
-        self.session = session.Session(auth=auth, verify=self.path_to_cert)
-
-        self.keystone = KeystoneClient(session=self.session)
-        self.keystone.management_url = auth_url
-
-        self.nova = nova_client.Client(version=2, session=self.session)
+        self.auth_url = auth_url
+        self.session = ProfiledSession(auth=auth, verify=self.path_to_cert)
+        self._clients = {}
+        self._clients_lock = threading.RLock()
 
-        self.cinder = cinderclient.Client(version=2, session=self.session)
+        self.env = env
+        self._vm_transports = {}
+        self.image_provisioner = ImageProvisioner(self)
 
-        self.neutron = neutron_client.Client(session=self.session)
+    @property
+    def is_admin(self):
+        """Whether user has admin role in tenant"""
+        access = self.session.auth.get_access(self.session)
+        return 'admin' in access.role_names
+
+    @lazy_client
+    def keystone(self):
+        keystone = KeystoneClient(session=self.session)
+        keystone.management_url = self.auth_url
+        return keystone
+
+    @lazy_client
+    def nova(self):
+        return nova_client.Client(version=2, session=self.session)
+
+    @lazy_client
+    def cinder(self):
+        return cinderclient.Client(version=2, session=self.session)
+
+    @lazy_client
+    def neutron(self):
+        return neutron_client.Client(session=self.session)
+
+    @lazy_client
+    def glance(self):
+        return GlanceClient(session=self.session)
+
+    @lazy_client
+    def heat(self):
+        # session client instead of static token, which expires
+        return HeatClient(session=self.session, endpoint_type='publicURL')
+
+    def rebind(self, env=None):
+        """Prepare to work with env after snapshot revert
+
+        Session (with HTTP connections) and clients are kept, token is
+        dropped (it can be unknown to reverted keystone), as well as
+        connections to instances and provisioned images references.
+
+        :param env: new Environment instance (optional)
+        """
+        if env is not None:
+            self.env = env
+        self.session.invalidate()
+        for transport in self._vm_transports.values():
+            transport.close()
+        self._vm_transports.clear()
+        self.image_provisioner = ImageProvisioner(self)
+
+    def provision_image(self, url, name, **kwargs):
+        """Return glance image with file from url
+
+        Existing image with same checksum is reused, otherwise file is
+        uploaded from local files cache. See
+        `mos_tests.environment.images.ImageProvisioner.provision`.
+        """
+        return self.image_provisioner.provision(url, name, **kwargs)
 
-        self.glance = GlanceClient(session=self.session)
+    def provision_images(self, specs):
+        """Provision several images concurrently
 
-        endpoint_url = self.session.get_endpoint(service_type='orchestration',
-                                                 endpoint_type='publicURL')
-        token = self.session.get_token()
-        self.heat = HeatClient(endpoint=endpoint_url, token=token)
+        :param specs: list of dicts with `provision_image` kwargs
+        """
+        return self.image_provisioner.provision_many(specs)
 
-        self.env = env
+    def release_image(self, image_id):
+        """Delete provisioned image, if it was uploaded and isn't used"""
+        self.image_provisioner.release(image_id)
 
     def _get_cirros_image(self):
         for image in self.glance.images.list():
@@ -149,19 +348,33 @@ class OpenStackActions(object):
         return self.server_status_is(server, 'ACTIVE')
 
     def wait_servers_active(self, servers, timeout=10 * 60):
-        wait(lambda: all(self.is_server_active(x) for x in servers),
+        tracker = ServersStatusTracker(self.nova, servers,
+                                       all_tenants=self.is_admin)
+        wait(lambda: tracker.all_in_status('ACTIVE'),
              timeout_seconds=timeout,
              waiting_for='instances to become at ACTIVE status')
+        tracker.log_transitions()
 
     def wait_servers_ssh_ready(self, servers, timeout=10 * 60):
-        wait(lambda: all(self.is_server_ssh_ready(x) for x in servers),
+        not_ready = list(servers)
+
+        def is_ready():
+            # check only servers, which are not ready yet
+            not_ready[:] = [x for x in not_ready
+                            if not self.is_server_ssh_ready(x)]
+            return len(not_ready) == 0
+
+        wait(is_ready,
              timeout_seconds=timeout,
              waiting_for='instances to be ssh ready')
 
     def wait_servers_deleted(self, servers, timeout=3 * 60):
-        wait(lambda: all(self.is_server_deleted(x) for x in servers),
+        tracker = ServersStatusTracker(self.nova, servers,
+                                       all_tenants=self.is_admin)
+        wait(tracker.all_deleted,
              timeout_seconds=timeout,
              waiting_for='instances to be deleted')
+        tracker.log_transitions()
 
     def wait_marker_in_servers_log(self, servers, marker, timeout=10 * 60):
         wait(lambda: all(marker in x.get_console_output() for x in servers),
@@ -190,6 +403,90 @@ class OpenStackActions(object):
             self.wait_servers_ssh_ready([srv], timeout=timeout)
         return self.get_instance_detail(srv.id)
 
+    def create_servers_bulk(self, specs, concurrency=10, timeout=600,
+                            wait_for_active=True, wait_for_avaliable=True):
+        """Boot many servers simultaneously
+
+        All boot requests are sent before waiting. Identical specs are booted
+        with single request (with nova `min_count`/`max_count`), other ones
+        are sent in parallel.
+
+        :param specs: list of dicts with `create_server` arguments
+            (`name` is required, other ones have `create_server` defaults)
+        :param concurrency: max count of simultaneous boot requests
+        :return: list of servers in `specs` order. If `wait_for_active` is
+            True, each server has `boot_time` attribute - time in seconds
+            from boot request to ACTIVE status
+        """
+        default_image_id = None
+        if any(x.get('image_id') is None for x in specs):
+            default_image_id = self._get_cirros_image().id
+        defaults = dict(flavor=1, userdata=None, files=None, key_name=None)
+        specs = [dict(defaults, **x) for x in specs]
+
+        groups = OrderedDict()
+        for i, spec in enumerate(specs):
+            key = repr(sorted(spec.items()))
+            groups.setdefault(key, []).append(i)
+
+        def find_servers(name):
+            name_re = '^{0}(-[0-9]+)?$'.format(re.escape(name))
+            return self.nova.servers.list(search_opts={'name': name_re})
+
+        def boot(indexes):
+            kwargs = dict(specs[indexes[0]])
+            name = kwargs.pop('name')
+            image_id = kwargs.pop('image_id', None) or default_image_id
+            count = len(indexes)
+            if count > 1:
+                existing = set(x.id for x in find_servers(name))
+                kwargs.update(min_count=count, max_count=count)
+            start = time.time()
+            srv = self.nova.servers.create(name=name, image=image_id,
+                                           **kwargs)
+            if count == 1:
+                return indexes, [srv], start
+            srvs = [x for x in find_servers(name) if x.id not in existing]
+            assert len(srvs) == count, (
+                "Expected {0} servers with name {1}, found {2}".format(
+                    count, name, len(srvs)))
+            srvs.sort(key=lambda x: x.name)
+            return indexes, srvs, start
+
+        results = [None] * len(specs)
+        boot_starts = {}
+        pool = ThreadPool(min(concurrency, len(groups)) or 1)
+        try:
+            for indexes, srvs, start in pool.imap_unordered(
+                    boot, groups.values()):
+                for index, srv in zip(indexes, srvs):
+                    results[index] = srv
+                    boot_starts[srv.id] = start
+        finally:
+            pool.close()
+            pool.join()
+        logger.info('{0} servers boot requests are sent'.format(len(specs)))
+
+        if not wait_for_active:
+            return results
+
+        tracker = ServersStatusTracker(self.nova, results,
+                                       all_tenants=self.is_admin)
+        wait(lambda: tracker.all_in_status('ACTIVE'),
+             timeout_seconds=timeout,
+             waiting_for='instances to become at ACTIVE status')
+        tracker.log_transitions()
+        results = [tracker.servers[x.id] for x in results]
+        for srv in results:
+            active_time = tracker.start + tracker.history[srv.id][-1][1]
+            srv.boot_time = active_time - boot_starts[srv.id]
+            logger.debug('Server {0.name} boot time is {0.boot_time:.1f}s'
+                         .format(srv))
+
+        if wait_for_avaliable:
+            self.wait_servers_ssh_ready(results, timeout=timeout)
+        return results
+
     def is_server_ssh_ready(self, server):
         """Check ssh connect to server"""
 
@@ -697,38 +994,31 @@ class OpenStackActions(object):
                 logger.info('the port {} is not deletable'
                             .format(port['id']))
 
-    def cleanup_network(self, networks_to_skip=tuple()):
+    def cleanup_network(self, networks_to_skip=tuple(), concurrency=10):
         """Clean up the neutron networks.
 
+        Resources are deleted in parallel in dependency order, see
+        `mos_tests.environment.cleanup.NetworkCleanup`.
+
         :param networks_to_skip: list of networks names that should be kept
+        :param concurrency: max count of simultaneous delete requests
+        :returns: CleanupReport with phases durations and not deleted
+            resources
         """
-        # net ids with the names from networks_to_skip are filtered out
-        networks = [x['id'] for x in self.neutron.list_networks()['networks']
-                    if x['name'] not in networks_to_skip]
-
-        self.delete_keypairs()
+        return NetworkCleanup(self, networks_to_skip=networks_to_skip,
+                              concurrency=concurrency).run()
 
-        self.delete_floating_ips()
+    def _get_vm_transport(self, ssh, vm_host, creds):
+        """Return authenticated transport to VM through node connection
 
-        self.delete_servers()
-
-        self.delete_security_groups()
-
-        self.delete_ports(networks)
-
-        self.delete_subnets(networks)
-
-        self.delete_routers()
-
-        # Delete nets
-        for net in networks:
-            try:
-                self.neutron.delete_network(net)
-            except NeutronClientException:
-                logger.info('the net {} is not deletable'
-                            .format(net))
+        Transports are cached per (node, vm, creds) to reuse them between
+        commands.
+        """
+        key = (ssh.host, vm_host, creds)
+        transport = self._vm_transports.get(key)
+        if transport is not None and transport.is_active():
+            return transport
 
-    def execute_through_host(self, ssh, vm_host, cmd, creds=()):
         logger.debug("Making intermediate transport")
         intermediate_transport = ssh._ssh.get_transport()
 
@@ -740,9 +1030,14 @@ class OpenStackActions(object):
         logger.debug("Starting client")
         transport.start_client()
         logger.info("Passing authentication to VM: {}".format(creds))
+        transport.auth_password(creds[0], creds[1])
+        self._vm_transports[key] = transport
+        return transport
+
+    def execute_through_host(self, ssh, vm_host, cmd, creds=()):
         if not creds:
             creds = ('cirros', 'cubswin:)')
-        transport.auth_password(creds[0], creds[1])
+        transport = self._get_vm_transport(ssh, vm_host, tuple(creds))
 
         logger.debug("Opening session")
         channel = transport.open_session()
@@ -813,17 +1108,11 @@ class OpenStackActions(object):
                 proxy_nodes = [proxy_node]
 
             for node in proxy_nodes:
-                ip = env.find_node_by_fqdn(node).data['ip']
-                key_paths = env.admin_ssh_keys_paths
-                proxy_command = (
-                    "ssh {keys} -o 'StrictHostKeyChecking no' "
-                    "root@{node_ip} 'ip netns exec {ns} "
-                    "nc {vm_ip} 22'".format(
-                        keys=' '.join('-i {}'.format(k) for k in key_paths),
-                        ns=dhcp_namespace,
-                        node_ip=ip,
-                        vm_ip=vm_ip))
-                proxy_commands.append(proxy_command)
+                node_ssh = env.find_node_by_fqdn(node).ssh()
+                proxy_commands.append(NodeJump(
+                    node_ssh,
+                    'ip netns exec {ns} nc {{host}} {{port}}'.format(
+                        ns=dhcp_namespace)))
         instance_keys = []
         if vm_keypair is not None:
             instance_keys.append(paramiko.RSAKey.from_private_key(six.StringIO(
@@ -833,7 +1122,9 @@ class OpenStackActions(object):
                          username=username,
                          password=password,
                          private_keys=instance_keys,
-                         proxy_commands=proxy_commands)
+                         proxy_commands=proxy_commands,
+                         pool=vm_connection_pool,
+                         pool_tag=vm.id)
 
     def wait_agents_alive(self, agt_ids_to_check):
         wait(lambda: all(agt['alive'] for agt in
@@ -1022,3 +1313,40 @@ class OpenStackActions(object):
             timeout_seconds=60 * 2,
             sleep_seconds=10,
             waiting_for='volumes [{names}] to be deleted'.format(names=names))
+
+
+class OpenStackActionsPool(object):
+    """OpenStackActions instances shared between Environment objects
+
+    Environment objects are recreated after each test, pool returns same
+    OpenStackActions (with its session, clients and connections) for them.
+    """
+
+    def __init__(self):
+        self._conns = {}
+        self._lock = threading.Lock()
+
+    def get(self, controller_ip, cert=None, env=None):
+        key = (controller_ip, cert)
+        with self._lock:
+            conn = self._conns.get(key)
+            if conn is None:
+                conn = OpenStackActions(controller_ip=controller_ip,
+                                        cert=cert, env=env)
+                self._conns[key] = conn
+            elif env is not None:
+                conn.env = env
+            return conn
+
+    def rebind(self):
+        """Rebind all connections after snapshot revert"""
+        with self._lock:
+            for conn in self._conns.values():
+                conn.rebind()
+
+    def clear(self):
+        with self._lock:
+            self._conns.clear()
+
+
+os_conn_pool = OpenStackActionsPool()
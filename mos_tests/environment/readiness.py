@@ -0,0 +1,173 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import logging
+from multiprocessing.pool import ThreadPool
+import re
+
+from waiting import TimeoutExpired
+
+from mos_tests.functions.common import wait
+
+logger = logging.getLogger(__name__)
+
+PACEMAKER_RUNNING_STATES = ('Started', 'Master', 'Masters', 'Slave', 'Slaves')
+
+
+class CheckError(Exception):
+    """Readiness check failed with error (it isn't a state mismatch)"""
+
+
+def parse_crm_mon(output):
+    """Return (running, stopped) resources instances count
+
+    :param output: `crm_mon -1 -r` output
+    """
+    running = stopped = 0
+    for line in output.splitlines():
+        brackets = re.search(r'\[(.*)\]', line)
+        count = len(brackets.group(1).split()) if brackets else 1
+        if 'Stopped' in line:
+            stopped += count
+        elif any(re.search(r'\b{0}\b'.format(x), line)
+                 for x in PACEMAKER_RUNNING_STATES):
+            running += count
+    return running, stopped
+
+
+def parse_rabbit_running_nodes(output):
+    """Return sorted running nodes from `rabbitmqctl cluster_status`"""
+    match = re.search(r'\{running_nodes,\[(.*?)\]\}', output, re.DOTALL)
+    if match is None:
+        return []
+    return sorted(re.findall(r"'?(rabbit@[\w.-]+)'?", match.group(1)))
+
+
+class Readiness(object):
+    """Fast env health check
+
+    Collects fingerprint of key services state in parallel: pacemaker
+    resources, rabbitmq cluster, nova services and neutron agents liveness,
+    keystone token issue and glance images listing. Env is treated as ready
+    when fingerprint is equal to expected one (recorded on ready env).
+
+    :param env: Environment instance
+    """
+
+    checks = ('pacemaker', 'rabbitmq', 'nova_services', 'neutron_agents',
+              'keystone', 'glance')
+
+    def __init__(self, env):
+        self.env = env
+
+    @property
+    def os_conn(self):
+        return self.env.os_conn
+
+    def _controller_call(self, cmd):
+        controller = self.env.controller_roles.primary()
+        with controller.ssh() as remote:
+            return remote.check_call(cmd, verbose=False).stdout_string
+
+    def check_pacemaker(self):
+        return parse_crm_mon(self._controller_call('crm_mon -1 -r'))
+
+    def check_rabbitmq(self):
+        return parse_rabbit_running_nodes(
+            self._controller_call('rabbitmqctl cluster_status'))
+
+    def check_nova_services(self):
+        return sorted('{0.binary}@{0.host}'.format(x)
+                      for x in self.os_conn.nova.services.list()
+                      if x.state == 'up' and x.status == 'enabled')
+
+    def check_neutron_agents(self):
+        return sorted('{agent_type}@{host}'.format(**x)
+                      for x in self.os_conn.neutron.list_agents()['agents']
+                      if x['alive'])
+
+    def check_keystone(self):
+        self.os_conn.session.invalidate()
+        return self.os_conn.session.get_token() is not None
+
+    def check_glance(self):
+        return len(list(self.os_conn.glance.images.list())) > 0
+
+    def _run_check(self, name):
+        try:
+            return getattr(self, 'check_' + name)()
+        except Exception as e:
+            logger.debug('Readiness check {0} failed: {1}'.format(name, e))
+            return CheckError('{0}: {1}'.format(name, e))
+
+    def fingerprint(self):
+        """Return dict with all checks results
+
+        Result of failed check is CheckError instance.
+        """
+        # token is issued first, other API checks will reuse it
+        results = {'keystone': self._run_check('keystone')}
+        names = [x for x in self.checks if x != 'keystone']
+        pool = ThreadPool(len(names))
+        try:
+            results.update(zip(names, pool.map(self._run_check, names)))
+        finally:
+            pool.close()
+            pool.join()
+        # values should be comparable with loaded from json
+        return {name: list(value) if isinstance(value, tuple) else value
+                for name, value in results.items()}
+
+    @staticmethod
+    def errors(fingerprint):
+        """Return list of CheckError from fingerprint"""
+        return [x for x in fingerprint.values() if isinstance(x, CheckError)]
+
+    @staticmethod
+    def diff(expected, actual):
+        """Return dict {check: (expected, actual)} for mismatched checks"""
+        return {name: (value, actual.get(name))
+                for name, value in expected.items()
+                if actual.get(name) != value}
+
+    def is_ready(self, expected, timeout=5 * 60):
+        """Wait until env fingerprint is equal to `expected`
+
+        Failed checks mean that env is not ready yet, so waiting continues
+        until timeout.
+
+        :returns: True if env is ready, False otherwise
+        """
+        state = {}
+
+        def predicate():
+            state['actual'] = self.fingerprint()
+            if self.errors(state['actual']):
+                return False
+            return not self.diff(expected, state['actual'])
+
+        try:
+            wait(predicate, timeout_seconds=timeout, sleep_seconds=20,
+                 waiting_for='env fingerprint to match')
+        except TimeoutExpired:
+            for error in self.errors(state['actual']):
+                logger.warning('Readiness check failed: {0}'.format(error))
+            for name, (value, actual) in self.diff(
+                    expected, state['actual']).items():
+                if isinstance(actual, CheckError):
+                    continue
+                logger.warning('Readiness check {0} mismatch: expected '
+                               '{1}, got {2}'.format(name, value, actual))
+            return False
+        return True
@@ -12,18 +12,25 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from collections import defaultdict
+from collections import deque
 import functools
 import itertools
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import posixpath
 import select
+import socket
 import stat
+import threading
 import time
 
 import paramiko
 import six
 
+from mos_tests.functions.profiling import counters
+
 
 logger = logging.getLogger(__name__)
 
@@ -65,14 +72,115 @@ class CalledProcessError(Exception):
         return message
 
 
+class OutputLines(object):
+    """Command output, which is split to lines only on first access
+
+    `CommandResult` returns it as list of lines (with line endings).
+    """
+
+    def __init__(self, data=b''):
+        self.raw = data
+        self._lines = None
+
+    @property
+    def lines(self):
+        if self._lines is None:
+            self._lines = self.raw.splitlines(True)
+        return self._lines
+
+    def __repr__(self):
+        return repr(self.lines)
+
+
+class OutputBuffer(object):
+    """Collects output chunks
+
+    :param max_size: max count of bytes to retain; if defined, only the
+        latest `max_size` bytes are kept (ring buffer)
+    :param line_callback: function to call with each complete line as soon
+        as it received
+    """
+
+    def __init__(self, max_size=None, line_callback=None):
+        self.max_size = max_size
+        self.line_callback = line_callback
+        self.size = 0
+        self.dropped = 0
+        self._chunks = deque()
+        self._partial = []
+
+    def append(self, chunk):
+        self._chunks.append(chunk)
+        self.size += len(chunk)
+        if self.max_size is not None:
+            self._shrink()
+        if self.line_callback is not None:
+            self._feed_lines(chunk)
+
+    def _shrink(self):
+        while self.size > self.max_size:
+            excess = self.size - self.max_size
+            first = self._chunks[0]
+            if len(first) <= excess:
+                self._chunks.popleft()
+                removed = len(first)
+            else:
+                self._chunks[0] = first[excess:]
+                removed = excess
+            self.size -= removed
+            self.dropped += removed
+
+    def _feed_lines(self, chunk):
+        if b'\n' not in chunk:
+            self._partial.append(chunk)
+            return
+        self._partial.append(chunk)
+        lines = b''.join(self._partial).splitlines(True)
+        self._partial = []
+        if not lines[-1].endswith(b'\n'):
+            self._partial.append(lines.pop())
+        for line in lines:
+            self.line_callback(line)
+
+    def flush(self):
+        """Pass last incomplete line to callback"""
+        if self.line_callback is not None and self._partial:
+            self.line_callback(b''.join(self._partial))
+        self._partial = []
+
+    def getvalue(self):
+        data = b''.join(self._chunks)
+        if self.dropped:
+            # drop first incomplete line
+            data = data[data.find(b'\n') + 1:]
+        return data
+
+
 class CommandResult(dict):
 
+    def __getitem__(self, key):
+        value = super(CommandResult, self).__getitem__(key)
+        if isinstance(value, OutputLines):
+            value = value.lines
+            self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
     @property
     def is_ok(self):
         return self['exit_code'] == 0
 
     def _list_to_string(self, key):
-        return (''.join(self[key])).decode('utf-8').strip()
+        value = super(CommandResult, self).__getitem__(key)
+        if isinstance(value, OutputLines):
+            data = value.raw
+        else:
+            data = ''.join(value)
+        return data.decode('utf-8').strip()
 
     @property
     def stdout_string(self):
@@ -83,8 +191,315 @@ class CommandResult(dict):
         return self._list_to_string('stderr')
 
 
+class PooledConnection(object):
+    """Cached ssh connection with usage accounting"""
+
+    def __init__(self, ssh, proxy=None):
+        self.ssh = ssh
+        self.proxy = proxy
+        self.users = 0
+        self.last_used = time.time()
+
+    @property
+    def is_alive(self):
+        transport = self.ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def ping(self):
+        """Send ssh ignore message to check that transport is still alive"""
+        try:
+            self.ssh.get_transport().send_ignore()
+            return True
+        except Exception as e:
+            logger.debug('Pooled connection health check failed: {}'.format(e))
+            return False
+
+    def close(self):
+        for item in (self.ssh, self.proxy):
+            if item is None:
+                continue
+            try:
+                item.close()
+            except Exception:
+                logger.exception("Could not close pooled connection")
+
+
+class SSHConnectionPool(object):
+    """Pool of authenticated ssh connections to reuse them between sessions
+
+    Connections are keyed by (host, port, credentials, proxies, pool tag).
+    SSHClient
+    created with `pool` argument borrows cached connection on `__enter__` and
+    gives it back on `__exit__`, so each command only opens new channel on
+    already established transport.
+
+    :param max_per_host: max count of connections with same key
+    :param max_sessions: max count of clients sharing one connection
+        (should be less than sshd `MaxSessions` option)
+    :param check_interval: idle time in seconds after which connection will
+        be checked before reuse
+    :param keepalive: transport keepalive interval in seconds
+    :param acquire_timeout: time in seconds to wait for free connection
+    :param idle_timeout: time in seconds after which unused connection will
+        be closed (None - keep forever)
+    :param max_size: max count of connections in pool, the least recently
+        used unused connection is closed to make new one (None - unlimited)
+    """
+
+    def __init__(self, max_per_host=4, max_sessions=8, check_interval=30,
+                 keepalive=30, acquire_timeout=60, idle_timeout=None,
+                 max_size=None):
+        self.max_size = max_size
+        self.max_per_host = max_per_host
+        self.max_sessions = max_sessions
+        self.check_interval = check_interval
+        self.keepalive = keepalive
+        self.acquire_timeout = acquire_timeout
+        self.idle_timeout = idle_timeout
+        self._connections = defaultdict(list)
+        self._pending = defaultdict(int)
+        self._lock = threading.Condition()
+
+    @staticmethod
+    def get_key(client):
+        return (client.host, client.port, client.username, client.password,
+                tuple(x.get_fingerprint() for x in client.private_keys),
+                tuple(str(x) for x in client.proxy_commands),
+                client.pool_tag)
+
+    def _evict_idle(self):
+        if self.idle_timeout is None:
+            return
+        now = time.time()
+        for key, connections in self._connections.items():
+            for conn in connections[:]:
+                if conn.users == 0 and \
+                        now - conn.last_used > self.idle_timeout:
+                    logger.debug('Close idle ssh connection to '
+                                 '{0[0]}:{0[1]}'.format(key))
+                    connections.remove(conn)
+                    conn.close()
+
+    def _evict_lru(self):
+        """Close the least recently used unused connection
+
+        :returns: True if connection was closed
+        """
+        idle = [(conn.last_used, key, conn)
+                for key, connections in self._connections.items()
+                for conn in connections if conn.users == 0]
+        if not idle:
+            return False
+        _, key, conn = min(idle, key=lambda x: x[0])
+        logger.debug('Close least recently used ssh connection to '
+                     '{0[0]}:{0[1]}'.format(key))
+        self._connections[key].remove(conn)
+        conn.close()
+        return True
+
+    def _is_full(self):
+        if self.max_size is None:
+            return False
+        total = (sum(len(x) for x in self._connections.values()) +
+                 sum(self._pending.values()))
+        return total >= self.max_size
+
+    def _evict_dead(self, key):
+        now = time.time()
+        connections = self._connections[key]
+        for conn in connections[:]:
+            need_ping = (conn.users == 0 and
+                         now - conn.last_used > self.check_interval)
+            if conn.is_alive and (not need_ping or conn.ping()):
+                continue
+            logger.debug('Evict dead ssh connection to {0[0]}:{0[1]}'.format(
+                key))
+            connections.remove(conn)
+            conn.close()
+
+    def _find(self, ssh):
+        for key, connections in self._connections.items():
+            for conn in connections:
+                if conn.ssh is ssh:
+                    return key, conn
+        return None, None
+
+    def _get_free(self, key):
+        connections = [x for x in self._connections[key]
+                       if x.users < self.max_sessions]
+        if connections:
+            return min(connections, key=lambda x: x.users)
+
+    def acquire(self, client):
+        """Return connected paramiko.SSHClient for client parameters
+
+        Makes new connection (with client authentication logic) only if there
+        is no cached alive connection with free sessions.
+        """
+        key = self.get_key(client)
+        deadline = time.time() + self.acquire_timeout
+        with self._lock:
+            self._evict_idle()
+            while True:
+                self._evict_dead(key)
+                conn = self._get_free(key)
+                if conn is not None:
+                    conn.users += 1
+                    return conn.ssh
+                total = len(self._connections[key]) + self._pending[key]
+                if total < self.max_per_host:
+                    if not self._is_full() or self._evict_lru():
+                        self._pending[key] += 1
+                        break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Exception(
+                        "Can't get free ssh connection to {0.host}:{0.port} "
+                        "in {1} seconds".format(client, self.acquire_timeout))
+                self._lock.wait(remaining)
+
+        try:
+            client.reconnect()
+            conn = PooledConnection(client._ssh, client._proxy)
+            client._proxy = None
+            conn.ssh.get_transport().set_keepalive(self.keepalive)
+        finally:
+            with self._lock:
+                self._pending[key] -= 1
+                self._lock.notify_all()
+
+        with self._lock:
+            conn.users += 1
+            self._connections[key].append(conn)
+        return conn.ssh
+
+    def release(self, ssh):
+        """Return connection to pool (or close it, if it is not pooled)"""
+        with self._lock:
+            key, conn = self._find(ssh)
+            if conn is not None:
+                conn.users = max(conn.users - 1, 0)
+                conn.last_used = time.time()
+                self._evict_idle()
+                self._lock.notify_all()
+                return
+        ssh.close()
+
+    def discard(self, ssh):
+        """Remove broken connection from pool and close it"""
+        with self._lock:
+            key, conn = self._find(ssh)
+            if conn is not None:
+                self._connections[key].remove(conn)
+                self._lock.notify_all()
+        if conn is not None:
+            conn.close()
+        else:
+            ssh.close()
+
+    def clear(self, host=None):
+        """Close all cached connections (to `host` only, if defined)
+
+        Should be called after actions which break existing connections,
+        like snapshot revert or nodes restart.
+        """
+        with self._lock:
+            keys = [x for x in self._connections
+                    if host is None or x[0] == str(host)]
+            to_close = [x for key in keys
+                        for x in self._connections.pop(key)]
+            self._lock.notify_all()
+        for conn in to_close:
+            conn.close()
+
+    @property
+    def stats(self):
+        """Return dict with connections count for each host"""
+        with self._lock:
+            return {key: len(value)
+                    for key, value in self._connections.items() if value}
+
+
+# Shared pool for connections to environment nodes
+connection_pool = SSHConnectionPool()
+
+# Shared pool for connections to instances (through env nodes). Each
+# connection holds jump channel on node connection, so count of connections
+# is limited to fit jump connections capacity (see `NodeJump`)
+vm_connection_pool = SSHConnectionPool(max_per_host=2, idle_timeout=5 * 60,
+                                       max_size=24)
+
+
+class JumpChannel(object):
+    """Socket-like channel through proxy node
+
+    Closing of channel gives node connection back to pool.
+    """
+
+    def __init__(self, remote, chan):
+        self._remote = remote
+        self._chan = chan
+
+    def __getattr__(self, name):
+        return getattr(self._chan, name)
+
+    def close(self):
+        try:
+            self._chan.close()
+        finally:
+            self._remote.__exit__(None, None, None)
+
+
+class NodeJump(object):
+    """Proxy to reach hosts through command executed on proxy node
+
+    Unlike `ProxyCommand`, it doesn't spawn local ssh process: session
+    channel is opened on (pooled) connection to proxy node, and this channel
+    is used as socket for connection to target host. Jump channels live as
+    long as connections to target hosts, so they use separate node
+    connections (with `jump` pool tag) to not starve usual node sessions.
+
+    :param node_client: SSHClient to proxy node (it is used as template for
+        new clients, so several jumps may be opened simultaneously)
+    :param command: command to connect stdin/stdout with target host, it is
+        formatted with `host` and `port`
+    """
+
+    def __init__(self, node_client, command='nc {host} {port}'):
+        self.node_client = node_client
+        self.command = command
+
+    def __str__(self):
+        return '{0.username}@{0.host}:{1}'.format(self.node_client,
+                                                  self.command)
+
+    def open(self, host, port, timeout=None):
+        client = self.node_client
+        remote = SSHClient(client.host, port=client.port,
+                           username=client.username,
+                           password=client.password,
+                           private_keys=client.private_keys,
+                           timeout=client.timeout,
+                           pool=client.pool,
+                           pool_tag='jump')
+        remote.__enter__()
+        try:
+            chan = remote._open_session()
+            chan.settimeout(timeout)
+            chan.exec_command(self.command.format(host=host, port=port))
+        except Exception:
+            remote.__exit__(None, None, None)
+            raise
+        return JumpChannel(remote, chan)
+
+
 class SSHClient(object):
 
+    # Max size of data to read from channel at once
+    chunk_size = 64 * 1024
+    # Max time to wait channel events in seconds
+    poll_interval = 1
+
     def __repr__(self):
         orig = super(SSHClient, self).__repr__()
         return '{} [{}:{}]'.format(orig, self.host, self.port)
@@ -107,7 +522,7 @@ class SSHClient(object):
 
     def __init__(self, host, port=22, username=None, password=None,
                  private_keys=None, proxy_commands=(), timeout=60,
-                 execution_timeout=60 * 60):
+                 execution_timeout=60 * 60, pool=None, pool_tag=None):
         self.host = str(host)
         self.port = int(port)
         self.username = username
@@ -121,6 +536,8 @@ class SSHClient(object):
         self.timeout = timeout
         self.execution_timeout = execution_timeout
         self.proxy_commands = proxy_commands
+        self.pool = pool
+        self.pool_tag = pool_tag
         self._ssh = None
         self._sftp_client = None
         self._proxy = None
@@ -136,7 +553,10 @@ class SSHClient(object):
 
         if self._ssh is not None:
             try:
-                self._ssh.close()
+                if self.pool is not None:
+                    self.pool.release(self._ssh)
+                else:
+                    self._ssh.close()
                 self._ssh = None
             except Exception:
                 logger.exception("Could not close ssh connection")
@@ -155,7 +575,10 @@ class SSHClient(object):
         if not self.closed:
             return self
         try:
-            self.reconnect()
+            if self.pool is not None:
+                self._ssh = self.pool.acquire(self)
+            else:
+                self.reconnect()
         except Exception:
             self.clear()
             raise
@@ -177,7 +600,12 @@ class SSHClient(object):
                          "as '{0.username}:{1}'....".format(self, password))
 
         sock = None
-        if proxy_command is not None:
+        if isinstance(proxy_command, NodeJump):
+            logger.debug('Jump for ssh: "{0}"'.format(proxy_command))
+            self._proxy = proxy_command.open(self.host, self.port,
+                                             timeout=self.timeout)
+            sock = self._proxy
+        elif proxy_command is not None:
             logger.debug('Proxy for ssh: "{0}"'.format(proxy_command))
             self._proxy = paramiko.ProxyCommand(proxy_command)
             self._proxy.settimeout(self.timeout)
@@ -278,32 +706,62 @@ class SSHClient(object):
         if errors:
             raise CalledProcessError(command, errors)
 
-    def execute(self, command, verbose=True, merge_stderr=False):
-        chan, stdin, stdout, stderr = self.execute_async(
-            command, merge_stderr=merge_stderr)
-
-        stdout_buf = ''
-        stderr_buf = ''
-
-        start = time.time()
+    def _iter_channel(self, chan, command, timeout=None):
+        """Yield (is_stderr, chunk) pairs until channel is closed"""
+        timeout = timeout or self.execution_timeout
+        deadline = time.time() + timeout
         while not chan.closed or chan.recv_ready() or chan.recv_stderr_ready():
-            select.select([chan], [], [chan], 60)
-
+            received = False
             if chan.recv_ready():
-                stdout_buf += chan.recv(1024)
+                yield False, chan.recv(self.chunk_size)
+                received = True
             if chan.recv_stderr_ready():
-                stderr_buf += chan.recv_stderr(1024)
+                yield True, chan.recv_stderr(self.chunk_size)
+                received = True
 
-            if time.time() > start + self.execution_timeout:
+            remaining = deadline - time.time()
+            if remaining <= 0:
                 chan.close()
                 raise Exception('Executing `{cmd}` is too long '
                                 '(more than {timeout} seconds)'.format(
-                                    cmd=command,
-                                    timeout=self.execution_timeout))
+                                    cmd=command, timeout=timeout))
+            if not received:
+                select.select([chan], [], [chan],
+                              min(remaining, self.poll_interval))
+
+    def execute(self, command, verbose=True, merge_stderr=False,
+                line_callback=None, max_output=None, timeout=None):
+        """Execute command and return CommandResult
+
+        :param line_callback: function, which will be called with each
+            stdout line as soon as it received
+        :param max_output: max bytes count to retain for each of stdout and
+            stderr (only the latest output is kept)
+        :param timeout: execution timeout in seconds (`execution_timeout`
+            by default)
+        """
+        chan, stdin, stdout, stderr = self.execute_async(
+            command, merge_stderr=merge_stderr)
+
+        buffers = {
+            False: OutputBuffer(max_size=max_output,
+                                line_callback=line_callback),
+            True: OutputBuffer(max_size=max_output),
+        }
+        for is_stderr, chunk in self._iter_channel(chan, command,
+                                                   timeout=timeout):
+            buffers[is_stderr].append(chunk)
+        buffers[False].flush()
+
+        for name, buf in (('stdout', buffers[False]),
+                          ('stderr', buffers[True])):
+            if buf.dropped:
+                logger.debug('{0} bytes of `{1}` {2} were dropped'.format(
+                    buf.dropped, command, name))
 
         result = CommandResult({
-            'stdout': stdout_buf.splitlines(True),
-            'stderr': stderr_buf.splitlines(True),
+            'stdout': OutputLines(buffers[False].getvalue()),
+            'stderr': OutputLines(buffers[True].getvalue()),
             'exit_code': chan.recv_exit_status()
         })
         stdin.close()
@@ -313,15 +771,62 @@ class SSHClient(object):
         if verbose:
             logger.debug("'{0}' exit_code is {1}".format(command, result[
                 'exit_code']))
-            if len(result['stdout']) > 0:
+            if result['stdout']:
                 logger.debug(u'Stdout:\n{0}'.format(result.stdout_string))
-            if len(result['stderr']) > 0:
+            if result['stderr']:
                 logger.debug(u'Stderr:\n{0}'.format(result.stderr_string))
         return result
 
+    def iter_lines(self, command, merge_stderr=False, timeout=None,
+                   check=False):
+        """Execute command and yield stdout lines as soon as they received
+
+        Output is not retained, so it is suitable for commands with huge
+        output.
+
+        :param check: raise CalledProcessError if command exit code is not 0
+        """
+        chan, stdin, stdout, stderr = self.execute_async(
+            command, merge_stderr=merge_stderr)
+        lines = deque()
+        buf = OutputBuffer(max_size=0, line_callback=lines.append)
+        try:
+            for is_stderr, chunk in self._iter_channel(chan, command,
+                                                       timeout=timeout):
+                if not is_stderr:
+                    buf.append(chunk)
+                while lines:
+                    yield lines.popleft()
+            buf.flush()
+            while lines:
+                yield lines.popleft()
+            exit_code = chan.recv_exit_status()
+        finally:
+            stdin.close()
+            stdout.close()
+            stderr.close()
+            chan.close()
+        if check and exit_code != 0:
+            raise CalledProcessError(command, exit_code)
+
+    def _open_session(self):
+        counters.add('ssh_commands')
+        try:
+            return self._ssh.get_transport().open_session(timeout=self.timeout)
+        except (paramiko.SSHException, EOFError, socket.error) as e:
+            if self.pool is None:
+                raise
+            logger.debug('Pooled connection to {0.host} is broken ({1}), '
+                         'reconnecting'.format(self, e))
+            self.pool.discard(self._ssh)
+            self._ssh = None
+            self._sftp_client = None
+            self._ssh = self.pool.acquire(self)
+            return self._ssh.get_transport().open_session(timeout=self.timeout)
+
     def execute_async(self, command, merge_stderr=False):
         logger.debug("Executing command: '%s'" % command.rstrip())
-        chan = self._ssh.get_transport().open_session(timeout=self.timeout)
+        chan = self._open_session()
         chan.set_combine_stderr(merge_stderr)
         stdin = chan.makefile('wb')
         stdout = chan.makefile('rb')
@@ -418,3 +923,73 @@ class SSHClient(object):
 
 def ssh(*args, **kwargs):
     return SSHClient(*args, **kwargs)
+
+
+def execute_parallel(remotes, command, concurrency=None, fail_fast=False,
+                     check=False, timeout=None, verbose=False):
+    """Execute command on many remotes simultaneously
+
+    Closed remotes are opened before executing and closed after.
+
+    :param remotes: list of SSHClient
+    :param command: command to execute
+    :param concurrency: max count of simultaneous executions (all remotes
+        by default)
+    :param fail_fast: don't start command on remaining remotes after first
+        failure and raise CalledProcessError
+    :param check: raise CalledProcessError, if command failed on any remote
+        (after all executions are done)
+    :param timeout: execution timeout in seconds for each remote
+    :return: list of CommandResult in `remotes` order. Each result has
+        `host` and `duration` (in seconds) attributes. If command can't be
+        executed due to exception, result `exit_code` is None and `error`
+        attribute contains exception.
+    """
+    remotes = list(remotes)
+    if not remotes:
+        return []
+    stop = threading.Event()
+
+    def run(index):
+        remote = remotes[index]
+        if stop.is_set():
+            return index, None
+        start = time.time()
+        try:
+            if remote.closed:
+                with remote:
+                    result = remote.execute(command, verbose=verbose,
+                                            timeout=timeout)
+            else:
+                result = remote.execute(command, verbose=verbose,
+                                        timeout=timeout)
+            result.error = None
+        except Exception as e:
+            logger.debug('`{0}` on {1.host} failed: {2}'.format(
+                command, remote, e))
+            result = CommandResult({'stdout': OutputLines(),
+                                    'stderr': OutputLines(),
+                                    'exit_code': None})
+            result.error = e
+        result.host = remote.host
+        result.duration = time.time() - start
+        if fail_fast and not result.is_ok:
+            stop.set()
+        return index, result
+
+    results = [None] * len(remotes)
+    pool = ThreadPool(concurrency or len(remotes))
+    try:
+        for index, result in pool.imap_unordered(run, range(len(remotes))):
+            results[index] = result
+    finally:
+        pool.close()
+        pool.join()
+
+    errors = {x.host: x['exit_code'] if x.error is None else x.error
+              for x in results if x is not None and not x.is_ok}
+    if errors and (fail_fast or check):
+        raise CalledProcessError(command, errors)
+    logger.debug('`{0}` executed on {1} remotes in {2:.1f}s'.format(
+        command, len(remotes), max(x.duration for x in results)))
+    return results
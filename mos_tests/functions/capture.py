@@ -0,0 +1,218 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from contextlib import contextmanager
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import tempfile
+import threading
+import uuid
+
+from contextlib2 import ExitStack
+
+from mos_tests.functions import pcap
+
+logger = logging.getLogger(__name__)
+
+__doc__ = """Remote tcpdump captures
+
+    with capture(env, compute_ip, bpf='port 4789') as cap:
+        ...
+    cap.capture.filter(proto='icmp', src=ip1, dst=ip2)
+
+By default packets are streamed over ssh channel and decoded while capture
+is running, nothing is stored on remote node. With `ring_size` tcpdump
+writes rotated files on remote node instead (only the latest
+`ring_files` * `ring_size` MB are kept), they are downloaded after stop.
+"""
+
+
+class TeeFile(object):
+    """Read-only file wrapper, which copies read data to other file"""
+
+    def __init__(self, f, copy_to):
+        self._file = f
+        self.copy_to = copy_to
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self.copy_to.write(data)
+        return data
+
+
+class RemoteCapture(object):
+    """tcpdump running on node
+
+    :param remote: SSHClient to node
+    :param bpf: capture filter expression
+    :param interface: interface to listen on
+    :param snaplen: max bytes of each packet to capture (headers are
+        enough for checks)
+    :param path: local path to save raw capture (optional)
+    :param ring_size: size of rotated remote file in MB (streaming is used
+        if not set)
+    :param ring_files: count of rotated remote files
+    """
+
+    def __init__(self, remote, bpf='', interface='any', snaplen=256,
+                 path=None, ring_size=None, ring_files=4):
+        self.remote = remote
+        self.bpf = bpf
+        self.interface = interface
+        self.snaplen = snaplen
+        self.path = path
+        self.ring_size = ring_size
+        self.ring_files = ring_files
+        self.capture = pcap.Capture()
+        self.pid = None
+        self.remote_path = None
+        self._chan = None
+        self._reader = None
+        self._error = None
+
+    def __repr__(self):
+        return '<RemoteCapture {0} on {1}:{2} pid {3}>'.format(
+            self.bpf, self.remote.host, self.interface, self.pid)
+
+    def _command(self, output):
+        command = 'tcpdump -n -U -i {0} -s {1} -w {2}'.format(
+            self.interface, self.snaplen, output)
+        if self.ring_size is not None:
+            command += ' -C {0} -W {1}'.format(self.ring_size,
+                                               self.ring_files)
+        if self.bpf:
+            command += " '{0}'".format(self.bpf)
+        return command
+
+    def start(self):
+        if self.ring_size is None:
+            self._start_stream()
+        else:
+            self.remote_path = '/tmp/capture-{0}.pcap'.format(
+                uuid.uuid4().hex[:8])
+            self.pid = self.remote.background_call(
+                self._command(self.remote_path),
+                stdout=self.remote_path + '.log')
+        logger.info('Started {0!r}'.format(self))
+
+    def _start_stream(self):
+        # shell prints own pid to stderr and is replaced by tcpdump
+        command = 'echo $$ >&2; exec {0} 2>/dev/null'.format(
+            self._command('-'))
+        self._chan, stdin, stdout, stderr = self.remote.execute_async(command)
+        self.pid = stderr.readline().strip()
+        if isinstance(self.pid, bytes):
+            self.pid = self.pid.decode('utf-8')
+        if not self.pid.isdigit():
+            self._chan.close()
+            raise Exception("Can't start `{0}` on {1}".format(
+                command, self.remote.host))
+
+        def read():
+            copy_to = open(self.path, 'wb') if self.path else None
+            try:
+                source = stdout
+                if copy_to is not None:
+                    source = TeeFile(stdout, copy_to)
+                self.capture.read(source)
+            except Exception as e:
+                logger.exception('Reading of {0!r} failed'.format(self))
+                self._error = e
+            finally:
+                if copy_to is not None:
+                    copy_to.close()
+
+        self._reader = threading.Thread(target=read)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def stop(self, timeout=60):
+        """Stop tcpdump and collect remaining packets"""
+        if self.pid is None:
+            return
+        self.remote.execute(
+            'kill -INT {pid}; '
+            'for i in $(seq {timeout}); do '
+            'kill -0 {pid} 2>/dev/null || break; sleep 1; done'.format(
+                pid=self.pid, timeout=timeout), verbose=False)
+        if self._reader is not None:
+            self._reader.join(timeout)
+            self._chan.close()
+        else:
+            self._collect_files()
+        logger.info('Stopped {0!r}, {1} packets captured'.format(
+            self, self.capture.total))
+        self.pid = None
+        if self._error is not None:
+            raise self._error
+
+    def _collect_files(self):
+        result = self.remote.check_call(
+            'ls -tr {0}[0-9]*'.format(self.remote_path), verbose=False)
+        paths = [x.strip() for x in result['stdout'] if x.strip()]
+        try:
+            for i, remote_path in enumerate(paths):
+                if self.path is None:
+                    fd, local_path = tempfile.mkstemp(suffix='.pcap')
+                    os.close(fd)
+                else:
+                    local_path = '{0}.{1}'.format(self.path, i)
+                self.remote.download(remote_path, local_path)
+                with open(local_path, 'rb') as f:
+                    self.capture.read(f)
+                if self.path is None:
+                    os.remove(local_path)
+        finally:
+            self.remote.execute('rm -f {0}*'.format(self.remote_path),
+                                verbose=False)
+
+
+@contextmanager
+def capture(env, ip, **kwargs):
+    """Capture traffic on node while in context
+
+    :param ip: node ip
+    :param kwargs: RemoteCapture params
+    :returns: RemoteCapture (packets are available as `capture` attribute)
+    """
+    with env.get_ssh_to_node(ip) as remote:
+        cap = RemoteCapture(remote, **kwargs)
+        cap.start()
+        try:
+            yield cap
+        finally:
+            cap.stop()
+
+
+@contextmanager
+def capture_many(env, ips, **kwargs):
+    """Capture traffic on several nodes concurrently
+
+    :returns: dict {ip: RemoteCapture}
+    """
+    with ExitStack() as stack:
+        remotes = [stack.enter_context(env.get_ssh_to_node(ip))
+                   for ip in ips]
+        captures = [RemoteCapture(x, **kwargs) for x in remotes]
+        pool = ThreadPool(len(captures) or 1)
+        try:
+            pool.map(lambda x: x.start(), captures)
+            try:
+                yield dict(zip(ips, captures))
+            finally:
+                pool.map(lambda x: x.stop(), captures)
+        finally:
+            pool.close()
+            pool.join()
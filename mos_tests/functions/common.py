@@ -12,10 +12,10 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import inspect
 import logging
 import os
 import socket
+import sys
 from tempfile import NamedTemporaryFile
 from time import sleep
 from time import time
@@ -23,9 +23,10 @@ import urllib2
 
 import uuid
 from waiting import TimeoutExpired
-from waiting import wait as base_wait
 import yaml
 
+from mos_tests.functions import waiter
+
 
 logger = logging.getLogger(__name__)
 
@@ -608,27 +609,18 @@ def delete_keys(nova_client, key_name):
 
 
 def wait(predicate, log=True, **kwargs):
-    __tracebackhide__ = True
-
-    frame = inspect.stack()[1]
-    called_from = '{0.f_globals[__name__]}:{2}'.format(*frame)
-    event = kwargs.get('waiting_for', repr(predicate))
-    msg = '{called_from}: waiting for {event}'.format(event=event,
-                                                      called_from=called_from)
-    logger = logging.getLogger('waiting')
-
-    if log:
-        logger.info(msg)
+    """Wait until predicate returns true value
 
-    start = time()
+    See `mos_tests.functions.waiter.wait` for arguments description.
+    """
+    __tracebackhide__ = True
 
+    frame = sys._getframe(1)
+    called_from = '{0}:{1}'.format(frame.f_globals['__name__'],
+                                   frame.f_lineno)
     try:
-        result = base_wait(predicate, **kwargs)
-        if log:
-            logger.info('{msg} ... done. '
-                        'Took {time:.0f}s'.format(msg=msg,
-                                                  time=time() - start))
-        return result
+        return waiter.wait(predicate, log=log, called_from=called_from,
+                           **kwargs)
     except TimeoutExpired as e:
         # prevent shows traceback from waiting package
         raise e
@@ -681,16 +673,15 @@ def disable_ovs_agents_on_controller(env):
     with controller.ssh() as remote:
         remote.check_call(
             'pcs resource disable {}'.format(ovs_agent_name))
+    env.controller_roles.invalidate()
 
 
 def restart_ovs_agents_on_computes(env):
     """Restart openvswitch-agents on all computes."""
     computes = env.get_nodes_by_role('compute')
-
-    for node in computes:
-        with node.ssh() as remote:
-            remote.check_call(
-                'service {} restart'.format(ovs_agent_service))
+    env.run_on_nodes(computes,
+                     'service {} restart'.format(ovs_agent_service),
+                     fail_fast=True)
 
 
 def enable_ovs_agents_on_controllers(env):
@@ -700,6 +691,7 @@ def enable_ovs_agents_on_controllers(env):
     with controller.ssh() as remote:
         remote.check_call(
             'pcs resource enable {}'.format(ovs_agent_name))
+    env.controller_roles.invalidate()
 
 
 def ban_ovs_agents_controllers(env):
@@ -711,6 +703,7 @@ def ban_ovs_agents_controllers(env):
             remote.check_call(
                 'pcs resource ban {resource_name} {fqdn}'.format(
                     resource_name=ovs_agent_name, **node.data))
+    env.controller_roles.invalidate()
 
 
 def clear_ovs_agents_controllers(env):
@@ -722,3 +715,4 @@ def clear_ovs_agents_controllers(env):
             remote.check_call(
                 'pcs resource clear {resource_name} {fqdn}'.format(
                     resource_name=ovs_agent_name, **node.data))
+    env.controller_roles.invalidate()
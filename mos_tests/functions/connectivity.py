@@ -0,0 +1,260 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import namedtuple
+from collections import OrderedDict
+import logging
+from multiprocessing.pool import ThreadPool
+import re
+
+from waiting import TimeoutExpired
+
+from mos_tests.functions.common import wait
+from mos_tests import settings
+
+logger = logging.getLogger(__name__)
+
+
+class PingResult(namedtuple('PingResult', ['sent', 'received', 'avg_rtt'])):
+    """Result of pings from one VM to one ip (avg_rtt is in ms or None)"""
+
+    # Reason why pings were not done (see `ProbeError`)
+    error = None
+
+    @property
+    def loss(self):
+        if not self.sent:
+            return 100
+        return 100 * (self.sent - self.received) // self.sent
+
+    @property
+    def is_reachable(self):
+        return self.received > 0
+
+
+NO_RESULT = PingResult(0, 0, None)
+
+
+class ProbeError(PingResult):
+    """Result of pings, which were not done because of error
+
+    It never matches expectation, so failed probe can't pass as
+    unreachable destination.
+    """
+
+    def __new__(cls, error):
+        self = super(ProbeError, cls).__new__(cls, 0, 0, None)
+        self.error = error
+        return self
+
+    def __repr__(self):
+        return 'ProbeError({0!r})'.format(self.error)
+
+
+def parse_ping(output):
+    """Return PingResult from ping (iputils or busybox) output"""
+    counts = re.search(r'(\d+) packets transmitted, (\d+) (?:packets )?'
+                       r'received', output)
+    if counts is None:
+        return NO_RESULT
+    rtt = re.search(r'= [\d.]+/([\d.]+)/', output)
+    return PingResult(int(counts.group(1)), int(counts.group(2)),
+                      float(rtt.group(1)) if rtt else None)
+
+
+def make_probe_command(ips, count=3, deadline=5):
+    """Return shell command, which pings all ips simultaneously
+
+    Output of each ping follows `== <ip>` line.
+    """
+    ips = ' '.join(ips)
+    return ('for ip in {ips}; do '
+            'ping -c {count} -w {deadline} $ip > /tmp/probe_$ip 2>&1 & '
+            'done; wait; '
+            'for ip in {ips}; do echo "== $ip"; cat /tmp/probe_$ip; '
+            'rm -f /tmp/probe_$ip; done').format(ips=ips, count=count,
+                                                 deadline=deadline)
+
+
+def parse_probe_output(output):
+    """Return dict {ip: PingResult} from probe command output"""
+    results = {}
+    for block in re.split(r'^== ', output, flags=re.MULTILINE)[1:]:
+        ip, _, text = block.partition('\n')
+        results[ip.strip()] = parse_ping(text)
+    return results
+
+
+class ConnectivityMatrix(object):
+    """Results of pings between VMs (and external ips)
+
+    Sources are VMs names, destinations are ips. `owners` maps ips to VMs
+    names, so expectations can be defined in terms of VMs.
+    """
+
+    def __init__(self, owners=None):
+        self.owners = owners or {}
+        self.results = OrderedDict()
+
+    def set(self, src, ip, result):
+        self.results[(src, ip)] = result
+
+    def get(self, src, ip):
+        return self.results.get((src, ip), NO_RESULT)
+
+    def dst_name(self, ip):
+        return self.owners.get(ip, ip)
+
+    def mismatches(self, expected=None):
+        """Return list of (src, ip, expected, PingResult) mismatches
+
+        :param expected: dict {(src, dst): bool}, where dst is VM name or
+            ip; missing pairs are expected to be reachable
+        """
+        expected = expected or {}
+        result = []
+        for (src, ip), ping in self.results.items():
+            should = expected.get((src, ip),
+                                  expected.get((src, self.dst_name(ip)),
+                                               True))
+            if ping.error is not None or ping.is_reachable != should:
+                result.append((src, ip, should, ping))
+        return result
+
+    def assert_matches(self, expected=None):
+        mismatches = self.mismatches(expected)
+        assert not mismatches, self.format_mismatches(mismatches)
+
+    def format_mismatches(self, mismatches):
+        lines = ['Connectivity mismatches:']
+        for src, ip, should, ping in mismatches:
+            if ping.error is not None:
+                status = 'probe error: {0}'.format(ping.error)
+            else:
+                status = 'loss {0}%'.format(ping.loss)
+            lines.append('  {0} -> {1} ({2}): expected {3}, {4}'.format(
+                src, self.dst_name(ip), ip,
+                'reachable' if should else 'unreachable', status))
+        return '\n'.join(lines)
+
+    def __str__(self):
+        lines = []
+        for (src, ip), ping in self.results.items():
+            if ping.error is not None:
+                lines.append('{0} -> {1} ({2}): probe error: {3}'.format(
+                    src, self.dst_name(ip), ip, ping.error))
+                continue
+            rtt = '-' if ping.avg_rtt is None else '{0:.1f}ms'.format(
+                ping.avg_rtt)
+            lines.append('{0} -> {1} ({2}): loss {3}%, rtt {4}'.format(
+                src, self.dst_name(ip), ip, ping.loss, rtt))
+        return '\n'.join(lines)
+
+
+class ConnectivityProber(object):
+    """Checks connectivity between all VMs in parallel
+
+    Each VM is logged in once and pings all other VMs ips (and external
+    ips) simultaneously, all VMs are probed in parallel.
+
+    :param servers: list of nova servers
+    :param external_ips: ips out of cloud to ping from each VM
+    :param count: count of pings to each ip
+    """
+
+    def __init__(self, env, os_conn, servers, vm_keypair=None,
+                 vm_login='cirros', vm_password='cubswin:)',
+                 external_ips=(settings.PUBLIC_TEST_IP,), count=3,
+                 concurrency=10):
+        self.env = env
+        self.os_conn = os_conn
+        self.servers = list(servers)
+        self.vm_keypair = vm_keypair
+        self.vm_login = vm_login
+        self.vm_password = vm_password
+        self.external_ips = list(external_ips)
+        self.count = count
+        self.concurrency = concurrency
+        self.ips = OrderedDict(
+            (server.name, list(os_conn.get_nova_instance_ips(server).values()))
+            for server in self.servers)
+        owners = {ip: name for name, ips in self.ips.items() for ip in ips}
+        self.matrix = ConnectivityMatrix(owners)
+
+    def targets(self, server):
+        targets = [ip for name, ips in self.ips.items()
+                   if name != server.name for ip in ips]
+        return targets + self.external_ips
+
+    def probe_server(self, server):
+        """Return dict {ip: PingResult} for pings from server
+
+        If server can't be probed, all targets get `ProbeError` result.
+        """
+        targets = self.targets(server)
+        try:
+            with self.os_conn.ssh_to_instance(
+                    self.env, server, self.vm_keypair,
+                    username=self.vm_login,
+                    password=self.vm_password) as remote:
+                result = remote.execute(make_probe_command(targets,
+                                                           count=self.count))
+            results = parse_probe_output(result.stdout_string)
+        except Exception as e:
+            logger.debug("Can't probe from {0}: {1}".format(server.name, e))
+            error = ProbeError('{0}: {1}'.format(type(e).__name__, e))
+            return {ip: error for ip in targets}
+        return {ip: results.get(ip, ProbeError('no ping output'))
+                for ip in targets}
+
+    def probe(self, servers=None):
+        """Probe from servers (all by default) and return matrix"""
+        servers = self.servers if servers is None else servers
+        pool = ThreadPool(min(self.concurrency, len(servers)) or 1)
+        try:
+            results = pool.map(self.probe_server, servers)
+        finally:
+            pool.close()
+            pool.join()
+        for server, server_results in zip(servers, results):
+            for ip, ping in server_results.items():
+                self.matrix.set(server.name, ip, ping)
+        return self.matrix
+
+    def wait_for(self, expected=None, timeout=4 * 60):
+        """Probe until matrix matches expected one
+
+        Only VMs with mismatched results are probed again.
+
+        :param expected: see `ConnectivityMatrix.mismatches`
+        :raises: AssertionError with mismatched pairs on timeout
+        """
+        servers = {x.name: x for x in self.servers}
+        state = {'todo': self.servers}
+
+        def predicate():
+            self.probe(state['todo'])
+            failed = set(x[0] for x in self.matrix.mismatches(expected))
+            state['todo'] = [servers[x] for x in failed]
+            return not failed
+
+        try:
+            wait(predicate, timeout_seconds=timeout, sleep_seconds=10,
+                 waiting_for='connectivity matrix to match expected')
+        except TimeoutExpired:
+            logger.info('Connectivity matrix:\n{0}'.format(self.matrix))
+            raise AssertionError(self.matrix.format_mismatches(
+                self.matrix.mismatches(expected)))
+        logger.debug('Connectivity matrix:\n{0}'.format(self.matrix))
+        return self.matrix
@@ -13,9 +13,16 @@
 #    under the License.
 
 from contextlib import contextmanager
-import email.utils
+import errno
+import fcntl
+import hashlib
+import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
+import tempfile
+import threading
+import time
 
 import requests
 
@@ -23,44 +30,339 @@ from mos_tests import settings
 
 logger = logging.getLogger(__name__)
 
+CHUNK_SIZE = 1024 * 1024
+# size of one part for parallel download
+RANGE_SIZE = 64 * 1024 * 1024
 
-@contextmanager
-def get_file(url, name=None):
-    with open(get_file_path(url, name), 'rb') as f:
-        yield f
 
+@contextmanager
+def file_lock(path, shared=False, blocking=True):
+    """Lock, shared between processes (xdist workers)
 
-def get_file_path(url, name=None):
-    if not os.path.exists(settings.TEST_IMAGE_PATH):
+    :param shared: take shared lock instead of exclusive one
+    :param blocking: wait for lock, otherwise False is yielded if lock is
+        held by other one
+    """
+    flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+    with open(path, 'a') as f:
         try:
-            os.makedirs(settings.TEST_IMAGE_PATH)
-        except Exception as e:
-            logger.warning("Can't make dir for files: {}".format(e))
-            return None
-
-    file_path = os.path.join(settings.TEST_IMAGE_PATH,
-                             get_file_name(url))
-    headers = {}
-    if os.path.exists(file_path):
-        file_date = os.path.getmtime(file_path)
-        headers['If-Modified-Since'] = email.utils.formatdate(file_date)
-
-    response = requests.get(url, stream=True, headers=headers)
-
-    if response.status_code == 304:
-        logger.info("Image file is up to date")
-    elif response.status_code == 200:
-        logger.info("Start downloading image")
-        with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(65536):
+            fcntl.flock(f, flags)
+        except (IOError, OSError) as e:
+            if blocking or e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def write_json(path, data):
+    """Atomically replace file with json data"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.tmp_')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def read_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_remote_info(response):
+    """Return validators and size of remote file from HEAD response"""
+    size = response.headers.get('Content-Length')
+    return {
+        'url': response.url,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'size': int(size) if size is not None else None,
+        'ranges': response.headers.get('Accept-Ranges') == 'bytes',
+    }
+
+
+class FileCache(object):
+    """Content addressed cache of downloaded files
+
+    Files are stored as `objects/<sha256>`. `manifest.json` maps urls to
+    files checksums with ETag, Last-Modified and size of downloaded
+    version, so file is downloaded again only if it is changed on server.
+    Downloads go to temporary file, which is renamed on success; big files
+    are downloaded with several parallel range requests. Interrupted
+    download is resumed on next call. Downloads and manifest updates are
+    guarded by file locks, so several processes can use one cache.
+    Least recently used files are removed when cache exceeds `max_size`,
+    files opened with `open` (or being recorded) are never removed.
+
+    :param path: cache directory
+    :param max_size: max cache size in bytes (None - unlimited)
+    :param threads: count of parallel connections for one download
+    """
+
+    def __init__(self, path, max_size=None, threads=4):
+        self.path = path
+        self.max_size = max_size
+        self.threads = threads
+        self.objects_dir = os.path.join(path, 'objects')
+        self.tmp_dir = os.path.join(path, 'tmp')
+        self.locks_dir = os.path.join(path, 'locks')
+        self.manifest_path = os.path.join(path, 'manifest.json')
+
+    def _makedirs(self):
+        for path in (self.objects_dir, self.tmp_dir, self.locks_dir):
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # made by other process
+                    if not os.path.isdir(path):
+                        raise
+
+    def _lock(self, name, **kwargs):
+        return file_lock(os.path.join(self.locks_dir, name + '.lock'),
+                         **kwargs)
+
+    def _object_lock(self, sha256, **kwargs):
+        return self._lock('object_' + sha256, **kwargs)
+
+    def object_path(self, sha256):
+        return os.path.join(self.objects_dir, sha256)
+
+    def load_manifest(self):
+        manifest = read_json(self.manifest_path, {})
+        manifest.setdefault('urls', {})
+        manifest.setdefault('objects', {})
+        return manifest
+
+    @contextmanager
+    def _manifest(self):
+        with self._lock('manifest'):
+            manifest = self.load_manifest()
+            yield manifest
+            write_json(self.manifest_path, manifest)
+
+    def _record(self, url, sha256, remote=None):
+        with self._object_lock(sha256, shared=True):
+            with self._manifest() as manifest:
+                if remote is not None:
+                    manifest['urls'][url] = dict(remote, sha256=sha256)
+                manifest['objects'][sha256] = {
+                    'size': os.path.getsize(self.object_path(sha256)),
+                    'last_used': time.time(),
+                }
+        return self.object_path(sha256)
+
+    @staticmethod
+    def _is_fresh(entry, remote):
+        for name in ('etag', 'last_modified'):
+            if entry.get(name) and remote.get(name):
+                return entry[name] == remote[name]
+        return remote['size'] is not None and entry['size'] == remote['size']
+
+    def get(self, url, sha256=None):
+        """Return path to cached file, download it if needed
+
+        :param sha256: expected checksum of file (optional)
+        :raises: ValueError if downloaded file checksum doesn't match
+        """
+        self._makedirs()
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        with self._lock(key):
+            entry = self.load_manifest()['urls'].get(url)
+            cached = (entry is not None and
+                      os.path.exists(self.object_path(entry['sha256'])) and
+                      sha256 in (None, entry['sha256']))
+            if (entry is None and sha256 is not None and
+                    os.path.exists(self.object_path(sha256))):
+                # same content was downloaded from other url
+                return self._record(url, sha256)
+            try:
+                response = requests.head(url, allow_redirects=True,
+                                         timeout=60)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                if not cached:
+                    raise
+                logger.warning("Can't check {0} freshness: {1}".format(url,
+                                                                       e))
+                return self._record(url, entry['sha256'])
+            remote = get_remote_info(response)
+            if cached and self._is_fresh(entry, remote):
+                logger.info('{0} is up to date'.format(url))
+                return self._record(url, entry['sha256'])
+
+            logger.info('Start downloading {0}'.format(url))
+            start = time.time()
+            tmp_path = self._download(key, remote)
+            digest = sha256sum(tmp_path)
+            if sha256 is not None and digest != sha256:
+                os.remove(tmp_path)
+                raise ValueError('Checksum of {0} is {1} instead of '
+                                 '{2}'.format(url, digest, sha256))
+            os.rename(tmp_path, self.object_path(digest))
+            logger.info('{0} downloaded in {1:.0f}s'.format(
+                url, time.time() - start))
+            path = self._record(url, digest, remote)
+        self.evict(keep=(digest,))
+        return path
+
+    @contextmanager
+    def open(self, url, sha256=None):
+        """Return opened cached file, it isn't evicted while it is open"""
+        path = self.get(url, sha256=sha256)
+        with self._object_lock(os.path.basename(path), shared=True):
+            if not os.path.exists(path):
+                # evicted by other process right after download
+                path = self.get(url, sha256=sha256)
+            with open(path, 'rb') as f:
+                yield f
+
+    def _download(self, key, remote):
+        """Download file to temporary file and return its path"""
+        part_path = os.path.join(self.tmp_dir, key + '.part')
+        state_path = os.path.join(self.tmp_dir, key + '.json')
+        state = read_json(state_path, {})
+        if (not os.path.exists(part_path) or not remote['ranges'] or
+                not remote['etag'] or state.get('etag') != remote['etag'] or
+                state.get('size') != remote['size']):
+            # can't resume
+            state = {'etag': remote['etag'], 'size': remote['size'],
+                     'done': []}
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        write_json(state_path, state)
+
+        size = remote['size']
+        if (remote['ranges'] and size is not None and size > RANGE_SIZE and
+                self.threads > 1):
+            self._download_ranges(remote, part_path, state, state_path)
+        else:
+            self._download_stream(remote, part_path)
+        if size is not None and os.path.getsize(part_path) != size:
+            raise IOError('Size of {0} is {1} instead of {2}'.format(
+                remote['url'], os.path.getsize(part_path), size))
+        os.remove(state_path)
+        return part_path
+
+    def _download_stream(self, remote, part_path):
+        headers = {}
+        offset = 0
+        if os.path.exists(part_path) and remote['ranges']:
+            offset = os.path.getsize(part_path)
+            headers['Range'] = 'bytes={0}-'.format(offset)
+            headers['If-Range'] = remote['etag']
+        response = requests.get(remote['url'], headers=headers, stream=True,
+                                timeout=60)
+        response.raise_for_status()
+        mode = 'ab' if response.status_code == 206 else 'wb'
+        if offset and mode == 'ab':
+            logger.info('Resume download from {0} byte'.format(offset))
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
                 f.write(chunk)
-        logger.info("Image downloaded")
-    else:
-        logger.warning("Can't get fresh image. HTTP status code is "
-                       "{0.status_code}".format(response))
+        response.close()
+
+    def _download_ranges(self, remote, part_path, state, state_path):
+        size = remote['size']
+        done = set(state['done'])
+        todo = [x for x in range(0, size, RANGE_SIZE) if x not in done]
+        if done:
+            logger.info('Resume download, {0} of {1} parts left'.format(
+                len(todo), len(todo) + len(done)))
+        with open(part_path, 'ab') as f:
+            f.truncate(size)
+        lock = threading.Lock()
+
+        def fetch(start):
+            end = min(start + RANGE_SIZE, size) - 1
+            headers = {'Range': 'bytes={0}-{1}'.format(start, end),
+                       'If-Range': remote['etag']}
+            response = requests.get(remote['url'], headers=headers,
+                                    stream=True, timeout=60)
+            if response.status_code != 206:
+                raise IOError('Range request to {0} returned {1}'.format(
+                    remote['url'], response.status_code))
+            written = 0
+            with open(part_path, 'r+b') as f:
+                f.seek(start)
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+                    written += len(chunk)
+            response.close()
+            if written != end - start + 1:
+                raise IOError('Got {0} bytes instead of {1}'.format(
+                    written, end - start + 1))
+            with lock:
+                state['done'].append(start)
+                write_json(state_path, state)
+
+        pool = ThreadPool(self.threads)
+        try:
+            pool.map(fetch, todo)
+        finally:
+            pool.close()
+            pool.join()
+
+    def evict(self, keep=()):
+        """Remove least recently used files to fit `max_size`
+
+        Files, which are in use, are skipped.
+        """
+        if self.max_size is None:
+            return
+        with self._manifest() as manifest:
+            objects = manifest['objects']
+            total = sum(x['size'] for x in objects.values())
+            for sha256 in sorted(objects,
+                                 key=lambda x: objects[x]['last_used']):
+                if total <= self.max_size:
+                    break
+                if sha256 in keep:
+                    continue
+                with self._object_lock(sha256, blocking=False) as locked:
+                    if not locked:
+                        logger.debug('{0} is in use, skip it'.format(sha256))
+                        continue
+                    logger.info('Remove {0} from cache'.format(sha256))
+                    try:
+                        os.remove(self.object_path(sha256))
+                    except OSError:
+                        pass
+                total -= objects.pop(sha256)['size']
+                for url, entry in list(manifest['urls'].items()):
+                    if entry['sha256'] == sha256:
+                        del manifest['urls'][url]
+
+
+cache = FileCache(settings.TEST_IMAGE_PATH,
+                  max_size=int(settings.TEST_IMAGE_CACHE_SIZE * 1024 ** 3),
+                  threads=settings.TEST_IMAGE_DOWNLOAD_THREADS)
+
+
+@contextmanager
+def get_file(url, name=None, sha256=None):
+    with cache.open(url, sha256=sha256) as f:
+        yield f
+
 
-    response.close()
-    return file_path
+def get_file_path(url, name=None, sha256=None):
+    return cache.get(url, sha256=sha256)
 
 
 def get_file_name(url):
@@ -0,0 +1,157 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import logging
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+RESERVED = {'or', 'and', 'not'}
+
+
+def dynamic_guard(func):
+    """Mark guard, which result depends on env resources state"""
+    func.dynamic = True
+    return func
+
+
+class CachedSettingsEnv(object):
+    """Environment proxy, which fetches cluster settings only once"""
+
+    def __init__(self, env):
+        self._env = env
+        self._settings = None
+
+    def __getattr__(self, name):
+        return getattr(self._env, name)
+
+    def get_settings_data(self):
+        if self._settings is None:
+            self._settings = self._env.get_settings_data()
+        return self._settings
+
+
+class GuardsValues(dict):
+    """Lazy mapping of guards names to results for expression evaluation"""
+
+    def __init__(self, engine, env):
+        super(GuardsValues, self).__init__()
+        self.engine = engine
+        self.env = env
+
+    def __missing__(self, name):
+        value = self.engine.get_value(self.env, name)
+        self[name] = value
+        return value
+
+
+class GuardsEngine(object):
+    """Evaluates `check_env_` marker expressions
+
+    Each expression is compiled once. Guard functions are called lazily
+    (only if needed for expression result) and only once per env until
+    `invalidate` call (it should be called when env may be changed, after
+    snapshot revert, for example). Cluster settings are fetched once for all
+    guards.
+
+    Guards, which depend on env resources state (not on deployment
+    settings), should be marked with `dynamic_guard` decorator.
+
+    :param namespace: dict with guards functions (functions names should
+        start with `is_` or `has_`)
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self._compiled = {}
+        self._values = {}
+        self._envs = {}
+        self._lock = threading.RLock()
+
+    def compile(self, guards):
+        """Compile marker args to code
+
+        :param guards: list of expressions like 'is_ha and not is_dvr'
+        :returns: tuple (expression, code, guards names)
+        :raises: ValueError if expression is invalid
+        """
+        guards = tuple(guards)
+        if guards not in self._compiled:
+            if len(guards) == 1:
+                expression = guards[0]
+            else:
+                expression = ' and '.join('({0})'.format(x) for x in guards)
+            names = []
+            for name in re.findall(r'[A-Za-z_]\w*', expression):
+                if name in RESERVED or name in names:
+                    continue
+                if not (name.startswith('is_') or name.startswith('has_')):
+                    logger.critical('Guard must start with "is_" or "has_", '
+                                    'got {} instead'.format(name))
+                    raise ValueError('Parse error')
+                if not callable(self.namespace.get(name)):
+                    logger.critical('Guard with name {} not found'.format(
+                        name))
+                    raise ValueError('Parse error')
+                names.append(name)
+            try:
+                code = compile(expression, '<check_env_>', 'eval')
+            except SyntaxError:
+                logger.critical('Invalid guards expression {}'.format(
+                    expression))
+                raise ValueError('Parse error')
+            self._compiled[guards] = (expression, code, names)
+        return self._compiled[guards]
+
+    def is_static(self, guards):
+        """Check that guards don't use dynamic ones
+
+        Static guards results depend only on env deployment settings, so
+        they can be evaluated before tests run.
+        """
+        _, _, names = self.compile(guards)
+        return not any(getattr(self.namespace[x], 'dynamic', False)
+                       for x in names)
+
+    def get_value(self, env, name):
+        """Return cached guard function result"""
+        key = (env.id, name)
+        with self._lock:
+            if key not in self._values:
+                if env.id not in self._envs:
+                    self._envs[env.id] = CachedSettingsEnv(env)
+                self._values[key] = self.namespace[name](self._envs[env.id])
+            return self._values[key]
+
+    def evaluate(self, env, guards):
+        """Evaluate guards on env
+
+        :returns: tuple (result, expression, evaluated expression)
+        """
+        expression, code, names = self.compile(guards)
+        values = GuardsValues(self, env)
+        result = eval(code, {'__builtins__': {}}, values)
+        evaluated = expression
+        for name in names:
+            if name in values:
+                evaluated = re.sub(r'\b{0}\b'.format(name),
+                                   str(values[name]), evaluated)
+        return bool(result), expression, evaluated
+
+    def invalidate(self):
+        """Forget all guards results and cluster settings"""
+        with self._lock:
+            self._values.clear()
+            self._envs.clear()
@@ -0,0 +1,303 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import namedtuple
+import csv
+import logging
+from multiprocessing.pool import ThreadPool
+import uuid
+
+from mos_tests.functions.common import wait
+
+logger = logging.getLogger(__name__)
+
+__doc__ = """iperf (v2) traffic between VMs
+
+Iperf servers should be already started on VMs. Clients are started in
+background on VMs, so flows survive ssh connectivity loss (during agents
+restart, for example):
+
+    harness = IperfHarness(env, os_conn, keypair)
+    harness.add_flow(vm1, vm2, port=5002, time=60)
+    harness.add_flow(vm3, vm4, port=5003, udp=True, bandwidth='1M')
+    for result in harness.run():
+        result.assert_bandwidth(max_bw=3000 * 1024)
+"""
+
+
+class IperfError(Exception):
+    """iperf client failed (it isn't a traffic check failure)"""
+
+
+class IperfRecord(namedtuple('IperfRecord', ['start', 'end', 'bytes',
+                                             'bandwidth', 'jitter', 'lost',
+                                             'total', 'loss'])):
+    """One iperf CSV report line
+
+    `bandwidth` is in bits per second, `jitter` is in ms, `loss` is in
+    percents; `jitter`, `lost`, `total` and `loss` are only set for UDP
+    server report.
+    """
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    @property
+    def is_server_report(self):
+        return self.jitter is not None
+
+
+def parse_csv(lines):
+    """Return list of IperfRecord from `iperf -y C` output lines
+
+    Lines, which are not CSV reports (warnings, errors), are skipped.
+    """
+    records = []
+    for row in csv.reader(lines):
+        if len(row) < 9 or '-' not in row[6]:
+            continue
+        start, end = row[6].split('-', 1)
+        extra = [None] * 4
+        if len(row) >= 13:
+            extra = [float(row[9]), int(row[10]), int(row[11]),
+                     float(row[12])]
+        records.append(IperfRecord(float(start), float(end), int(row[7]),
+                                   int(row[8]), *extra))
+    return records
+
+
+def percentile(values, percent):
+    """Return percentile of values (with linear interpolation)"""
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * percent / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position -
+                                                              lower)
+
+
+class Flow(object):
+    """iperf client to server flow
+
+    :param bandwidth: target bandwidth for UDP (iperf format, e.g. '10M')
+    :param length: datagram/buffer length (iperf format)
+    """
+
+    def __init__(self, client, server, server_ip, port, udp=False,
+                 bandwidth=None, time=60, interval=10, length=None):
+        self.client = client
+        self.server = server
+        self.server_ip = server_ip
+        self.port = port
+        self.udp = udp
+        self.bandwidth = bandwidth
+        self.time = time
+        self.interval = min(interval, time)
+        self.length = length
+        self.pid = None
+        self.output = '/tmp/iperf_{0}.csv'.format(uuid.uuid4().hex[:8])
+
+    def __repr__(self):
+        return '<Flow {0} -> {1}:{2} {3}>'.format(
+            self.client.name, self.server_ip, self.port,
+            'udp' if self.udp else 'tcp')
+
+    @property
+    def command(self):
+        command = 'iperf -c {ip} -p {port} -y C -t {time} -i {interval}'
+        if self.udp:
+            command += ' -u -x CDMS'
+        if self.bandwidth is not None:
+            command += ' --bandwidth {bandwidth}'
+        if self.length is not None:
+            command += ' --len {length}'
+        return command.format(ip=self.server_ip, port=self.port,
+                              time=self.time, interval=self.interval,
+                              bandwidth=self.bandwidth, length=self.length)
+
+
+class FlowResult(object):
+    """Records of one flow and their statistics
+
+    :param warmup: seconds from flow start, which are excluded from
+        steady state statistics (the first interval by default)
+    """
+
+    def __init__(self, flow, records, warmup=None):
+        self.flow = flow
+        self.records = records
+        self.warmup = flow.interval if warmup is None else warmup
+        self.server_reports = [x for x in records if x.is_server_report]
+        self.intervals = [x for x in records if not x.is_server_report]
+        self.summary = None
+        # the last client report covers whole flow
+        if len(self.intervals) > 1 and self.intervals[-1].start == 0:
+            self.summary = self.intervals.pop()
+
+    def __repr__(self):
+        return '<FlowResult {0!r}: {1} intervals, loss {2}>'.format(
+            self.flow, len(self.intervals), self.loss)
+
+    def steady(self):
+        """Return intervals out of warm-up period
+
+        All intervals are returned if flow is shorter than warm-up.
+        """
+        steady = [x for x in self.intervals if x.start >= self.warmup]
+        return steady or self.intervals
+
+    def samples(self):
+        """Return records for bandwidth statistics
+
+        For UDP it is server report (received traffic), for TCP - steady
+        state intervals.
+        """
+        if self.flow.udp and self.server_reports:
+            return self.server_reports
+        return self.steady()
+
+    def bandwidths(self):
+        return [x.bandwidth for x in self.samples()]
+
+    def percentile(self, percent):
+        return percentile(self.bandwidths(), percent)
+
+    @property
+    def loss(self):
+        """UDP datagrams loss in percents (None for TCP)"""
+        if not self.server_reports:
+            return None
+        return self.server_reports[-1].loss
+
+    @property
+    def jitter(self):
+        if not self.server_reports:
+            return None
+        return self.server_reports[-1].jitter
+
+    def fraction_within(self, min_bw=None, max_bw=None):
+        """Return fraction of samples with bandwidth in [min_bw, max_bw]"""
+        bandwidths = self.bandwidths()
+        if not bandwidths:
+            return 0
+        good = [x for x in bandwidths
+                if (min_bw is None or x >= min_bw) and
+                (max_bw is None or x <= max_bw)]
+        return float(len(good)) / len(bandwidths)
+
+    def assert_bandwidth(self, min_bw=None, max_bw=None, ratio=0.95):
+        """Check bandwidth is in [min_bw, max_bw] for `ratio` of samples"""
+        __tracebackhide__ = True
+        fraction = self.fraction_within(min_bw, max_bw)
+        assert fraction >= ratio, (
+            'Bandwidth of {flow!r} is out of [{min_bw}, {max_bw}] for '
+            '{out:.0%} of samples: {bandwidths}'.format(
+                flow=self.flow, min_bw=min_bw, max_bw=max_bw,
+                out=1 - fraction, bandwidths=self.bandwidths()))
+
+    def assert_loss(self, max_loss):
+        __tracebackhide__ = True
+        assert self.loss is not None, 'No server report for {0!r}'.format(
+            self.flow)
+        assert self.loss < max_loss, (
+            '{0}% datagrams of {1!r} lost. Should be < {2}%'.format(
+                self.loss, self.flow, max_loss))
+
+
+class IperfHarness(object):
+    """Runs several iperf flows concurrently
+
+    :param keypair: keypair to login to VMs
+    :param username: VMs username
+    :param concurrency: max count of simultaneous ssh sessions to VMs
+    """
+
+    def __init__(self, env, os_conn, keypair, username='ubuntu',
+                 concurrency=10):
+        self.env = env
+        self.os_conn = os_conn
+        self.keypair = keypair
+        self.username = username
+        self.concurrency = concurrency
+        self.flows = []
+
+    def add_flow(self, client, server, port, ip_type='fixed', **kwargs):
+        """Add flow from client VM to server VM
+
+        :param ip_type: server ip to use ('fixed' or 'floating')
+        :param kwargs: `Flow` params
+        """
+        server_ip = self.os_conn.get_nova_instance_ips(server)[ip_type]
+        flow = Flow(client, server, server_ip, port, **kwargs)
+        self.flows.append(flow)
+        return flow
+
+    def _ssh(self, vm):
+        return self.os_conn.ssh_to_instance(self.env, vm=vm,
+                                            vm_keypair=self.keypair,
+                                            username=self.username)
+
+    def _map(self, func, flows):
+        pool = ThreadPool(min(self.concurrency, len(flows)) or 1)
+        try:
+            return pool.map(func, flows)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _start(self, flow):
+        with self._ssh(flow.client) as remote:
+            flow.pid = remote.background_call(flow.command,
+                                              stdout=flow.output)
+        logger.info('Started {0!r}'.format(flow))
+
+    def _wait(self, flow, timeout):
+        with self._ssh(flow.client) as remote:
+            wait(lambda: not remote.execute(
+                'ps -o pid | grep -w {0}'.format(flow.pid),
+                verbose=False).is_ok,
+                timeout_seconds=timeout,
+                sleep_seconds=5,
+                waiting_for='{0!r} to be done'.format(flow))
+            output = remote.check_call('cat {0}; rm -f {0}'.format(
+                flow.output), verbose=False).stdout_string
+        logger.debug('{0!r} output:\n{1}'.format(flow, output))
+        records = parse_csv(output.splitlines())
+        if not records:
+            raise IperfError('{0!r} failed:\n{1}'.format(flow, output))
+        return FlowResult(flow, records)
+
+    def start(self, flows=None):
+        """Start clients of flows (all added by default) simultaneously"""
+        flows = self.flows if flows is None else flows
+        self._map(self._start, flows)
+        return flows
+
+    def wait(self, flows=None, timeout=None):
+        """Wait flows to be done and return list of FlowResult
+
+        :param timeout: default is the longest flow time + 2 minutes
+        """
+        flows = self.flows if flows is None else flows
+        if timeout is None:
+            timeout = max([x.time for x in flows] or [0]) + 2 * 60
+        return self._map(lambda x: self._wait(x, timeout), flows)
+
+    def run(self, flows=None, timeout=None):
+        """Run flows simultaneously and return list of FlowResult"""
+        flows = self.start(flows)
+        return self.wait(flows, timeout=timeout)
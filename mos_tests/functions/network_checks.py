@@ -18,6 +18,7 @@ from contextlib2 import suppress
 import six
 
 from mos_tests.functions.common import wait
+from mos_tests.functions.connectivity import ConnectivityProber
 from mos_tests import settings
 
 
@@ -107,15 +108,17 @@ def check_ping_from_vm_helper(env, os_conn, vm, vm_keypair, ip_to_ping,
     return res
 
 
-def check_vm_connectivity(env, os_conn, vm_keypair=None, timeout=4 * 60):
-    """Check that all vms can ping each other and public ip"""
-    servers = os_conn.get_servers()
-    for server1 in servers:
-        ips_to_ping = [settings.PUBLIC_TEST_IP]
-        for server2 in servers:
-            if server1 == server2:
-                continue
-            ips_to_ping += os_conn.get_nova_instance_ips(
-                server2).values()
-        check_ping_from_vm(env, os_conn, server1, vm_keypair, ips_to_ping,
-                           timeout=timeout)
+def check_vm_connectivity(env, os_conn, vm_keypair=None, timeout=4 * 60,
+                          expected=None):
+    """Check that all vms can ping each other and public ip
+
+    All vms are probed in parallel, see
+    `mos_tests.functions.connectivity.ConnectivityProber`.
+
+    :param expected: dict {(src vm name, dst vm name or ip): bool} with
+        pairs, which differ from default (reachable)
+    :returns: ConnectivityMatrix
+    """
+    servers = os_conn.get_servers() or []
+    prober = ConnectivityProber(env, os_conn, servers, vm_keypair=vm_keypair)
+    return prober.wait_for(expected=expected, timeout=timeout)
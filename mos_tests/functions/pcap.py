@@ -0,0 +1,229 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import defaultdict
+from collections import namedtuple
+import os
+import socket
+import struct
+import threading
+
+__doc__ = """Minimal pcap (tcpdump -w) reader for traffic checks
+
+Capture is parsed once, in a single pass, packets are decoded down to
+ARP/IPv4 (through VXLAN encapsulation) and indexed by VNI, protocol and
+addresses, so any count of checks can be done without re-reading file:
+
+    capture = read_capture('vxlan.log')
+    capture.vnis()
+    capture.filter(proto='arp', src='10.1.1.3', dst='10.1.1.4')
+"""
+
+# link types
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+ETH_P_IP = 0x0800
+ETH_P_ARP = 0x0806
+ETH_P_8021Q = 0x8100
+
+IP_PROTOCOLS = {1: 'icmp', 6: 'tcp', 17: 'udp'}
+
+VXLAN_PORT = 4789
+
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1e-6),
+    b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e-9),
+    b'\xa1\xb2\x3c\x4d': ('>', 1e-9),
+}
+
+
+class Packet(namedtuple('Packet', ['number', 'time', 'proto', 'src', 'dst',
+                                   'vni', 'tunnel_src', 'tunnel_dst'])):
+    """Decoded packet
+
+    For ARP `src` and `dst` are sender and target protocol addresses.
+    For VXLAN encapsulated packets `vni` and `tunnel_*` (outer ip
+    addresses) are set, other fields describe inner packet.
+    """
+
+    def __str__(self):
+        line = '{0} {1:.6f} {2} -> {3} {4}'.format(
+            self.number, self.time, self.src, self.dst, self.proto.upper())
+        if self.vni is not None:
+            line += ' (VXLAN vni {0}, {1} -> {2})'.format(
+                self.vni, self.tunnel_src, self.tunnel_dst)
+        return line
+
+
+def iter_records(f):
+    """Yield (time, linktype, data) from pcap file object"""
+    magic = f.read(4)
+    if magic not in PCAP_MAGIC:
+        raise ValueError('Not a pcap file (magic {0!r})'.format(magic))
+    endian, resolution = PCAP_MAGIC[magic]
+    header = f.read(20)
+    if len(header) < 20:
+        return
+    linktype = struct.unpack(endian + 'HHiIII', header)[-1] & 0xffff
+    record = struct.Struct(endian + 'IIII')
+    while True:
+        header = f.read(record.size)
+        if len(header) < record.size:
+            return
+        sec, frac, incl_len, _ = record.unpack(header)
+        data = f.read(incl_len)
+        if len(data) < incl_len:
+            # capture was interrupted
+            return
+        yield sec + frac * resolution, linktype, data
+
+
+def decode_link(linktype, data):
+    """Return (ethertype, payload) of link layer frame"""
+    if linktype == LINKTYPE_ETHERNET:
+        return decode_ethernet(data)
+    if linktype == LINKTYPE_LINUX_SLL and len(data) >= 16:
+        return struct.unpack('!H', data[14:16])[0], data[16:]
+    if linktype == LINKTYPE_LINUX_SLL2 and len(data) >= 20:
+        return struct.unpack('!H', data[0:2])[0], data[20:]
+    if linktype == LINKTYPE_RAW:
+        return ETH_P_IP, data
+    return None, None
+
+
+def decode_ethernet(data):
+    offset = 12
+    while len(data) >= offset + 2:
+        ethertype = struct.unpack('!H', data[offset:offset + 2])[0]
+        if ethertype != ETH_P_8021Q:
+            return ethertype, data[offset + 2:]
+        offset += 4
+    return None, None
+
+
+def decode(ethertype, data, depth=0):
+    """Return (proto, src, dst, vni, tunnel_src, tunnel_dst) or None"""
+    if ethertype == ETH_P_ARP and len(data) >= 28:
+        return ('arp', socket.inet_ntoa(data[14:18]),
+                socket.inet_ntoa(data[24:28]), None, None, None)
+    if ethertype != ETH_P_IP or len(data) < 20:
+        return None
+    ihl = (struct.unpack('!B', data[0:1])[0] & 0x0f) * 4
+    proto = struct.unpack('!B', data[9:10])[0]
+    src = socket.inet_ntoa(data[12:16])
+    dst = socket.inet_ntoa(data[16:20])
+    payload = data[ihl:]
+    if proto == 17 and len(payload) >= 16 and depth < 2:
+        dport = struct.unpack('!H', payload[2:4])[0]
+        if dport == VXLAN_PORT:
+            vni = struct.unpack('!I', payload[12:16])[0] >> 8
+            inner = decode(*decode_ethernet(payload[16:]), depth=depth + 1)
+            if inner is not None:
+                return inner[:3] + (vni, src, dst)
+            return 'vxlan', src, dst, vni, src, dst
+    return IP_PROTOCOLS.get(proto, str(proto)), src, dst, None, None, None
+
+
+class Capture(object):
+    """Decoded packets with indexes by VNI, protocol and addresses"""
+
+    def __init__(self):
+        self.packets = []
+        self.total = 0
+        self.skipped = 0
+        self._index = defaultdict(list)
+
+    def add(self, packet):
+        position = len(self.packets)
+        self.packets.append(packet)
+        for key in (('vni', packet.vni), ('proto', packet.proto),
+                    ('src', packet.src), ('dst', packet.dst)):
+            self._index[key].append(position)
+
+    def read(self, f):
+        """Decode and add packets from pcap file object
+
+        File object may be a stream, packets are added as soon as they are
+        read.
+        """
+        for ts, linktype, data in iter_records(f):
+            self.total += 1
+            fields = decode(*decode_link(linktype, data))
+            if fields is None:
+                self.skipped += 1
+                continue
+            self.add(Packet(self.total, ts, *fields))
+
+    @classmethod
+    def from_file(cls, f):
+        capture = cls()
+        capture.read(f)
+        return capture
+
+    def vnis(self):
+        """Return set of VNIs of encapsulated packets"""
+        return set(key[1] for key in self._index
+                   if key[0] == 'vni' and key[1] is not None)
+
+    def filter(self, proto=None, src=None, dst=None, vni=None):
+        """Return list of packets, which match all given fields"""
+        criteria = [(name, value) for name, value in (('proto', proto),
+                                                      ('src', src),
+                                                      ('dst', dst),
+                                                      ('vni', vni))
+                    if value is not None]
+        if not criteria:
+            return list(self.packets)
+        positions = [self._index.get(x, []) for x in criteria]
+        positions.sort(key=len)
+        result = set(positions[0])
+        for other in positions[1:]:
+            result.intersection_update(other)
+        return [self.packets[x] for x in sorted(result)]
+
+    def exclude_vni(self, vni):
+        """Return list of encapsulated packets with other VNI"""
+        return [x for x in self.packets
+                if x.vni is not None and x.vni != vni]
+
+
+_captures = {}
+_captures_lock = threading.Lock()
+
+
+def read_capture(path):
+    """Return Capture for pcap file, memoized while file is unchanged"""
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    with _captures_lock:
+        if key in _captures:
+            return _captures[key]
+    with open(path, 'rb') as f:
+        capture = Capture.from_file(f)
+    with _captures_lock:
+        for old_key in [x for x in _captures if x[0] == path]:
+            del _captures[old_key]
+        _captures[key] = capture
+    return capture
+
+
+def format_packets(packets, limit=20):
+    lines = [str(x) for x in packets[:limit]]
+    if len(packets) > limit:
+        lines.append('... {0} more'.format(len(packets) - limit))
+    return '\n'.join(lines)
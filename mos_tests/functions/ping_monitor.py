@@ -0,0 +1,352 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import namedtuple
+from collections import OrderedDict
+import logging
+import re
+import signal
+import subprocess
+import threading
+import time
+
+from mos_tests.functions.common import wait
+
+logger = logging.getLogger(__name__)
+
+__doc__ = """Background pings with outage windows detection
+
+    monitor = PingMonitor()
+    monitor.add('8.8.8.8', remote=vm_remote, name='vm1 -> external')
+    monitor.add('10.0.0.5', remote=node_remote,
+                prefix='ip netns exec qrouter-<id> ')
+    with monitor:
+        monitor.wait_stable(10)
+        monitor.mark('ban l3 agent')
+        ...
+        monitor.wait_stable(50)
+    for name, stats in monitor.stats(since_mark=True).items():
+        assert stats.lost < 50, monitor.report()
+
+Replies are timestamped when they are received, lost packets are detected
+by gaps in ping sequence numbers. Sequence numbers start from 1 for
+iputils ping and from 0 for busybox one, flavor is detected by ping output
+header. With `since_mark` only packets sent after the first mark are
+counted (starting right after the last reply received before the mark),
+so loss before ping is stable doesn't affect result.
+"""
+
+SEQ_RE = re.compile(r'seq=(\d+)[ ,]')
+RTT_RE = re.compile(r'time=([\d.]+)')
+TRANSMITTED_RE = re.compile(r'(\d+) packets transmitted')
+# `PING <ip> (<ip>): 56 data bytes`
+BUSYBOX_HEADER_RE = re.compile(r'^PING .*: \d+ data bytes')
+# `PING <ip> (<ip>) 56(84) bytes of data.`
+IPUTILS_HEADER_RE = re.compile(r'^PING .* bytes of data')
+
+Reply = namedtuple('Reply', ['seq', 'time', 'rtt'])
+
+
+class Outage(namedtuple('Outage', ['start', 'end', 'lost', 'events'])):
+    """Period without replies
+
+    `start` is time of the last reply before outage (or pinger start),
+    `end` is time of the first reply after it (or pinger stop), `events`
+    are (time, name) marks made shortly before or during outage.
+    """
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def __str__(self):
+        line = '{0} lost in {1:.1f}s'.format(self.lost, self.duration)
+        if self.events:
+            line += ' after {0}'.format(', '.join(x[1] for x in self.events))
+        return line
+
+
+PingStats = namedtuple('PingStats', ['sent', 'received', 'lost', 'outages',
+                                     'max_gap'])
+
+
+def get_stats(replies, sent, started, stopped, interval=1, events=(),
+              event_window=10, first_seq=1, since=None):
+    """Return PingStats for replies
+
+    :param sent: transmitted packets count (estimated if None)
+    :param event_window: max time (in seconds) between event and outage
+        start to relate them
+    :param first_seq: sequence number of the first packet (1 for iputils
+        ping, 0 for busybox one)
+    :param since: count only packets sent after this time (packets after
+        the last reply received before it)
+    """
+    if since is not None and since > started:
+        before = [x for x in replies if x.time < since]
+        if before:
+            last = max(before, key=lambda x: x.seq)
+            skipped = max(last.seq + 1 - first_seq, 0)
+            first_seq += skipped
+            if sent is not None:
+                sent = max(sent - skipped, 0)
+            # outage after mark starts with the last reply
+            started = last.time
+        else:
+            started = since
+    seen = set()
+    unique = []
+    for reply in replies:
+        # skip duplicates and replies to packets sent before `since`
+        if reply.seq not in seen and reply.seq >= first_seq:
+            seen.add(reply.seq)
+            unique.append(reply)
+    replies = unique
+
+    def relate(outages):
+        result = []
+        prev_end = None
+        for start, end, lost in outages:
+            lower = start - event_window
+            if prev_end is not None:
+                lower = max(lower, prev_end)
+            related = [x for x in events if lower <= x[0] <= end]
+            result.append(Outage(start, end, lost, related))
+            prev_end = end
+        return result
+
+    if not replies:
+        if sent is None:
+            sent = int((stopped - started) / interval)
+        outages = [(started, stopped, sent)] if sent else []
+        return PingStats(sent, 0, sent, relate(outages), stopped - started)
+
+    base = first_seq
+    outages = []
+    if replies[0].seq > base:
+        outages.append((started, replies[0].time, replies[0].seq - base))
+    for prev, reply in zip(replies, replies[1:]):
+        if reply.seq - prev.seq > 1:
+            outages.append((prev.time, reply.time, reply.seq - prev.seq - 1))
+    last = replies[-1]
+    if sent is None:
+        sent = last.seq - base + 1 + int((stopped - last.time) / interval)
+    if sent > last.seq - base + 1:
+        outages.append((last.time, stopped, sent - (last.seq - base + 1)))
+    outages = relate(outages)
+    max_gap = max([x.duration for x in outages] or [0])
+    return PingStats(sent, len(replies), sent - len(replies), outages,
+                     max_gap)
+
+
+class Pinger(object):
+    """Ping running in background
+
+    :param target: ip to ping
+    :param remote: SSHClient to ping from (local host if None)
+    :param prefix: command prefix (`ip netns exec <ns> ` for example)
+    :param interval: ping interval (busybox ping supports only default 1)
+    :param events: list to store marks in (shared by monitor)
+    :param timeout: max ping duration in seconds
+    :param first_seq: sequence number of the first packet (detected by ping
+        output header if None)
+    """
+
+    def __init__(self, target, remote=None, name=None, prefix='',
+                 interval=1, events=None, timeout=60 * 60, first_seq=None):
+        self.target = target
+        self.remote = remote
+        self.name = name or target
+        self.prefix = prefix
+        self.interval = interval
+        self.events = [] if events is None else events
+        self.timeout = timeout
+        self.first_seq = first_seq
+        self.replies = []
+        self.transmitted = None
+        self.started = None
+        self.stopped = None
+        self.pid = None
+        self._proc = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    def __repr__(self):
+        return '<Pinger {0}>'.format(self.name)
+
+    @property
+    def command(self):
+        command = '{0}ping {1}'.format(self.prefix, self.target)
+        if self.interval != 1:
+            command = '{0}ping -i {1} {2}'.format(self.prefix, self.interval,
+                                                  self.target)
+        return command
+
+    def _lines(self):
+        if self.remote is None:
+            self._proc = subprocess.Popen('exec ' + self.command, shell=True,
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.STDOUT)
+            self.pid = self._proc.pid
+            self._ready.set()
+            return iter(self._proc.stdout.readline, b'')
+        # shell prints own pid and is replaced by ping
+        lines = self.remote.iter_lines(
+            'echo $$; exec {0} 2>&1'.format(self.command),
+            timeout=self.timeout)
+        self.pid = next(lines).strip().decode('utf-8')
+        self._ready.set()
+        return lines
+
+    def _run(self):
+        try:
+            for line in self._lines():
+                self.feed(line.decode('utf-8', 'replace'))
+        except Exception:
+            logger.exception('{0!r} failed'.format(self))
+        finally:
+            self._ready.set()
+
+    def feed(self, line):
+        """Process line of ping output"""
+        seq = SEQ_RE.search(line)
+        # `From <ip> icmp_seq=N Destination Host Unreachable` isn't reply
+        if seq is not None and ' bytes from ' in line:
+            rtt = RTT_RE.search(line)
+            self.replies.append(Reply(int(seq.group(1)), time.time(),
+                                      float(rtt.group(1)) if rtt else None))
+            return
+        if self.first_seq is None:
+            if BUSYBOX_HEADER_RE.search(line):
+                self.first_seq = 0
+            elif IPUTILS_HEADER_RE.search(line):
+                self.first_seq = 1
+        transmitted = TRANSMITTED_RE.search(line)
+        if transmitted is not None:
+            self.transmitted = int(transmitted.group(1))
+
+    def start(self):
+        self.started = time.time()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        self._ready.wait(60)
+        logger.info('Started {0!r} (pid {1})'.format(self, self.pid))
+
+    def stop(self, timeout=30):
+        """Interrupt ping and wait for its summary"""
+        if self._thread is None or self.stopped is not None:
+            return
+        self.stopped = time.time()
+        if self._proc is not None:
+            if self._proc.poll() is None:
+                self._proc.send_signal(signal.SIGINT)
+        elif self.pid is not None:
+            self.remote.execute('kill -INT {0}'.format(self.pid),
+                                verbose=False)
+        self._thread.join(timeout)
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+        logger.info('Stopped {0!r}: {1}'.format(self, self.stats()))
+
+    def mark(self, name):
+        """Record event to relate it with outages"""
+        logger.info('Event: {0}'.format(name))
+        self.events.append((time.time(), name))
+
+    def success_tail(self):
+        """Return count of continuous replies at the end"""
+        count = 0
+        for reply, prev in zip(reversed(self.replies),
+                               reversed(self.replies[:-1])):
+            if reply.seq - prev.seq != 1:
+                break
+            count += 1
+        if self.replies:
+            count += 1
+        # ping could stop to receive replies after the last one
+        if (self.replies and
+                time.time() - self.replies[-1].time > 3 * self.interval):
+            return 0
+        return count
+
+    def stats(self, since_mark=False):
+        """Return PingStats
+
+        :param since_mark: count only packets sent after the first mark
+        """
+        since = None
+        if since_mark and self.events:
+            since = self.events[0][0]
+        first_seq = 1 if self.first_seq is None else self.first_seq
+        return get_stats(list(self.replies), self.transmitted, self.started,
+                         self.stopped or time.time(),
+                         interval=self.interval, events=self.events,
+                         first_seq=first_seq, since=since)
+
+
+class PingMonitor(object):
+    """Several pingers with common start/stop and events marks"""
+
+    def __init__(self):
+        self.pingers = OrderedDict()
+        self.events = []
+
+    def add(self, target, remote=None, name=None, **kwargs):
+        """Add pinger (see `Pinger` params)"""
+        pinger = Pinger(target, remote=remote, name=name, events=self.events,
+                        **kwargs)
+        self.pingers[pinger.name] = pinger
+        return pinger
+
+    def mark(self, name):
+        """Record event to relate it with outages"""
+        logger.info('Event: {0}'.format(name))
+        self.events.append((time.time(), name))
+
+    def start(self):
+        for pinger in self.pingers.values():
+            pinger.start()
+
+    def stop(self):
+        for pinger in self.pingers.values():
+            pinger.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def wait_stable(self, count=10, timeout=10 * 60):
+        """Wait for `count` continuous replies on all pingers"""
+        wait(lambda: all(x.success_tail() >= count
+                         for x in self.pingers.values()),
+             timeout_seconds=timeout,
+             sleep_seconds=1,
+             waiting_for='{0} continuous ping replies'.format(count))
+
+    def stats(self, since_mark=False):
+        """Return dict {pinger name: PingStats} (see `Pinger.stats`)"""
+        return OrderedDict((name, pinger.stats(since_mark=since_mark))
+                           for name, pinger in self.pingers.items())
+
+    def report(self):
+        lines = []
+        for name, stats in self.stats().items():
+            lines.append('{0}: {1.lost} of {1.sent} lost, max gap '
+                         '{1.max_gap:.1f}s'.format(name, stats))
+            lines.extend('  {0}'.format(x) for x in stats.outages)
+        return '\n'.join(lines)
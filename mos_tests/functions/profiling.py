@@ -0,0 +1,55 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import defaultdict
+from contextlib import contextmanager
+import threading
+import time
+
+
+class Counters(object):
+    """Counters (ssh commands, API calls) and time spans, grouped by test
+
+    Usage:
+        counters.add('ssh_commands')
+        with counters.span('revert'):
+            revert_snapshot()
+    """
+
+    def __init__(self):
+        self.test = None
+        self._data = defaultdict(lambda: defaultdict(float))
+        self._lock = threading.Lock()
+
+    def add(self, name, value=1):
+        with self._lock:
+            self._data[self.test][name] += value
+
+    @contextmanager
+    def span(self, name):
+        """Count calls and time (as `time.<name>`) of code block"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name)
+            self.add('time.{0}'.format(name), time.time() - start)
+
+    def pop(self, test):
+        """Return counters of test and forget them"""
+        with self._lock:
+            return dict(self._data.pop(test, {}))
+
+
+counters = Counters()
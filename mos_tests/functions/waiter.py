@@ -0,0 +1,270 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import defaultdict
+from collections import namedtuple
+import logging
+import random
+import re
+import threading
+import time
+
+from waiting import TimeoutExpired
+
+from mos_tests.environment.ssh import OutputBuffer
+
+logger = logging.getLogger('waiting')
+
+WaitRecord = namedtuple('WaitRecord', ['test', 'called_from', 'waiting_for',
+                                       'timeout', 'elapsed', 'polls',
+                                       'status'])
+
+
+class WaitStats(object):
+    """Collects results of all waits, grouped by current test"""
+
+    def __init__(self):
+        self.test = None
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, **kwargs):
+        record = WaitRecord(test=self.test, **kwargs)
+        with self._lock:
+            self.records.append(record)
+        return record
+
+    def get(self, test=None):
+        return [x for x in self.records if test is None or x.test == test]
+
+    def clear(self):
+        with self._lock:
+            self.records = []
+
+    def total_by_test(self):
+        """Return list of (test, total waiting time) sorted by time"""
+        totals = defaultdict(float)
+        for record in self.records:
+            totals[record.test] += record.elapsed
+        return sorted(totals.items(), key=lambda x: x[1], reverse=True)
+
+    def report(self, test=None, limit=None):
+        """Return list of strings with waits, sorted by elapsed time"""
+        records = sorted(self.get(test), key=lambda x: x.elapsed,
+                         reverse=True)
+        lines = []
+        for record in records[:limit]:
+            timeout = record.timeout
+            if timeout is not None:
+                timeout = '{0:.0f}s'.format(timeout)
+            lines.append(
+                '{0.elapsed:7.1f}s of {1:>6} {0.polls:4d} polls {0.status:7} '
+                '{0.waiting_for} ({0.called_from})'.format(record, timeout))
+        return lines
+
+
+wait_stats = WaitStats()
+
+
+class Deadline(object):
+    """Time budget shared between several waits
+
+    Usage:
+        deadline = Deadline(5 * 60)
+        wait(predicate1, deadline=deadline)
+        wait(predicate2, deadline=deadline)  # gets only remaining time
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.end = time.time() + seconds
+
+    @property
+    def remaining(self):
+        return max(self.end - time.time(), 0)
+
+
+class LogProbe(object):
+    """Probe, which is signaled when a line matching `pattern` appears in
+    remote file
+
+    Usage:
+        with controller.ssh() as remote:
+            with LogProbe(remote, '/var/log/nova/nova-compute.log',
+                          'Instance spawned') as probe:
+                wait(predicate, probe=probe, timeout_seconds=60)
+    """
+
+    def __init__(self, remote, path, pattern):
+        self.remote = remote
+        self.path = path
+        self.pattern = re.compile(pattern)
+        self.matches = []
+        self._event = threading.Event()
+        self._chan = None
+        self._thread = None
+
+    def _on_line(self, line):
+        if self.pattern.search(line.decode('utf-8', 'replace')):
+            self.matches.append(line)
+            self._event.set()
+
+    def _read(self):
+        buf = OutputBuffer(max_size=0, line_callback=self._on_line)
+        try:
+            while True:
+                chunk = self._chan.recv(self.remote.chunk_size)
+                if not chunk:
+                    break
+                buf.append(chunk)
+        except Exception as e:
+            logger.debug('Log probe for {0} stopped: {1}'.format(self.path,
+                                                                 e))
+
+    def start(self):
+        # shell prints own pid to stderr and is replaced by tail
+        cmd = 'echo $$ >&2; exec tail -F -n0 {0}'.format(self.path)
+        self._chan, _, _, stderr = self.remote.execute_async(cmd)
+        self.pid = stderr.readline().strip()
+        if isinstance(self.pid, bytes):
+            self.pid = self.pid.decode('utf-8')
+        self._thread = threading.Thread(target=self._read)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self.pid:
+            try:
+                self.remote.execute('kill {0}'.format(self.pid),
+                                    verbose=False)
+            except Exception as e:
+                logger.debug("Can't kill tail of {0}: {1}".format(self.path,
+                                                                  e))
+            self.pid = None
+        if self._chan is not None:
+            self._chan.close()
+            self._thread.join(5)
+            self._chan = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def wait(self, timeout):
+        return self._event.wait(timeout)
+
+    def clear(self):
+        self._event.clear()
+
+
+def sleep_generator(sleep_seconds=1, adaptive=True, jitter=0.1):
+    """Yield times to sleep between polls
+
+    :param sleep_seconds: number or tuple (start, end, multiplier) for
+        exponential backoff
+    :param adaptive: if True, number `sleep_seconds` is treated as max sleep
+        time, and sleeping starts from 1 second with doubling
+    :param jitter: relative random deviation of each sleep time
+    """
+    if isinstance(sleep_seconds, (tuple, list)):
+        params = tuple(sleep_seconds) + (None, 2)[len(sleep_seconds) - 1:]
+        current, end, multiplier = params[:3]
+    elif adaptive:
+        current, end, multiplier = min(1, sleep_seconds), sleep_seconds, 2
+    else:
+        current, end, multiplier = sleep_seconds, sleep_seconds, 1
+    while True:
+        yield max(0, current * random.uniform(1 - jitter, 1 + jitter))
+        current *= multiplier
+        if end is not None:
+            current = min(current, end)
+
+
+def wait(predicate, timeout_seconds=None, sleep_seconds=1, waiting_for=None,
+         expected_exceptions=(), on_poll=None, probe=None, deadline=None,
+         adaptive=True, jitter=0.1, called_from=None, log=True):
+    """Wait until predicate returns true value and return this value
+
+    Interface is compatible with `waiting.wait`. Additional arguments:
+
+    :param probe: object with `wait(timeout)` method (like threading.Event
+        or LogProbe), which interrupts sleeping between polls when it is
+        signaled. It will be cleared (if it has `clear` method) after signal
+    :param deadline: Deadline instance to limit timeout
+    :param adaptive: start polling with 1 second period and increase it up to
+        `sleep_seconds` with each poll
+    :param jitter: relative random deviation of sleep time between polls
+    :raises: waiting.TimeoutExpired
+    """
+    if waiting_for is None:
+        waiting_for = repr(predicate)
+    if deadline is not None:
+        remaining = deadline.remaining
+        if timeout_seconds is None or timeout_seconds > remaining:
+            timeout_seconds = remaining
+    msg = '{0}: waiting for {1}'.format(called_from, waiting_for)
+    if log:
+        logger.info(msg)
+
+    start = time.time()
+    end = None
+    if timeout_seconds is not None:
+        end = start + timeout_seconds
+    sleeps = sleep_generator(sleep_seconds, adaptive=adaptive, jitter=jitter)
+    polls = 0
+
+    def add_record(status):
+        record = wait_stats.add(called_from=called_from,
+                                waiting_for=waiting_for,
+                                timeout=timeout_seconds,
+                                elapsed=time.time() - start,
+                                polls=polls,
+                                status=status)
+        if log:
+            timeout = 'unlimited'
+            if timeout_seconds is not None:
+                timeout = '{0:.0f}s'.format(timeout_seconds)
+            logger.info('{msg} ... {0.status}. Took {0.elapsed:.0f}s of '
+                        '{timeout} ({0.polls} polls)'.format(
+                            record, msg=msg, timeout=timeout))
+
+    while True:
+        polls += 1
+        result = None
+        try:
+            result = predicate()
+            if on_poll is not None:
+                on_poll()
+        except expected_exceptions:
+            pass
+        if result:
+            add_record('done')
+            return result
+
+        now = time.time()
+        if end is not None and now >= end:
+            add_record('timeout')
+            raise TimeoutExpired(timeout_seconds, waiting_for)
+        delay = next(sleeps)
+        if end is not None:
+            delay = min(delay, end - now)
+        if probe is None:
+            time.sleep(delay)
+        elif probe.wait(delay):
+            logger.debug('{0}: probe is signaled'.format(msg))
+            if hasattr(probe, 'clear'):
+                probe.clear()
@@ -30,6 +30,7 @@ def clear_l3_ban(env, os_conn):
         for node in controllers:
             remote.execute("pcs resource clear neutron-l3-agent {0}".format(
                 node.data['fqdn']))
+    env.controller_roles.invalidate()
 
 
 @pytest.fixture
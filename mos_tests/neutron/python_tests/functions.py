@@ -50,6 +50,7 @@ def ban_dhcp_agent(os_conn, env, node_to_ban, host, network_name=None,
         remote.check_call(
             "pcs resource ban neutron-dhcp-agent {0}".format(
                 node_to_ban))
+    env.controller_roles.invalidate()
 
     # Wait to die banned dhcp agent
     if wait_for_die:
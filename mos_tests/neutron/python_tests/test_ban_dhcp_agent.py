@@ -93,6 +93,7 @@ class TestBaseDHCPAgent(base.TestBase):
             remote.check_call(
                 "pcs resource clear neutron-dhcp-agent {0}".format(
                     node_to_clear))
+        self.env.controller_roles.invalidate()
 
         # Wait to reschedule dhcp agent
         if wait_for_rescheduling:
@@ -13,21 +13,15 @@
 #    under the License.
 
 from collections import defaultdict
-from collections import namedtuple
 from contextlib import contextmanager
 import logging
-import re
-import signal
-import subprocess
-import threading
 
 from neutronclient.common.exceptions import InternalServerError
 import pytest
-from six.moves.queue import Empty
-from six.moves.queue import Queue
 
 from mos_tests.functions.common import wait
 from mos_tests.functions import network_checks
+from mos_tests.functions.ping_monitor import PingMonitor
 from mos_tests.neutron.python_tests.base import TestBase
 from mos_tests import settings
 
@@ -35,91 +29,6 @@ from mos_tests import settings
 logger = logging.getLogger(__name__)
 
 
-def get_ping_seq(line):
-    """Return ping seq"""
-    seq = re.search(r'seq=(\d+) ', line)
-    if seq is None:
-        return None
-    return int(seq.group(1))
-
-
-def ping_groups(stdout):
-    """Generate ping info for each line of stdout
-
-    Format:
-        * `sent` - count of sent packets
-        * `received` - count of received packets
-        * `group_len` - len of last continuous group of success pings
-    """
-    PingInfo = namedtuple('PingInfo', ['sent', 'received', 'group_len'])
-    prev_seq = -1
-    group_start = 0
-    received = 0
-    start_seq = 0
-    for line in stdout:
-        logger.debug('Ping result: {}'.format(line.strip()))
-        seq = get_ping_seq(line)
-        if seq is None:
-            continue
-        # if first ping 'seq' was more then 0. For e.g.: 223
-        if seq != start_seq and start_seq == 0 and prev_seq == -1:
-            start_seq = seq
-        received += 1
-        if seq != prev_seq + 1:
-            logger.debug('ping interrupted')
-            group_start = seq
-        sent = seq - start_seq
-        pi = PingInfo(sent=sent, received=received,
-                      group_len=seq - group_start)
-        logger.debug(
-            'start_seq={0}, prev_seq={1}, received={2}, sent={3}, '
-            'group_len={4}'.format(
-                start_seq, prev_seq, received, sent, seq - group_start))
-        yield pi
-        prev_seq = seq
-
-
-class PingThread(threading.Thread):
-    def __init__(self, remote, ip_to_ping,
-                 timeout=10 * 60, *args, **kwargs):
-        super(PingThread, self).__init__(*args, **kwargs)
-        self.stdout_q = Queue()
-        self._stop = threading.Event()
-        self.remote = remote
-        self.ip_to_ping = ip_to_ping
-        self.timeout = timeout
-        self.stdin = None
-        self.chan = None
-
-    def run(self):
-        remote = self.remote
-        command = 'ping {0} 2>&1'.format(self.ip_to_ping)
-        self.chan, self.stdin, stdout, _ = remote.execute_async(command)
-        for line in stdout:
-            self.stdout_q.put(line)
-
-    def stop(self):
-        self._stop.set()
-        if self.stdin is not None:
-            self.stdin.write(chr(signal.SIGINT))
-            self.stdin.flush()
-        if self.chan is not None:
-            self.chan.close()
-
-    def stopped(self):
-        return self._stop.isSet()
-
-    def iter_output(self):
-        while True:
-            try:
-                yield self.stdout_q.get(timeout=self.timeout)
-            except Empty:
-                self.stop()
-                self._Thread__stop()
-                raise Exception('Timeout was reached during communicate '
-                                'with thread')
-
-
 @pytest.mark.check_env_('is_l3_ha', 'has_2_or_more_computes')
 class TestL3HA(TestBase):
     """Tests for L3 HA"""
@@ -128,42 +37,30 @@ class TestL3HA(TestBase):
     def background_ping_from_host(self, ip_to_ping, recover_pings=50):
         """Start ping from host to `ip_to_ping` before enter and stop it after
 
-        Return dict with ping stat
+        Return Pinger, ping stats are available by its `stats` method
+        (use `since_mark=True` to count loss after the first mark only)
 
-        :param ip_to_ping: ip address to ping from `vm`
+        :param ip_to_ping: ip address to ping from host
+        :param recover_pings: count of continuous pings to determine that
+            connect is restored
         """
-
-        result = {}
-
-        logger.info('Start ping on {0}'.format(ip_to_ping))
-        proc = subprocess.Popen(['ping', ip_to_ping], stdout=subprocess.PIPE)
-        try:
-            proc.stdout.readline()
-            output = []
-            for line_count in range(10):
-                output.append(proc.stdout.readline().strip())
-
-            yield result
-            # terminate ping subprocess and fill analyzed result
+        monitor = PingMonitor()
+        # iputils ping starts sequence from 1
+        pinger = monitor.add(ip_to_ping, first_seq=1)
+        with monitor:
+            monitor.wait_stable(10)
+            yield pinger
             logger.info('Wait for ping restored')
-            for line_count in range(recover_pings):
-                output.append(proc.stdout.readline().strip())
-            proc.terminate()
-            output += proc.communicate()[0].split('\n')
-            groups = ping_groups(output)
-            for ping_info in groups:
-                result['received'] = ping_info.received
-                result['sent'] = ping_info.sent
-        finally:
-            if proc.returncode is None:
-                proc.kill()
+            monitor.wait_stable(recover_pings)
+        logger.info('Ping results:\n{0}'.format(monitor.report()))
 
     @contextmanager
     def background_ping(self, vm, vm_keypair, ip_to_ping, good_pings=50,
                         proxy_node=None):
         """Start ping from `vm` to `ip_to_ping` before enter and stop it after
 
-        Return dict with ping stat
+        Return Pinger, ping stats are available by its `stats` method
+        (use `since_mark=True` to count loss after the first mark only)
 
         :param vm: instance to ping from
         :param vm_keypair: keypair to connect to `vm`
@@ -171,34 +68,18 @@ class TestL3HA(TestBase):
         :param good_pings: count of continuous pings to determine that connect
             is restored
         """
-        result = {
-            'received': 0,
-            'sent': 0,
-        }
-
         with self.os_conn.ssh_to_instance(self.env, vm, vm_keypair,
                                           proxy_node=proxy_node) as remote:
-            t = PingThread(remote=remote, ip_to_ping=ip_to_ping)
-            logger.info('Start ping on {0}'.format(ip_to_ping))
-            t.start()
-
-            groups = ping_groups(t.iter_output())
-
-            # Wait for 10 not interrupted packets
-            for ping_info in groups:
-                if ping_info.group_len >= 10:
-                    break
-
-            yield result
-
-            logger.info('Wait for ping restored')
-            for ping_info in groups:
-                result['received'] = ping_info.received
-                result['sent'] = ping_info.sent
-                if ping_info.group_len >= good_pings:
-                    break
-            t.stop()
-            t.join()
+            monitor = PingMonitor()
+            # cirros (busybox) ping starts sequence from 0
+            pinger = monitor.add(ip_to_ping, remote=remote, first_seq=0)
+            with monitor:
+                # Wait for 10 not interrupted packets
+                monitor.wait_stable(10)
+                yield pinger
+                logger.info('Wait for ping restored')
+                monitor.wait_stable(good_pings)
+        logger.info('Ping results:\n{0}'.format(monitor.report()))
 
     def get_active_l3_agents_for_router(self, router_id):
         agents = self.os_conn.get_l3_for_router(router_id)
@@ -303,18 +184,19 @@ class TestL3HA(TestBase):
             # Ban l3 agent
             with self.background_ping(vm=server1,
                                       vm_keypair=self.instance_keypair,
-                                      ip_to_ping=server2_ip) as ping_result:
+                                      ip_to_ping=server2_ip) as pinger:
                 with self.env.get_ssh_to_node(controller_ip) as remote:
-                    logger.info("Ban L3 agent on node {0}".format(node_to_ban))
+                    pinger.mark("Ban L3 agent on node {0}".format(node_to_ban))
                     remote.check_call(
                         "pcs resource ban neutron-l3-agent {0}".format(
                             node_to_ban))
+                    self.env.controller_roles.invalidate()
                     new_agent = self.wait_router_rescheduled(
                         router_id=router['router']['id'],
                         from_node=node_to_ban)
                     node_to_ban = new_agent['host']
 
-            assert ping_result['sent'] - ping_result['received'] < 50
+            assert pinger.stats(since_mark=True).lost < 50
 
     @pytest.mark.testrail_id('542794')
     def test_ban_all_l3_agents_and_clear_them(self, router, prepare_openstack):
@@ -343,9 +225,11 @@ class TestL3HA(TestBase):
         with controller.ssh() as remote:
             logger.info('disable all l3 agents')
             remote.check_call('pcs resource disable neutron-l3-agent')
+            self.env.controller_roles.invalidate()
             self.os_conn.wait_agents_down(agent_ids)
             logger.info('enable all l3 agents')
             remote.check_call('pcs resource enable neutron-l3-agent')
+            self.env.controller_roles.invalidate()
             self.os_conn.wait_agents_alive(agent_ids)
 
         network_checks.check_ping_from_vm(
@@ -380,15 +264,15 @@ class TestL3HA(TestBase):
 
         # Delete namespace
         with self.background_ping(vm=server1, vm_keypair=self.instance_keypair,
-                                  ip_to_ping=server2_ip) as ping_result:
+                                  ip_to_ping=server2_ip) as pinger:
             with self.env.get_ssh_to_node(node_ip) as remote:
-                logger.info(("Delete namespace for router `router01` "
+                pinger.mark(("Delete namespace for router `router01` "
                              "on {0}").format(node_ip))
                 remote.check_call(
                     "ip netns delete qrouter-{0}".format(
                         router['router']['id']))
 
-        assert ping_result['sent'] - ping_result['received'] < 50
+        assert pinger.stats(since_mark=True).lost < 50
 
     @pytest.mark.testrail_id('542786')
     def test_destroy_primary_controller(self, router, prepare_openstack,
@@ -426,6 +310,7 @@ class TestL3HA(TestBase):
                     remote.check_call(
                         'pcs resource ban neutron-l3-agent {}'.format(
                             node.data['fqdn']))
+                self.env.controller_roles.invalidate()
                 from_node = l3_agent_controller.data['fqdn']
                 self.wait_router_rescheduled(router_id=router_id,
                                              from_node=from_node,
@@ -434,6 +319,7 @@ class TestL3HA(TestBase):
                     remote.check_call(
                         'pcs resource clear neutron-l3-agent {}'.format(
                             node.data['fqdn']))
+                self.env.controller_roles.invalidate()
 
         server1 = self.os_conn.nova.servers.find(name="server01")
         server2 = self.os_conn.nova.servers.find(name="server02")
@@ -513,18 +399,19 @@ class TestL3HA(TestBase):
         # Ban l3 agent
         with self.background_ping(vm=server20,
                                   vm_keypair=self.instance_keypair,
-                                  ip_to_ping=server21_ip) as ping_result:
+                                  ip_to_ping=server21_ip) as pinger:
             with self.env.leader_controller.ssh() as remote:
-                logger.info("Ban L3 agent on node {0}".format(node_to_ban))
+                pinger.mark("Ban L3 agent on node {0}".format(node_to_ban))
                 remote.check_call(
                     "pcs resource ban neutron-l3-agent {0}".format(
                         node_to_ban))
+                self.env.controller_roles.invalidate()
                 new_agent = self.wait_router_rescheduled(
                     router_id=router['router']['id'],
                     from_node=node_to_ban)
                 node_to_ban = new_agent['host']
 
-        assert ping_result['sent'] - ping_result['received'] < 50
+        assert pinger.stats(since_mark=True).lost < 50
 
     @pytest.mark.testrail_id('542790')
     def test_ban_active_l3_agent_with_external_connectivity(self, router,
@@ -553,17 +440,18 @@ class TestL3HA(TestBase):
         with self.background_ping(
                 vm=instance,
                 vm_keypair=self.instance_keypair,
-                ip_to_ping=settings.PUBLIC_TEST_IP) as ping_result:
+                ip_to_ping=settings.PUBLIC_TEST_IP) as pinger:
             with self.env.get_ssh_to_node(controller_ip) as remote:
-                logger.info("Ban L3 agent on node {0}".format(node_to_ban))
+                pinger.mark("Ban L3 agent on node {0}".format(node_to_ban))
                 remote.check_call(
                     "pcs resource ban neutron-l3-agent {0}".format(
                         node_to_ban))
+                self.env.controller_roles.invalidate()
                 self.wait_router_rescheduled(
                     router_id=router['router']['id'],
                     from_node=node_to_ban)
 
-        assert (ping_result['sent'] - ping_result['received']) < 40
+        assert pinger.stats(since_mark=True).lost < 40
 
     @pytest.mark.testrail_id('542791')
     def test_move_router_iface_to_down_state(self, router, prepare_openstack):
@@ -602,9 +490,9 @@ class TestL3HA(TestBase):
         with self.background_ping(
                 vm=instance,
                 vm_keypair=self.instance_keypair,
-                ip_to_ping=settings.PUBLIC_TEST_IP) as ping_result:
+                ip_to_ping=settings.PUBLIC_TEST_IP) as pinger:
             with active_node.ssh() as remote:
-                logger.info("Move down ha-port on router")
+                pinger.mark("Move down ha-port on router")
                 remote.check_call(
                     "ip netns exec qrouter-{router_id} "
                     "ip link set dev {iface_id} down".format(
@@ -613,7 +501,7 @@ class TestL3HA(TestBase):
                     router_id=router['router']['id'],
                     from_node=active_hostname)
 
-        assert (ping_result['sent'] - ping_result['received']) < 50
+        assert pinger.stats(since_mark=True).lost < 50
 
     @pytest.mark.testrail_id('542789')
     def test_ban_l3_agent_with_tcpdump_check(self, router, prepare_openstack):
@@ -688,12 +576,13 @@ class TestL3HA(TestBase):
                                         active_qg_iface_id)
         # Ban l3 agent
         with self.background_ping_from_host(
-                ip_to_ping=instance_ip) as ping_result:
+                ip_to_ping=instance_ip) as pinger:
             with controllers[0].ssh() as remote:
-                logger.info("Ban active l3 agent")
+                pinger.mark("Ban active l3 agent")
                 remote.check_call(
                     "pcs resource ban neutron-l3-agent {0}".format(
                         active_hostname))
+                self.env.controller_roles.invalidate()
                 new_active_agent = self.wait_router_rescheduled(
                     router_id=router['router']['id'],
                     from_node=active_hostname)
@@ -713,7 +602,7 @@ class TestL3HA(TestBase):
         new_tcpdump_results = get_last_package_datetime(new_active_node)
         assert (last_tcpdump_results and new_tcpdump_results) is not None
         assert last_tcpdump_results < new_tcpdump_results
-        assert (ping_result['sent'] - ping_result['received']) < 50
+        assert pinger.stats(since_mark=True).lost < 50
 
     def reschedule_active_l3_agt(self, router_id,
                                  to_controller, from_controller):
@@ -728,6 +617,7 @@ class TestL3HA(TestBase):
                     remote.check_call(
                         'pcs resource ban neutron-l3-agent {}'.format(
                             node.data['fqdn']))
+                self.env.controller_roles.invalidate()
                 # Wait until the agent is migrated
                 # to the destination controller
                 from_node = from_controller.data['fqdn']
@@ -738,6 +628,7 @@ class TestL3HA(TestBase):
                     remote.check_call(
                         'pcs resource clear neutron-l3-agent {}'.format(
                             node.data['fqdn']))
+                self.env.controller_roles.invalidate()
 
     def check_l3_ha_agent_states(self, router_id):
         active_agents = self.get_active_l3_agents_for_router(router_id)
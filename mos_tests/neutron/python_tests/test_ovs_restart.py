@@ -12,7 +12,6 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import csv
 import logging
 from random import randint
 import re
@@ -21,8 +20,7 @@ import time
 import pytest
 
 from mos_tests.functions import common
-from mos_tests.functions.common import wait
-from mos_tests.functions import file_cache
+from mos_tests.functions import iperf
 from mos_tests.functions import network_checks
 from mos_tests.neutron.python_tests.base import TestBase
 from mos_tests import settings
@@ -574,47 +572,16 @@ class TestOVSRestartWithIperfTraffic(OvsBase):
         """Create image
         :return: image object for Glance
         """
-        image = self.os_conn.glance.images.create(name="image_ubuntu",
-                                                  disk_format='qcow2',
-                                                  container_format='bare')
-        with file_cache.get_file(settings.UBUNTU_QCOW2_URL) as f:
-            self.os_conn.glance.images.upload(image['id'], f)
-        return image
-
-    def get_lost_percentage(self, output):
-        """Get lost percentage
-
-        :param output: output of iperf client
-        :return: percentage of lost datagrams
-        """
-        output = output.strip()
-        logger.debug('Iperf result:\n{}'.format(output))
-        reader = csv.reader(output.splitlines())
-        rows = list(reader)
-        return float(rows[-1][12])
-
-    def launch_iperf_client(self, client, server, keypair, vm_login,
-                            stdout):
-        """Launch iperf client"""
-        client_cmd = ('iperf --port 5002 -u --client {0} --len 64'
-                      ' --bandwidth 1M --time 60 -i 10 -y C -x CDMS').format(
-                          self.os_conn.get_nova_instance_ips(server)['fixed'])
-        with self.os_conn.ssh_to_instance(self.env,
-                                          vm=client,
-                                          vm_keypair=keypair,
-                                          username=vm_login) as remote:
-            return remote.background_call(client_cmd, stdout=stdout)
+        return self.os_conn.provision_image(settings.UBUNTU_QCOW2_URL,
+                                            "image_ubuntu")
 
-    def wait_command_done(self, pid, vm, keypair, vm_login):
-        with self.os_conn.ssh_to_instance(self.env,
-                                          vm=vm,
-                                          vm_keypair=keypair,
-                                          username=vm_login) as remote:
-            cmd = 'ps -o pid | grep {}'.format(pid)
-            wait(lambda: not remote.execute(cmd).is_ok,
-                 timeout_seconds=2 * 60,
-                 sleep_seconds=15,
-                 waiting_for='command with pid {} to be done'.format(pid))
+    def iperf_flow(self, client, server):
+        """Return harness with UDP flow from client to server"""
+        harness = iperf.IperfHarness(self.env, self.os_conn,
+                                     self.instance_keypair)
+        harness.add_flow(client, server, 5002, udp=True, length=64,
+                         bandwidth='1M', time=60, interval=10)
+        return harness
 
     def _prepare_openstack(self):
         """Prepare OpenStack for scenarios run
@@ -718,42 +685,18 @@ class TestOVSRestartWithIperfTraffic(OvsBase):
         """
         self._prepare_openstack()
 
-        iperf_log_file = '/tmp/iperf_client.log'
-
         client = self.server1
         server = self.server2
 
-        # Launch iperf client
-        pid = self.launch_iperf_client(client, server,
-                                       self.instance_keypair,
-                                       vm_login='ubuntu',
-                                       stdout=iperf_log_file)
-
-        time.sleep(60)
-
-        self.wait_command_done(pid, vm=client, keypair=self.instance_keypair,
-                               vm_login='ubuntu')
-
-        with self.os_conn.ssh_to_instance(self.env,
-                                          vm=client,
-                                          vm_keypair=self.instance_keypair,
-                                          username='ubuntu') as remote:
-            with remote.open(iperf_log_file) as f:
-                iperf_result = f.read()
-
         # Check iperf traffic before restart
-        lost = self.get_lost_percentage(iperf_result)
-        err_msg = "Packet losses more than 1%. Actual value is {0}%".format(
-            lost)
-        assert lost < 1, err_msg
+        result, = self.iperf_flow(client, server).run()
+        result.assert_loss(1)
 
         self.os_conn.wait_agents_alive(self.ovs_agent_ids)
 
         # Launch client in background and restart agents
-        pid = self.launch_iperf_client(client, server,
-                                       self.instance_keypair,
-                                       vm_login='ubuntu',
-                                       stdout=iperf_log_file)
+        harness = self.iperf_flow(client, server)
+        harness.start()
 
         common.disable_ovs_agents_on_controller(self.env)
         self.os_conn.wait_agents_down(self.ovs_conroller_agents)
@@ -761,18 +704,8 @@ class TestOVSRestartWithIperfTraffic(OvsBase):
         common.enable_ovs_agents_on_controllers(self.env)
         self.os_conn.wait_agents_alive(self.ovs_agent_ids)
 
-        self.wait_command_done(pid, vm=client, keypair=self.instance_keypair,
-                               vm_login='ubuntu')
-
-        with self.os_conn.ssh_to_instance(self.env,
-                                          vm=client,
-                                          vm_keypair=self.instance_keypair,
-                                          username='ubuntu') as remote:
-            with remote.open(iperf_log_file) as f:
-                iperf_result = f.read()
-
-        err_msg = "{0}% datagrams lost. Should be < 20%".format(lost)
-        assert lost < 20, err_msg
+        result, = harness.wait()
+        result.assert_loss(20)
 
         # check all agents are alive
         assert all([agt['alive'] for agt in
@@ -931,15 +864,9 @@ class TestOVSRestartTwoSeparateVms(OvsBase):
                 nics=[{'net-id': net['network']['id']}])
 
         # Check pings with alive ovs-agents,
-        # and before restart 'neutron-plugin-openvswitch-agent'
-        self.server1 = self.os_conn.nova.servers.find(name="test_vm_06")
-        self.server2_ip = self.os_conn.get_nova_instance_ips(
-            self.os_conn.nova.servers.find(name="test_vm_05")
-        ).values()[0]
-
+        # and before restart 'neutron-plugin-openvswitch-agent'.
         # Ping should NOT go between VMs
-        self.check_no_ping_from_vm(self.server1, self.instance_keypair,
-                                   self.server2_ip, timeout=None)
+        self.check_vms_isolation()
 
         # make a list of all ovs agent ids
         self.ovs_agent_ids = [
@@ -954,6 +881,20 @@ class TestOVSRestartTwoSeparateVms(OvsBase):
         self.ovs_conroller_agents = [agt['id'] for agt in ovs_agts
                                      if agt['host'] in controllers]
 
+    def check_vms_isolation(self):
+        """Check that VMs can't reach each other and external ip
+
+        Routers have no gateway, so external ip is unreachable too.
+        """
+        vms = ('test_vm_05', 'test_vm_06')
+        expected = {}
+        for src, dst in (vms, vms[::-1]):
+            expected[(src, dst)] = False
+            expected[(src, settings.PUBLIC_TEST_IP)] = False
+        network_checks.check_vm_connectivity(
+            self.env, self.os_conn, vm_keypair=self.instance_keypair,
+            expected=expected)
+
     @pytest.mark.testrail_id('542666')
     def test_ovs_restart_pcs_disable_enable_ping_private_vms(self):
         """Restart openvswitch-agents with pcs disable/enable on controllers.
@@ -1008,5 +949,4 @@ class TestOVSRestartTwoSeparateVms(OvsBase):
         # after restarting service
         time.sleep(30)
 
-        self.check_no_ping_from_vm(self.server1, self.instance_keypair,
-                                   self.server2_ip, timeout=None)
+        self.check_vms_isolation()
@@ -12,13 +12,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import csv
 import logging
 
 import pytest
 
 from mos_tests.functions import common
-from mos_tests.functions import file_cache
+from mos_tests.functions import iperf
 from mos_tests.neutron.python_tests import base
 from mos_tests import settings
 
@@ -63,15 +62,11 @@ def delete_net_policy(os_conn):
 @pytest.yield_fixture(scope='class')
 def iperf_image_id(os_conn):
     logger.info('Creating ubuntu image')
-    image = os_conn.glance.images.create(name="image_ubuntu",
-                                         disk_format='qcow2',
-                                         container_format='bare')
-    with file_cache.get_file(settings.UBUNTU_QCOW2_URL) as f:
-        os_conn.glance.images.upload(image.id, f)
-
+    image = os_conn.provision_image(settings.UBUNTU_QCOW2_URL,
+                                    "image_ubuntu")
     logger.info('Ubuntu image created')
     yield image.id
-    os_conn.glance.images.delete(image.id)
+    os_conn.release_image(image.id)
 
 
 @pytest.fixture(scope='class')
@@ -179,59 +174,34 @@ class TestQoSBase(base.TestBase):
             wait_for_active=False,
             wait_for_avaliable=False)
 
-    def get_iperf_result(self,
-                         remote,
-                         server_ip,
-                         time=80,
-                         interval=20,
-                         udp=False):
-        interval = min(interval, time)
-        port = UDP_PORT if udp else TCP_PORT
-        if udp:
-            cmd = ('iperf -u -c {ip} -p {port} -x CDMS -y C -t {time} '
-                   '-i {interval} --bandwidth 10M')
-        else:
-            cmd = 'iperf -c {ip} -p {port} -y C -t {time} -i {interval}'
-        result = remote.check_call(cmd.format(ip=server_ip,
-                                              port=port,
-                                              time=time,
-                                              interval=interval))
-        assert not result['stderr'], 'Error during iperf execution, {}'.format(
-            result)
-        if udp:
-            # Show only server report
-            stdout = result['stdout'][-1:]
-        else:
-            stdout = result['stdout']
-            # Exclude summary
-            if len(stdout) > 1:
-                stdout = stdout[:-1]
-            # Strip first result, because it almost always too high
-            if len(stdout) > 1:
-                stdout = stdout[1:]
-        reader = csv.reader(stdout)
-        for line in reader:
-            yield line
-
     def check_iperf_bandwidth(self,
                               client,
                               server,
                               limit,
                               ip_type='fixed',
-                              **kwargs):
-        server_ip = self.os_conn.get_nova_instance_ips(server)[ip_type]
-        with self.os_conn.ssh_to_instance(
-                self.env,
-                client,
-                username='ubuntu',
-                vm_keypair=self.instance_keypair) as remote:
-            for line in self.get_iperf_result(remote, server_ip, **kwargs):
-                bandwidth = int(line[8])
-                if bandwidth < 0.75 * limit:
-                    raise Exception(
-                        'Bandwidth is too low: {0}, limit is {1}'.format(
-                            bandwidth, limit))
-                assert bandwidth <= limit * 1.05
+                              time=80,
+                              interval=20,
+                              udp=False):
+        """Check bandwidth from client to server is close to limit
+
+        :raises: Exception if bandwidth is too low, AssertionError if it
+            exceeds limit
+        """
+        harness = iperf.IperfHarness(self.env, self.os_conn,
+                                     self.instance_keypair)
+        if udp:
+            harness.add_flow(client, server, UDP_PORT, ip_type=ip_type,
+                             udp=True, bandwidth='10M', time=time,
+                             interval=interval)
+        else:
+            harness.add_flow(client, server, TCP_PORT, ip_type=ip_type,
+                             time=time, interval=interval)
+        result, = harness.run()
+        if result.fraction_within(min_bw=0.75 * limit) < 0.95:
+            raise Exception(
+                'Bandwidth is too low: {0}, limit is {1}'.format(
+                    result.bandwidths(), limit))
+        result.assert_bandwidth(max_bw=limit * 1.05)
 
 
 @pytest.mark.check_env_('has_1_or_more_computes')
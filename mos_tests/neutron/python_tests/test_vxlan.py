@@ -12,105 +12,63 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-from contextlib import contextmanager
-from distutils.spawn import find_executable
 import logging
-import subprocess
-import threading
 
 import pytest
 
-from mos_tests.functions.common import gen_temp_file
+from mos_tests.functions import capture
 from mos_tests.functions import network_checks
+from mos_tests.functions import pcap
 from mos_tests.neutron.python_tests.base import TestBase
 
 
 logger = logging.getLogger(__name__)
 
 
-@contextmanager
-def tcpdump(ip, env, log_path, tcpdump_args):
-    """Start tcpdump on vxlan port before enter and stop it after
+def tcpdump(ip, env, bpf, interface='any'):
+    """Capture traffic on node while in context
 
-    Log will download to log_path argument
+    Packets are decoded on the fly, result is available as `capture`
+    attribute of returned RemoteCapture.
     """
-    def tcpdump(ip):
-        logger.info('Start tcpdump on {0}'.format(ip))
-        with env.get_ssh_to_node(ip) as remote:
-            result = remote.execute(
-                'tcpdump -U {0} -w /tmp/vxlan.log'.format(tcpdump_args))
-            assert result['exit_code'] == 0
-
-    thread = threading.Thread(target=tcpdump, args=(ip,))
-    try:
-        # Start tcpdump
-        thread.start()
-        yield
-    except Exception:
-        raise
-    else:
-        # Download log
-        with env.get_ssh_to_node(ip) as remote:
-            remote.download('/tmp/vxlan.log', log_path)
-    finally:
-        # Kill tcpdump
-        with env.get_ssh_to_node(ip) as remote:
-            remote.execute('killall tcpdump')
-        thread.join(0)
-
-
-def tcpdump_vxlan(ip, env, log_path):
-    """Start tcpdump on vxlan port before enter and stop it after
-
-    Log will download to log_path argument
-    """
-    return tcpdump(ip, env, log_path, '-U -vvni any port 4789')
+    return capture.capture(env, ip, bpf=bpf, interface=interface)
 
 
-def _run_tshark_on_vxlan(log_file, cond):
-    tshark = find_executable('tshark')
-    return subprocess.check_output([
-        tshark, '-d', 'udp.port==4789,vxlan', '-r', log_file,
-        '-Y', '{0}'.format(cond)])
+def tcpdump_vxlan(ip, env):
+    """Capture vxlan traffic on node while in context"""
+    return tcpdump(ip, env, bpf='port 4789')
 
 
-def check_all_traffic_has_vni(vni, log_file):
+def check_all_traffic_has_vni(vni, dump):
     __tracebackhide__ = True
-    output = _run_tshark_on_vxlan(log_file, 'vxlan.vni!={0}'.format(vni))
-    if output.strip():
-        pytest.fail(
-            "Log contains records with another VNI\n{0}".format(output))
+    packets = dump.capture.exclude_vni(vni)
+    if packets:
+        pytest.fail("Log contains records with another VNI\n{0}".format(
+            pcap.format_packets(packets)))
 
 
-def get_arp_traffic(src_ip, dst_ip, log_file):
-    cond = (
-        "arp.dst.proto_ipv4=={dst_ip} and "
-        "arp.src.proto_ipv4=={src_ip}".format(dst_ip=dst_ip, src_ip=src_ip))
-    return _run_tshark_on_vxlan(log_file, cond)
+def get_arp_traffic(src_ip, dst_ip, dump):
+    return dump.capture.filter(proto='arp', src=src_ip, dst=dst_ip)
 
 
-def check_no_arp_traffic(src_ip, dst_ip, log_file):
+def check_no_arp_traffic(src_ip, dst_ip, dump):
     __tracebackhide__ = True
-    output = get_arp_traffic(src_ip, dst_ip, log_file)
-    if output.strip():
-        pytest.fail("Log contains ARP traffic\n{0}".format(output))
+    packets = get_arp_traffic(src_ip, dst_ip, dump)
+    if packets:
+        pytest.fail("Log contains ARP traffic\n{0}".format(
+            pcap.format_packets(packets)))
 
 
-def check_arp_traffic(src_ip, dst_ip, log_file):
+def check_arp_traffic(src_ip, dst_ip, dump):
     __tracebackhide__ = True
-    output = get_arp_traffic(src_ip, dst_ip, log_file)
-    if not output.strip():
+    if not get_arp_traffic(src_ip, dst_ip, dump):
         pytest.fail("Log not contains ARP traffic")
 
 
-def check_icmp_traffic(src_ip, dst_ip, log_file):
+def check_icmp_traffic(src_ip, dst_ip, dump):
     __tracebackhide__ = True
-    cond = "icmp and ip.src=={src_ip} and ip.dst=={dst_ip}".format(
-        src_ip=src_ip,
-        dst_ip=dst_ip
-    )
-    output = _run_tshark_on_vxlan(log_file, cond)
-    if not output.strip():
+    packets = dump.capture.filter(proto='icmp', src=src_ip, dst=dst_ip)
+    if not packets:
         pytest.fail(
             "Log not contains ICMP traffic from {src_ip} to {dst_ip}".format(
                 src_ip=src_ip,
@@ -139,7 +97,6 @@ class TestVxlanBase(TestBase):
         return router
 
 
-@pytest.mark.requires_('tshark')
 class TestVxlan(TestVxlanBase):
     """Simple Vxlan tests"""
 
@@ -193,9 +150,7 @@ class TestVxlan(TestVxlanBase):
                 result = remote.execute('ovs-vsctl show | grep -q br-tun')
                 assert result['exit_code'] == 0
 
-        log_file = gen_temp_file(prefix='vxlan', suffix='.log')
-        with tcpdump_vxlan(ip=compute.data['ip'], env=self.env,
-                           log_path=log_file.name):
+        with tcpdump_vxlan(ip=compute.data['ip'], env=self.env) as dump:
             with self.env.get_ssh_to_node(controller.data['ip']) as remote:
                 vm_ip = self.os_conn.get_nova_instance_ips(server)['fixed']
                 result = remote.execute(
@@ -205,7 +160,7 @@ class TestVxlan(TestVxlanBase):
 
         # Check log
         vni = network['network']['provider:segmentation_id']
-        check_all_traffic_has_vni(vni, log_file.name)
+        check_all_traffic_has_vni(vni, dump)
 
     @pytest.mark.testrail_id('542632')
     @pytest.mark.check_env_('has_2_or_more_computes')
@@ -264,12 +219,8 @@ class TestVxlan(TestVxlanBase):
         # Start tcpdump
         compute1 = self.env.find_node_by_fqdn(compute_nodes[0])
         compute2 = self.env.find_node_by_fqdn(compute_nodes[1])
-        log_file1 = gen_temp_file(prefix='vxlan', suffix='.log')
-        log_file2 = gen_temp_file(prefix='vxlan', suffix='.log')
-        with tcpdump_vxlan(
-                ip=compute1.data['ip'], env=self.env,
-                log_path=log_file1.name), tcpdump_vxlan(
-                ip=compute2.data['ip'], env=self.env, log_path=log_file2.name):
+        ips = [compute1.data['ip'], compute2.data['ip']]
+        with capture.capture_many(self.env, ips, bpf='port 4789') as dumps:
             # Ping server1 from server2
             server1_ip = self.os_conn.get_nova_instance_ips(
                 server1).values()[0]
@@ -279,9 +230,9 @@ class TestVxlan(TestVxlanBase):
 
         # Check traffic
         check_all_traffic_has_vni(net1['provider:segmentation_id'],
-                                  log_file1.name)
+                                  dumps[ips[0]])
         check_all_traffic_has_vni(net2['provider:segmentation_id'],
-                                  log_file2.name)
+                                  dumps[ips[1]])
 
 
 @pytest.mark.check_env_('is_l2pop')
@@ -296,16 +247,15 @@ class TestVxlanL2pop(TestVxlanBase):
         """
 
     @pytest.mark.testrail_id(
-        '542633', params={'tcpdump_args': '-vvni any port 4789'})
+        '542633', params={'bpf': 'port 4789'})
     @pytest.mark.testrail_id(
-        '542637', params={'tcpdump_args': '-n src host {source_ip} -i any'})
-    @pytest.mark.requires_('tshark')
+        '542637', params={'bpf': 'src host {source_ip}'})
     @pytest.mark.check_env_('has_2_or_more_computes')
-    @pytest.mark.parametrize('tcpdump_args', [
-        '-vvni any port 4789',
-        '-n src host {source_ip} -i any'
+    @pytest.mark.parametrize('bpf', [
+        'port 4789',
+        'src host {source_ip}'
     ], ids=['filter by vxlan port', 'filter by source_ip'])
-    def test_broadcast_traffic_propagation(self, router, tcpdump_args):
+    def test_broadcast_traffic_propagation(self, router, bpf):
         """Check broadcast traffic propagation for network segments
 
         Scenario:
@@ -357,33 +307,27 @@ class TestVxlanL2pop(TestVxlanBase):
         compute2 = self.env.find_node_by_fqdn(compute_nodes[1])
 
         # Initiate broadcast traffic from server1 to server2
-        broadcast_log_file = gen_temp_file(prefix='broadcast', suffix='.log')
         with tcpdump(
             ip=compute2.data['ip'], env=self.env,
-            log_path=broadcast_log_file.name,
-            tcpdump_args=tcpdump_args.format(source_ip=server1_ip)
-        ):
+            bpf=bpf.format(source_ip=server1_ip)
+        ) as dump:
             cmd = 'sudo /usr/sbin/arping -I eth0 -c 4 {0}; true'.format(
                 server2_ip)
             network_checks.run_on_vm(self.env, self.os_conn, server1,
                                      self.instance_keypair, cmd)
 
-        check_no_arp_traffic(src_ip=server1_ip, dst_ip=server2_ip,
-                             log_file=broadcast_log_file.name)
+        check_no_arp_traffic(src_ip=server1_ip, dst_ip=server2_ip, dump=dump)
 
         # Initiate unicast traffic from server1 to server2
-        unicast_log_file = gen_temp_file(prefix='unicast', suffix='.log')
         with tcpdump(
             ip=compute2.data['ip'], env=self.env,
-            log_path=unicast_log_file.name,
-            tcpdump_args=tcpdump_args.format(source_ip=server1_ip)
-        ):
+            bpf=bpf.format(source_ip=server1_ip)
+        ) as dump:
             cmd = 'ping -c 4 {0}; true'.format(server2_ip)
             network_checks.run_on_vm(self.env, self.os_conn, server1,
                                      self.instance_keypair, cmd)
 
-        check_icmp_traffic(src_ip=server1_ip, dst_ip=server2_ip,
-                           log_file=unicast_log_file.name)
+        check_icmp_traffic(src_ip=server1_ip, dst_ip=server2_ip, dump=dump)
 
     @pytest.mark.testrail_id('542636')
     @pytest.mark.check_env_('has_3_or_more_computes')
@@ -513,7 +457,6 @@ class TestVxlanL2pop(TestVxlanBase):
                 assert any([x in stdout for x in compute3.ip_list])
 
     @pytest.mark.testrail_id('542638')
-    @pytest.mark.requires_('tshark')
     @pytest.mark.check_env_('has_2_or_more_computes')
     def test_broadcast_traffic_propagation_single_net(self, router):
         """Check broadcast traffic between instances placed in a single
@@ -565,36 +508,29 @@ class TestVxlanL2pop(TestVxlanBase):
         server2_port = self.os_conn.get_port_by_fixed_ip(server2_ip)
         server2_tap = 'tap{}'.format(server2_port['id'][:11])
         # Initiate broadcast traffic from server1 to server2
-        broadcast_log_file = gen_temp_file(prefix='broadcast', suffix='.log')
         with tcpdump(
             ip=compute2.data['ip'], env=self.env,
-            log_path=broadcast_log_file.name,
-            tcpdump_args=' -n src host {ip} -i {interface}'.format(
-                ip=server1_ip,
-                interface=server2_tap,)
-        ):
+            bpf='src host {0}'.format(server1_ip),
+            interface=server2_tap
+        ) as dump:
             cmd = 'sudo /usr/sbin/arping -I eth0 -c 4 {0}; true'.format(
                 server2_ip)
             network_checks.run_on_vm(self.env, self.os_conn, server1,
                                      self.instance_keypair, cmd)
 
-        check_arp_traffic(src_ip=server1_ip, dst_ip=server2_ip,
-                          log_file=broadcast_log_file.name)
+        check_arp_traffic(src_ip=server1_ip, dst_ip=server2_ip, dump=dump)
 
         server3_port = self.os_conn.get_port_by_fixed_ip(server3_ip)
         server3_tap = 'tap{}'.format(server3_port['id'][:11])
         # Initiate broadcast traffic from server1 to server3
         with tcpdump(
             ip=compute2.data['ip'], env=self.env,
-            log_path=broadcast_log_file.name,
-            tcpdump_args=' -n src host {ip} -i {interface}'.format(
-                ip=server1_ip,
-                interface=server3_tap,)
-        ):
+            bpf='src host {0}'.format(server1_ip),
+            interface=server3_tap
+        ) as dump:
             cmd = 'sudo /usr/sbin/arping -I eth0 -c 4 {0}; true'.format(
                 server2_ip)
             network_checks.run_on_vm(self.env, self.os_conn, server1,
                                      self.instance_keypair, cmd)
 
-        check_no_arp_traffic(src_ip=server1_ip, dst_ip=server2_ip,
-                             log_file=broadcast_log_file.name)
+        check_no_arp_traffic(src_ip=server1_ip, dst_ip=server2_ip, dump=dump)
@@ -17,7 +17,6 @@ import pytest
 import re
 
 from mos_tests.functions import common
-from mos_tests.functions import file_cache
 from mos_tests.nfv.base import page_1gb
 from mos_tests.nfv.base import page_2mb
 from mos_tests.settings import UBUNTU_QCOW2_URL
@@ -345,11 +344,8 @@ def get_hp_distribution_per_numa_node(env, numa_count=1):
 
 @pytest.fixture
 def ubuntu_image_id(os_conn, cleanup):
-    image = os_conn.glance.images.create(
-        name="image_ubuntu", url=UBUNTU_QCOW2_URL, disk_format='qcow2',
-        container_format='bare')
-    with file_cache.get_file(UBUNTU_QCOW2_URL) as f:
-        os_conn.glance.images.upload(image.id, f)
+    image = os_conn.provision_image(UBUNTU_QCOW2_URL, "image_ubuntu",
+                                    url=UBUNTU_QCOW2_URL)
     return image.id
 
 
@@ -17,7 +17,6 @@ import logging
 import dpath.util
 import pytest
 
-from mos_tests.functions import file_cache
 from mos_tests.functions import network_checks
 from mos_tests.nfv.base import page_1gb
 from mos_tests.nfv.base import page_2mb
@@ -43,14 +42,10 @@ def nova_ceph(env):
 
 @pytest.yield_fixture
 def ubuntu_image_id(os_conn):
-    image = os_conn.glance.images.create(name="image_ubuntu",
-                                         url=UBUNTU_QCOW2_URL,
-                                         disk_format='qcow2',
-                                         container_format='bare')
-    with file_cache.get_file(UBUNTU_QCOW2_URL) as f:
-        os_conn.glance.images.upload(image.id, f)
+    image = os_conn.provision_image(UBUNTU_QCOW2_URL, "image_ubuntu",
+                                    url=UBUNTU_QCOW2_URL)
     yield image.id
-    os_conn.glance.images.delete(image.id)
+    os_conn.release_image(image.id)
 
 
 def check_vm_connectivity_cirros_ubuntu(env, os_conn, keypair, cirros, ubuntu):
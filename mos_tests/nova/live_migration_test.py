@@ -22,7 +22,6 @@ import pytest
 from six.moves import configparser
 
 from mos_tests.functions import common
-from mos_tests.functions import file_cache
 from mos_tests.functions import service
 from mos_tests import settings
 
@@ -124,15 +123,11 @@ def block_migration(env, request):
 @pytest.yield_fixture(scope='module')
 def ubuntu_image_id(os_conn):
     logger.info('Creating ubuntu image')
-    image = os_conn.glance.images.create(name="image_ubuntu",
-                                         disk_format='qcow2',
-                                         container_format='bare')
-    with file_cache.get_file(settings.UBUNTU_QCOW2_URL) as f:
-        os_conn.glance.images.upload(image.id, f)
-
+    image = os_conn.provision_image(settings.UBUNTU_QCOW2_URL,
+                                    "image_ubuntu")
     logger.info('Ubuntu image created')
     yield image.id
-    os_conn.glance.images.delete(image.id)
+    os_conn.release_image(image.id)
 
 
 @pytest.yield_fixture
@@ -180,9 +175,9 @@ class TestLiveMigrationBase(object):
             assert len(create_args) == instances_count
         else:
             create_args = [{}] * instances_count
+        specs = []
         for i in range(instances_count):
-            kwargs = create_args[i]
-            instance = self.os_conn.create_server(
+            spec = dict(
                 name='server%02d' % i,
                 image_id=image_id,
                 userdata=userdata,
@@ -190,12 +185,12 @@ class TestLiveMigrationBase(object):
                 availability_zone=zone,
                 key_name=self.keypair.name,
                 nics=[{'net-id': self.network['network']['id']}],
-                security_groups=[self.security_group.id],
-                wait_for_active=False,
-                wait_for_avaliable=False,
-                **kwargs)
-            self.instances.append(instance)
-        self.os_conn.wait_servers_active(self.instances)
+                security_groups=[self.security_group.id])
+            spec.update(create_args[i])
+            specs.append(spec)
+        instances = self.os_conn.create_servers_bulk(
+            specs, wait_for_active=True, wait_for_avaliable=False)
+        self.instances.extend(instances)
 
         if userdata is None:
             self.os_conn.wait_servers_ssh_ready(self.instances)
@@ -16,7 +16,6 @@ import logging
 
 import pytest
 
-from mos_tests.functions import file_cache
 from mos_tests import settings
 
 logger = logging.getLogger(__name__)
@@ -26,15 +25,11 @@ pytestmark = pytest.mark.undestructive
 @pytest.yield_fixture
 def ubuntu_image_id(os_conn):
     logger.info('Creating ubuntu image')
-    image = os_conn.glance.images.create(name="image_ubuntu",
-                                         disk_format='qcow2',
-                                         container_format='bare')
-    with file_cache.get_file(settings.UBUNTU_QCOW2_URL) as f:
-        os_conn.glance.images.upload(image.id, f)
-
+    image = os_conn.provision_image(settings.UBUNTU_QCOW2_URL,
+                                    "image_ubuntu")
     logger.info('Ubuntu image created')
     yield image.id
-    os_conn.glance.images.delete(image.id)
+    os_conn.release_image(image.id)
 
 
 @pytest.yield_fixture
@@ -27,7 +27,6 @@ from six.moves import configparser
 from mos_tests.environment.ssh import SSHClient
 from mos_tests.functions.base import OpenStackTestCase
 from mos_tests.functions import common as common_functions
-from mos_tests.functions import file_cache
 from mos_tests.functions import network_checks
 from mos_tests.functions import service
 from mos_tests.neutron.python_tests.base import TestBase
@@ -881,14 +880,11 @@ class TestBugVerification(TestBase):
     @pytest.yield_fixture
     def ubuntu_image_id(self, os_conn):
         logger.info('Creating ubuntu image')
-        image = os_conn.glance.images.create(name="image_ubuntu",
-                                             disk_format='qcow2',
-                                             container_format='bare')
-        with file_cache.get_file(settings.UBUNTU_QCOW2_URL) as f:
-            os_conn.glance.images.upload(image.id, f)
+        image = os_conn.provision_image(settings.UBUNTU_QCOW2_URL,
+                                        "image_ubuntu")
         logger.info('Ubuntu image created')
         yield image.id
-        os_conn.glance.images.delete(image.id)
+        os_conn.release_image(image.id)
 
     @pytest.yield_fixture
     def flavors(self, os_conn):
@@ -35,6 +35,11 @@ PUBLIC_TEST_IP = os.environ.get('PUBLIC_TEST_IP', '8.8.8.8')
 
 # Path to folder with required images
 TEST_IMAGE_PATH = os.environ.get("TEST_IMAGE_PATH", os.path.expanduser('~/images'))  # noqa
+# Max size of images cache in GiB (least recently used images are removed)
+TEST_IMAGE_CACHE_SIZE = float(os.environ.get('TEST_IMAGE_CACHE_SIZE', 50))
+# Count of parallel connections to download one image
+TEST_IMAGE_DOWNLOAD_THREADS = int(os.environ.get(
+    'TEST_IMAGE_DOWNLOAD_THREADS', 4))
 UBUNTU_QCOW2_URL = 'https://cloud-images.ubuntu.com/trusty/current/trusty-server-cloudimg-amd64-disk1.img'  # noqa
 FEDORA_QCOW2_URL = 'https://download.fedoraproject.org/pub/fedora/linux/releases/23/Cloud/x86_64/Images/Fedora-Cloud-Base-23-20151030.x86_64.qcow2'  # noqa
 WIN_SERVER_QCOW2 = 'windows_server_2012_r2_standard_eval_kvm_20140607.qcow2'
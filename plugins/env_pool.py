@@ -0,0 +1,384 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import namedtuple
+from collections import OrderedDict
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import pytest
+
+logger = logging.getLogger(__name__)
+
+__doc__ = """This module allows to run tests on several envs with xdist.
+
+Each xdist worker leases its own env from pool:
+
+    py.test mos_tests -n 3 --env-pool envA,envB:snapshot2,envC@10.109.0.2
+
+Pool entry format is `env_name[:snapshot_name][@fuel_master_ip]`. Without
+xdist tests run on the first env of pool.
+
+Tests are distributed between workers with respect to `check_env_` guards:
+each worker evaluates guards for its env (with `config.env_guards_evaluator`
+callable, defined by conftest) and tests are sent to workers, which envs
+satisfy them. Tests of one class (or module) go to one worker in collection
+order, so class fixtures and incremental tests work as usual.
+
+With `--durations-file` (JSON {nodeid: seconds}, exported by
+`tools/timing_report.py export`) workers are balanced by expected time
+instead of tests count, the longest classes are assigned first.
+"""
+
+EnvSpec = namedtuple('EnvSpec', ['name', 'snapshot', 'fuel_ip'])
+
+
+def pytest_addoption(parser):
+    parser.addoption("--env-pool", action="store",
+                     help="Comma separated list of devops envs to run tests "
+                          "on, in `env_name[:snapshot][@fuel_ip]` format. "
+                          "Each xdist worker leases own env")
+    parser.addoption("--durations-file", action="store",
+                     help="JSON file with expected tests durations to "
+                          "balance env pool workers by time")
+
+
+def parse_env_spec(text):
+    text, _, fuel_ip = text.strip().partition('@')
+    name, _, snapshot = text.partition(':')
+    return EnvSpec(name, snapshot or None, fuel_ip or None)
+
+
+def get_pool(config):
+    value = config.getoption('--env-pool')
+    if not value:
+        return []
+    return [parse_env_spec(x) for x in value.split(',') if x.strip()]
+
+
+def get_worker_input(config):
+    return getattr(config, 'workerinput', getattr(config, 'slaveinput', None))
+
+
+def get_leased_env(config):
+    """Return EnvSpec of env leased by current process or None"""
+    pool = get_pool(config)
+    if not pool:
+        return None
+    worker_input = get_worker_input(config)
+    if worker_input is None or 'env_pool_lease' not in worker_input:
+        return pool[0]
+    return EnvSpec(*worker_input['env_pool_lease'])
+
+
+def get_block_key(nodeid):
+    """Return class (or module) part of test nodeid"""
+    if '::()' in nodeid:
+        return nodeid.split('::()')[0]
+    return nodeid.rsplit('::', 1)[0]
+
+
+def load_durations(path):
+    """Return dict {nodeid: seconds} from durations file"""
+    if not path:
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError) as e:
+        logger.warning("Can't read tests durations: {0}".format(e))
+        return {}
+
+
+def get_guards(item):
+    marker = item.keywords.get('check_env_')
+    if marker is None:
+        return ()
+    return tuple(marker.args)
+
+
+def get_node_env(node):
+    """Return key of env leased by xdist worker (gateway id if unknown)"""
+    worker_input = getattr(node, 'workerinput',
+                           getattr(node, 'slaveinput', None)) or {}
+    lease = worker_input.get('env_pool_lease')
+    if lease is None:
+        return (node.gateway.id,)
+    return tuple(lease)
+
+
+def pytest_configure(config):
+    if not get_pool(config):
+        return
+    worker_input = get_worker_input(config)
+    if worker_input is not None:
+        config.pluginmanager.register(WorkerEnvPool(config, worker_input),
+                                      'env_pool_worker')
+    elif config.pluginmanager.hasplugin('xdist'):
+        config.pluginmanager.register(MasterEnvPool(config),
+                                      'env_pool_master')
+
+
+class WorkerEnvPool(object):
+    """Writes tests, which can be run on worker env, for master"""
+
+    def __init__(self, config, worker_input):
+        self.config = config
+        self.path = os.path.join(
+            worker_input['env_pool_dir'],
+            '{0}.json'.format(worker_input['workerid']))
+
+    def _evaluate(self, guards):
+        evaluator = getattr(self.config, 'env_guards_evaluator', None)
+        if evaluator is None or not guards:
+            return True
+        try:
+            return bool(evaluator(guards))
+        except Exception as e:
+            logger.warning('Guards {0} evaluation failed: {1}'.format(guards,
+                                                                      e))
+            return True
+
+    @pytest.hookimpl(trylast=True)
+    def pytest_collection_modifyitems(self, session, config, items):
+        results = {}
+        runnable = {}
+        for item in items:
+            guards = get_guards(item)
+            if guards not in results:
+                results[guards] = self._evaluate(guards)
+            runnable[item.nodeid] = results[guards]
+        with open(self.path, 'w') as f:
+            json.dump(runnable, f)
+
+
+class MasterEnvPool(object):
+    """Leases envs to xdist workers and creates env aware scheduler"""
+
+    def __init__(self, config):
+        self.config = config
+        self.pool = get_pool(config)
+        self.dir = tempfile.mkdtemp(prefix='env_pool_')
+        # {gateway id: pool index}
+        self.leases = {}
+
+    def pytest_configure_node(self, node):
+        leased = set(self.leases.values())
+        free = [x for x in range(len(self.pool)) if x not in leased]
+        if not free:
+            raise pytest.UsageError(
+                'There are more xdist workers than envs in pool '
+                '({0})'.format(len(self.pool)))
+        index = free[0]
+        self.leases[node.gateway.id] = index
+        worker_input = getattr(node, 'workerinput',
+                               getattr(node, 'slaveinput', None))
+        worker_input['env_pool_lease'] = list(self.pool[index])
+        worker_input['env_pool_dir'] = self.dir
+        logger.info('{0} leases env {1}'.format(node.gateway.id,
+                                                self.pool[index]))
+
+    def pytest_testnodedown(self, node, error):
+        # env of finished (or crashed) worker is handed to replacement one
+        index = self.leases.pop(node.gateway.id, None)
+        if index is not None:
+            logger.info('{0} releases env {1}'.format(node.gateway.id,
+                                                      self.pool[index]))
+
+    def pytest_xdist_make_scheduler(self, config, log):
+        return EnvAwareScheduling(config, self.dir, log=log)
+
+    def pytest_unconfigure(self, config):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def get_numnodes(config):
+    try:
+        from xdist.workermanage import parse_tx_spec_config
+    except ImportError:
+        try:
+            from xdist.workermanage import parse_spec_config as \
+                parse_tx_spec_config
+        except ImportError:
+            from xdist.slavemanage import parse_spec_config as \
+                parse_tx_spec_config
+    return len(parse_tx_spec_config(config))
+
+
+class EnvAwareScheduling(object):
+    """Static xdist scheduling with respect to workers envs abilities
+
+    Tests are grouped by class (or module). Each group is assigned to
+    the least loaded worker, which env can run all group tests (groups
+    with fewer suitable workers are assigned first, the longest ones first
+    among them). Load is measured by expected tests durations, tests
+    without known duration count as average one (or as 1, if no durations
+    are known). All tests are sent to workers at once in collection order.
+
+    Tests, which are returned by worker or left by crashed one, are queued
+    to pending list of their env and sent to worker with this env (to
+    replacement worker, if there is no other one), re-queued tests
+    (`mark_test_pending`) go to the least loaded suitable env.
+    """
+
+    durations = {}
+
+    def __init__(self, config, workdir, log=None):
+        self.config = config
+        self.workdir = workdir
+        self.log = log
+        self.numnodes = get_numnodes(config)
+        self.durations = load_durations(config.getoption('--durations-file'))
+        self.node2collection = OrderedDict()
+        self.node2pending = OrderedDict()
+        self.env2pending = OrderedDict()
+        self.runnable = {}
+        self.collection = None
+
+    @property
+    def nodes(self):
+        return list(self.node2pending.keys())
+
+    @property
+    def collection_is_completed(self):
+        return len(self.node2collection) >= self.numnodes
+
+    @property
+    def tests_finished(self):
+        if not self.collection_is_completed or any(self.env2pending.values()):
+            return False
+        return all(len(x) < 2 for x in self.node2pending.values())
+
+    @property
+    def has_pending(self):
+        return (any(self.node2pending.values()) or
+                any(self.env2pending.values()))
+
+    def add_node(self, node):
+        self.node2pending[node] = []
+
+    def add_node_collection(self, node, collection):
+        self.node2collection[node] = list(collection)
+
+    def mark_test_complete(self, node, item_index, duration=0):
+        self.node2pending[node].remove(item_index)
+
+    def mark_test_pending(self, item):
+        index = self.collection.index(item)
+        collected = [x for x in self.nodes if x in self.node2collection]
+        nodes = [x for x in collected
+                 if self._load_runnable(x).get(item, True)]
+        node = min(nodes or collected,
+                   key=lambda x: len(self.node2pending[x]))
+        self.env2pending.setdefault(get_node_env(node), []).append(index)
+        self.send_pending()
+
+    def remove_pending_tests_from_node(self, node, indices):
+        pending = self.node2pending[node]
+        for index in indices:
+            pending.remove(index)
+        self.env2pending.setdefault(get_node_env(node), []).extend(indices)
+        self.send_pending()
+
+    def remove_node(self, node):
+        pending = self.node2pending.pop(node)
+        self.runnable.pop(node, None)
+        if not pending:
+            return None
+        # the first pending test crashed worker, others wait for worker with
+        # same env
+        self.env2pending.setdefault(get_node_env(node), []).extend(
+            pending[1:])
+        self.send_pending()
+        return self.collection[pending[0]]
+
+    def send_pending(self):
+        """Send tests from env pending lists to workers with these envs"""
+        for env, indices in self.env2pending.items():
+            nodes = [x for x in self.nodes
+                     if x in self.node2collection and get_node_env(x) == env]
+            if not indices or not nodes:
+                continue
+            node = min(nodes, key=lambda x: len(self.node2pending[x]))
+            self.node2pending[node].extend(indices)
+            node.send_runtest_some(list(indices))
+            del indices[:]
+
+    def _load_runnable(self, node):
+        if node in self.runnable:
+            return self.runnable[node]
+        path = os.path.join(self.workdir,
+                            '{0}.json'.format(node.gateway.id))
+        try:
+            with open(path) as f:
+                self.runnable[node] = json.load(f)
+        except (IOError, ValueError):
+            logger.warning("Can't read env abilities of {0}".format(
+                node.gateway.id))
+            self.runnable[node] = {}
+        return self.runnable[node]
+
+    def assign(self):
+        """Return dict {node: list of test indices}"""
+        runnable = {node: self._load_runnable(node) for node in self.nodes}
+        blocks = OrderedDict()
+        for index, nodeid in enumerate(self.collection):
+            blocks.setdefault(get_block_key(nodeid), []).append(index)
+
+        if self.durations:
+            default = sum(self.durations.values()) / len(self.durations)
+        else:
+            default = 1
+        weights = {key: sum(self.durations.get(self.collection[x], default)
+                            for x in indices)
+                   for key, indices in blocks.items()}
+
+        candidates = {}
+        for key, indices in blocks.items():
+            nodes = [node for node in self.nodes
+                     if all(runnable[node].get(self.collection[x], True)
+                            for x in indices)]
+            candidates[key] = nodes or self.nodes
+
+        assigned = {node: [] for node in self.nodes}
+        load = {node: 0 for node in self.nodes}
+        for key in sorted(blocks, key=lambda x: (len(candidates[x]),
+                                                 -weights[x])):
+            node = min(candidates[key], key=lambda x: load[x])
+            assigned[node].extend(blocks[key])
+            load[node] += weights[key]
+        return {node: sorted(indices) for node, indices in assigned.items()}
+
+    def schedule(self):
+        assert self.collection_is_completed
+        nodes = [x for x in self.nodes if x in self.node2collection]
+        scheduled = self.collection is not None
+        if not scheduled:
+            self.collection = self.node2collection[nodes[0]]
+        if any(self.node2collection[x] != self.collection for x in nodes):
+            raise pytest.UsageError('Different tests were collected by '
+                                    'xdist workers')
+        if scheduled:
+            # replacement worker is added, tests are already assigned
+            self.send_pending()
+            return
+        for node, indices in self.assign().items():
+            logger.info('{0} runs {1} tests'.format(node.gateway.id,
+                                                    len(indices)))
+            self.node2pending[node] = indices
+            if indices:
+                node.send_runtest_some(indices)
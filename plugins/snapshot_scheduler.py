@@ -0,0 +1,176 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import logging
+
+import pytest
+
+logger = logging.getLogger(__name__)
+
+__doc__ = """This module reorders tests to reduce count of snapshot reverts.
+
+Tests without `undestructive` mark are followed by devops snapshot revert.
+With `--schedule-snapshots` option tests are reordered:
+
+    * undestructive tests run first as one block on fresh snapshot;
+    * destructive tests are grouped by `check_env_` guards, so tests, which
+      will be skipped on current env, go together.
+
+Tests of one class (or module, for tests without class) with same kind are
+moved together to keep class/module fixtures reuse. Classes marked as
+`incremental` are never split.
+
+The plan (`session.snapshot_plan`) also tells, if revert after test can be
+skipped. Test leaves env intact, if it is undestructive or it will be
+skipped: by `skip`/`skipif` mark or by failed `check_env_` guards (they are
+evaluated with `config.env_guards_evaluator` callable, defined by conftest).
+Revert is needed only after test, which changes env, and only if some
+runnable test follows it.
+"""
+
+
+def pytest_addoption(parser):
+    parser.addoption("--schedule-snapshots", action="store_true",
+                     help="Reorder tests to reduce count of snapshot "
+                          "reverts")
+    parser.addoption("--revert-cost", action="store", type=float,
+                     default=5 * 60,
+                     help="Estimated time of snapshot revert (with env "
+                          "readiness checks) in seconds")
+
+
+def is_destructive(item):
+    return 'undestructive' not in item.keywords
+
+
+def get_guards(item):
+    marker = item.keywords.get('check_env_')
+    if marker is None:
+        return ()
+    return tuple(sorted(marker.args))
+
+
+class GuardsResults(object):
+    """Memoized `check_env_` guards results
+
+    :param evaluator: callable, which returns guards result on env (or None
+        to treat all guards as passed)
+    """
+
+    def __init__(self, evaluator=None):
+        self.evaluator = evaluator
+        self._results = {}
+
+    def passed(self, item):
+        guards = get_guards(item)
+        if not guards or self.evaluator is None:
+            return True
+        if guards not in self._results:
+            try:
+                self._results[guards] = bool(self.evaluator(guards))
+            except Exception as e:
+                logger.warning('Guards {0} evaluation failed: {1}'.format(
+                    guards, e))
+                self._results[guards] = True
+        return self._results[guards]
+
+
+def is_skipped(item):
+    """Check that item is skipped by `skip` or `skipif` mark with bool"""
+    if item.keywords.get('skip') is not None:
+        return True
+    marker = item.keywords.get('skipif')
+    if marker is None:
+        return False
+    return any(x is True for x in marker.args)
+
+
+def get_block_key(item):
+    """Return key of tests, which should be kept together"""
+    cls = getattr(item, 'cls', None)
+    if cls is not None and 'incremental' in item.keywords:
+        return (item.module.__name__, cls.__name__)
+    owner = cls.__name__ if cls is not None else None
+    return (item.module.__name__, owner, is_destructive(item),
+            get_guards(item))
+
+
+def count_reverts(items, guards=None):
+    """Return count of reverts needed to run items in given order"""
+    plan = SnapshotPlan(items, guards=guards)
+    return len([x for x in items if plan.needs_revert_after(x)])
+
+
+class SnapshotPlan(object):
+    """Ordered tests with snapshot reverts info
+
+    :param guards: GuardsResults (all guards are treated as passed if None)
+    """
+
+    def __init__(self, items, guards=None):
+        self.items = list(items)
+        self.guards = guards or GuardsResults()
+        self._need_revert = set()
+        # revert is needed only after test, which changes env, and only if
+        # some runnable test follows it
+        runnable_after = False
+        for item in reversed(self.items):
+            runnable = self.is_runnable(item)
+            if runnable and runnable_after and is_destructive(item):
+                self._need_revert.add(item.nodeid)
+            if runnable:
+                runnable_after = True
+
+    def is_runnable(self, item):
+        return not is_skipped(item) and self.guards.passed(item)
+
+    def needs_revert_after(self, item):
+        return item.nodeid in self._need_revert
+
+
+def schedule(items):
+    """Return items in new order"""
+    blocks = []
+    blocks_by_key = {}
+    for item in items:
+        key = get_block_key(item)
+        if key not in blocks_by_key:
+            blocks_by_key[key] = []
+            blocks.append(blocks_by_key[key])
+        blocks_by_key[key].append(item)
+
+    def sort_key(block):
+        first = block[0]
+        destructive = any(is_destructive(x) for x in block)
+        return (destructive, get_guards(first) if destructive else ())
+
+    blocks.sort(key=sort_key)
+    return [item for block in blocks for item in block]
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_collection_modifyitems(session, config, items):
+    guards = GuardsResults(getattr(config, 'env_guards_evaluator', None))
+    if config.getoption('--schedule-snapshots'):
+        before = count_reverts(items, guards=guards)
+        items[:] = schedule(items)
+        after = count_reverts(items, guards=guards)
+        saving = (before - after) * config.getoption('--revert-cost')
+        msg = ('snapshot schedule: {0} reverts instead of {1}, estimated '
+               'saving is {2:.0f}s'.format(after, before, saving))
+        logger.info(msg)
+        reporter = config.pluginmanager.getplugin('terminalreporter')
+        if reporter is not None:
+            reporter.write_line(msg)
+    session.snapshot_plan = SnapshotPlan(items, guards=guards)
@@ -0,0 +1,144 @@
+from collections import OrderedDict
+import json
+
+from plugins.env_pool import EnvAwareScheduling
+from plugins.env_pool import MasterEnvPool
+
+pytest_plugins = "pytester"
+
+
+def test_first_env_leased_without_xdist(testdir):
+    testdir.makepyfile("""
+        from plugins.env_pool import get_leased_env
+
+        def test_a(request):
+            leased = get_leased_env(request.config)
+            assert leased.name == 'envA'
+            assert leased.snapshot == 'snap'
+            assert leased.fuel_ip is None
+    """)
+    result = testdir.runpytest("-p", "plugins.env_pool",
+                               "--env-pool", "envA:snap,envB@10.0.0.2")
+    assert result.ret == 0
+
+
+class FakeGateway(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeNode(object):
+    def __init__(self, id, env=None):
+        self.gateway = FakeGateway(id)
+        self.workerinput = {}
+        if env is not None:
+            self.workerinput['env_pool_lease'] = [env, None, None]
+        self.sent = []
+
+    def send_runtest_some(self, indices):
+        self.sent.extend(indices)
+
+
+def test_tests_assigned_to_envs_which_can_run_them(tmpdir):
+    collection = ['a.py::TestA::test_1', 'a.py::TestA::test_2',
+                  'b.py::test_1', 'b.py::test_2', 'c.py::test_1']
+    runnable = {
+        'gw0': {'a.py::TestA::test_1': False},
+        'gw1': {'b.py::test_2': False},
+    }
+    for worker, data in runnable.items():
+        tmpdir.join('{0}.json'.format(worker)).write(json.dumps(data))
+    sched = object.__new__(EnvAwareScheduling)
+    sched.workdir = str(tmpdir)
+    sched.node2pending = {}
+    sched.runnable = {}
+    nodes = [FakeNode(x) for x in sorted(runnable)]
+    for node in nodes:
+        sched.node2pending[node] = []
+    sched.collection = collection
+
+    assigned = sched.assign()
+
+    assert assigned[nodes[0]] == [2, 3, 4]
+    assert assigned[nodes[1]] == [0, 1]
+
+
+def make_scheduler(tmpdir, nodes, collection, runnable=None):
+    for node in nodes:
+        data = (runnable or {}).get(node.gateway.id, {})
+        tmpdir.join('{0}.json'.format(node.gateway.id)).write(
+            json.dumps(data))
+    sched = object.__new__(EnvAwareScheduling)
+    sched.workdir = str(tmpdir)
+    sched.numnodes = len(nodes)
+    sched.durations = {}
+    sched.node2collection = OrderedDict()
+    sched.node2pending = OrderedDict()
+    sched.env2pending = OrderedDict()
+    sched.runnable = {}
+    sched.collection = None
+    for node in nodes:
+        sched.add_node(node)
+        sched.add_node_collection(node, collection)
+    sched.schedule()
+    return sched
+
+
+def test_tests_of_crashed_worker_go_to_replacement(tmpdir):
+    collection = ['a.py::test_1', 'a.py::test_2', 'a.py::test_3',
+                  'b.py::test_1']
+    nodes = [FakeNode('gw0', 'envA'), FakeNode('gw1', 'envB')]
+    sched = make_scheduler(tmpdir, nodes, collection,
+                           runnable={'gw1': {'a.py::test_1': False}})
+    assert nodes[0].sent == [0, 1, 2]
+    sched.mark_test_complete(nodes[0], 0)
+
+    crashed = sched.remove_node(nodes[0])
+
+    assert crashed == 'a.py::test_2'
+    assert nodes[1].sent == [3]
+    assert not sched.tests_finished
+    replacement = FakeNode('gw2', 'envA')
+    tmpdir.join('gw2.json').write('{}')
+    sched.add_node(replacement)
+    sched.add_node_collection(replacement, collection)
+    sched.schedule()
+    assert replacement.sent == [2]
+    assert sched.node2pending[replacement] == [2]
+
+
+def test_returned_and_requeued_tests_are_sent_again(tmpdir):
+    collection = ['a.py::test_1', 'a.py::test_2', 'b.py::test_1']
+    nodes = [FakeNode('gw0', 'envA'), FakeNode('gw1', 'envB')]
+    sched = make_scheduler(tmpdir, nodes, collection,
+                           runnable={'gw1': {'a.py::test_1': False,
+                                             'a.py::test_2': False}})
+    assert nodes[0].sent == [0, 1]
+    assert nodes[1].sent == [2]
+
+    sched.remove_pending_tests_from_node(nodes[0], [1])
+    assert nodes[0].sent == [0, 1, 1]
+    assert sched.node2pending[nodes[0]] == [0, 1]
+
+    sched.mark_test_complete(nodes[1], 2)
+    sched.mark_test_pending('a.py::test_1')
+    assert nodes[0].sent == [0, 1, 1, 0]
+    assert sched.node2pending[nodes[0]] == [0, 1, 0]
+
+
+def test_env_of_crashed_worker_is_leased_to_replacement(testdir):
+    config = testdir.parseconfig("-p", "plugins.env_pool",
+                                 "--env-pool", "envA,envB")
+    pool = MasterEnvPool(config)
+    nodes = [FakeNode('gw0'), FakeNode('gw1')]
+    for node in nodes:
+        pool.pytest_configure_node(node)
+    assert [x.workerinput['env_pool_lease'][0] for x in nodes] == ['envA',
+                                                                   'envB']
+
+    pool.pytest_testnodedown(nodes[0], error='crashed')
+    replacement = FakeNode('gw2')
+    pool.pytest_configure_node(replacement)
+
+    assert replacement.workerinput['env_pool_lease'][0] == 'envA'
+    pool.pytest_unconfigure(config)
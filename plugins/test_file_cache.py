@@ -0,0 +1,134 @@
+from contextlib import contextmanager
+import hashlib
+from multiprocessing.pool import ThreadPool
+import re
+import threading
+
+import pytest
+from six.moves import BaseHTTPServer
+
+from mos_tests.functions import file_cache
+
+
+class FileServer(BaseHTTPServer.HTTPServer):
+    """HTTP server with one file, which supports range requests"""
+
+    def __init__(self, content):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FileHandler)
+        self.content = content
+        self.requests = []
+        # ranges starts, which should fail once
+        self.fail_ranges = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/file.img'.format(self.server_port)
+
+    def gets(self):
+        return [x for x in self.requests if x[0] == 'GET']
+
+
+class FileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _headers(self, code, length):
+        self.send_response(code)
+        self.send_header('Content-Length', str(length))
+        self.send_header('ETag', '"v1"')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_HEAD(self):
+        with self.server.lock:
+            self.server.requests.append(('HEAD', None))
+        self._headers(200, len(self.server.content))
+
+    def do_GET(self):
+        content = self.server.content
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        start = end = None
+        if match is not None:
+            start = int(match.group(1))
+            end = int(match.group(2) or len(content) - 1)
+        with self.server.lock:
+            self.server.requests.append(('GET', start))
+            fail = start in self.server.fail_ranges
+            self.server.fail_ranges.discard(start)
+        if fail:
+            self._headers(500, 0)
+        elif start is None:
+            self._headers(200, len(content))
+            self.wfile.write(content)
+        else:
+            self._headers(206, end - start + 1)
+            self.wfile.write(content[start:end + 1])
+
+
+@contextmanager
+def serve(content):
+    server = FileServer(content)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def content():
+    return b''.join(bytes(bytearray([x % 256])) * 1024 for x in range(10))
+
+
+def test_concurrent_gets_download_once(tmpdir, content):
+    cache = file_cache.FileCache(str(tmpdir), threads=1)
+    with serve(content) as server:
+        pool = ThreadPool(5)
+        try:
+            paths = pool.map(lambda x: cache.get(server.url), range(5))
+        finally:
+            pool.close()
+            pool.join()
+        assert len(server.gets()) == 1
+    assert len(set(paths)) == 1
+    with open(paths[0], 'rb') as f:
+        assert f.read() == content
+
+
+def test_interrupted_ranges_download_is_resumed(tmpdir, content,
+                                                monkeypatch):
+    monkeypatch.setattr(file_cache, 'RANGE_SIZE', 2048)
+    cache = file_cache.FileCache(str(tmpdir), threads=2)
+    with serve(content) as server:
+        server.fail_ranges.add(4096)
+        with pytest.raises(IOError):
+            cache.get(server.url)
+        done = sorted(x[1] for x in server.gets() if x[1] != 4096)
+        del server.requests[:]
+
+        path = cache.get(server.url)
+
+        resumed = sorted(x[1] for x in server.gets())
+    assert 4096 in resumed
+    assert not set(done) & set(resumed)
+    with open(path, 'rb') as f:
+        assert hashlib.sha256(f.read()).hexdigest() == hashlib.sha256(
+            content).hexdigest()
+
+
+def test_opened_file_is_not_evicted(tmpdir, content):
+    cache = file_cache.FileCache(str(tmpdir), threads=1)
+    with serve(content) as server:
+        with cache.open(server.url) as f:
+            cache.max_size = 1
+            cache.evict()
+            assert f.read() == content
+            assert len(cache.load_manifest()['objects']) == 1
+        cache.evict()
+    assert cache.load_manifest()['objects'] == {}
@@ -0,0 +1,163 @@
+pytest_plugins = "pytester"
+
+
+def test_undestructive_first(testdir):
+    testdir.makepyfile("""
+        import pytest
+
+        def test_a():
+            pass
+
+        @pytest.mark.undestructive
+        def test_b():
+            pass
+
+        @pytest.mark.check_env_('is_ha')
+        def test_c():
+            pass
+
+        def test_d():
+            pass
+
+        @pytest.mark.undestructive
+        def test_e():
+            pass
+    """)
+    result = testdir.runpytest("-p", "plugins.snapshot_scheduler",
+                               "--collect-only", "-q",
+                               "--schedule-snapshots")
+    result.stdout.fnmatch_lines([
+        "*::test_b",
+        "*::test_e",
+        "*::test_a",
+        "*::test_d",
+        "*::test_c",
+    ])
+
+
+def test_incremental_class_is_not_split(testdir):
+    testdir.makepyfile("""
+        import pytest
+
+        @pytest.mark.incremental
+        class TestSmth(object):
+
+            def test_a(self):
+                pass
+
+            @pytest.mark.undestructive
+            def test_b(self):
+                pass
+
+        @pytest.mark.undestructive
+        def test_c():
+            pass
+    """)
+    result = testdir.runpytest("-p", "plugins.snapshot_scheduler",
+                               "--collect-only", "-q",
+                               "--schedule-snapshots")
+    result.stdout.fnmatch_lines([
+        "*::test_c",
+        "*::TestSmth::test_a",
+        "*::TestSmth::test_b",
+    ])
+
+
+def test_no_revert_before_skipped_tests(testdir):
+    testdir.makeconftest("""
+        def pytest_collection_finish(session):
+            plan = session.snapshot_plan
+            for item in session.items:
+                print('revert after {0}: {1}'.format(
+                    item.name, plan.needs_revert_after(item)))
+    """)
+    testdir.makepyfile("""
+        import pytest
+        pytest_plugins = "plugins.snapshot_scheduler"
+
+        def test_a():
+            pass
+
+        def test_b():
+            pass
+
+        @pytest.mark.skip(reason='skipped')
+        def test_c():
+            pass
+    """)
+    result = testdir.runpytest("--collect-only", "-s")
+    result.stdout.fnmatch_lines([
+        "revert after test_a: True",
+        "revert after test_b: False",
+        "revert after test_c: False",
+    ])
+
+
+def test_no_revert_after_tests_with_failed_guards(testdir):
+    testdir.makeconftest("""
+        def pytest_configure(config):
+            config.env_guards_evaluator = lambda guards: 'is_ha' not in guards
+
+        def pytest_collection_finish(session):
+            plan = session.snapshot_plan
+            for item in session.items:
+                print('revert after {0}: {1}'.format(
+                    item.name, plan.needs_revert_after(item)))
+    """)
+    testdir.makepyfile("""
+        import pytest
+        pytest_plugins = "plugins.snapshot_scheduler"
+
+        def test_a():
+            pass
+
+        @pytest.mark.check_env_('is_ha')
+        def test_b():
+            pass
+
+        @pytest.mark.undestructive
+        def test_c():
+            pass
+
+        def test_d():
+            pass
+
+        @pytest.mark.check_env_('is_ha')
+        def test_e():
+            pass
+    """)
+    result = testdir.runpytest("--collect-only", "-s")
+    result.stdout.fnmatch_lines([
+        "revert after test_a: True",
+        "revert after test_b: False",
+        "revert after test_c: False",
+        "revert after test_d: False",
+        "revert after test_e: False",
+    ])
+
+
+def test_schedule_saving_counts_failed_guards(testdir):
+    testdir.makeconftest("""
+        def pytest_configure(config):
+            config.env_guards_evaluator = lambda guards: 'is_ha' not in guards
+    """)
+    testdir.makepyfile("""
+        import pytest
+
+        def test_a():
+            pass
+
+        @pytest.mark.check_env_('is_ha')
+        def test_b():
+            pass
+
+        @pytest.mark.undestructive
+        def test_c():
+            pass
+    """)
+    result = testdir.runpytest("-p", "plugins.snapshot_scheduler",
+                               "--collect-only", "-q",
+                               "--schedule-snapshots", "--revert-cost", "10")
+    result.stdout.fnmatch_lines([
+        "snapshot schedule: 0 reverts instead of 1, estimated saving is 10s",
+    ])
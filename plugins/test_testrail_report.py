@@ -0,0 +1,84 @@
+import io
+import time
+
+from plugins.testrail_report import FollowFile
+from plugins.testrail_report import iter_junit_cases
+from plugins.testrail_report import ResultsUploader
+
+pytest_plugins = "pytester"
+
+REPORT = b"""<?xml version="1.0" encoding="utf-8"?>
+<testsuite name="pytest" tests="4">
+  <testcase classname="mos_tests.test_a.TestA" name="test_x[1][(101)]"
+            time="1.5"/>
+  <testcase classname="mos_tests.test_a.TestA" name="test_x[2][(101)]"
+            time="2.0"><failure message="boom">trace</failure></testcase>
+  <testcase classname="mos_tests.test_a.TestA" name="test_y[(102)]"
+            time="0.1"><skipped message="not ha"/></testcase>
+  <testcase classname="mos_tests.test_a.TestA" name="test_no_id" time="1"/>
+</testsuite>
+"""
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.posts = []
+
+    def add_results_for_case_ids(self, run_id, results):
+        self.posts.append([(case_id, result.status, result.duration)
+                           for case_id, result in results])
+
+
+def test_junit_variants_merged_and_uploaded_in_batches():
+    client = FakeClient()
+    uploader = ResultsUploader(client, run_id=1, batch_size=2)
+    for case in iter_junit_cases(io.BytesIO(REPORT)):
+        uploader.add(*case)
+    uploader.flush()
+
+    assert client.posts == [[('101', 'failed', '4s'),
+                             ('102', 'skipped', '1s')]]
+    assert 'boom' in uploader.results['101'].comments
+
+
+def test_followed_report_is_parsed_until_root_end(tmpdir):
+    path = tmpdir.join('report.xml')
+    path.write_binary(REPORT)
+    source = FollowFile(str(path), poll=0.1, timeout=30)
+    start = time.time()
+    try:
+        cases = list(iter_junit_cases(source))
+    finally:
+        source.close()
+
+    assert len(cases) == 4
+    assert time.time() - start < 5
+
+
+def test_results_uploaded_during_run(testdir, monkeypatch):
+    import plugins.testrail_report as testrail_report
+    client = FakeClient()
+    monkeypatch.setattr(testrail_report, 'get_testrail_client',
+                        lambda: client)
+    testdir.makepyfile("""
+        import pytest
+
+        @pytest.mark.parametrize('x', [1, 2])
+        def test_a(x):
+            assert x == 1
+
+        def test_b():
+            pass
+    """)
+    testdir.makeconftest("""
+        def pytest_collection_modifyitems(items):
+            for item in items:
+                if item.name.startswith('test_a'):
+                    item._nodeid += '[(7)]'
+    """)
+    testdir.runpytest_inprocess("-p", "plugins.testrail_report",
+                                "--testrail-run-id", "5",
+                                "--testrail-batch", "1")
+
+    assert client.posts == [[('7', 'passed', '1s')],
+                            [('7', 'failed', '1s')]]
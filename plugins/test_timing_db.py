@@ -0,0 +1,40 @@
+from plugins.timing_db import TimingDB
+
+pytest_plugins = "pytester"
+
+
+def test_phases_are_stored(testdir, tmpdir):
+    path = str(tmpdir.join('timings.db'))
+    testdir.makepyfile("""
+        import time
+
+        def test_slow():
+            time.sleep(0.2)
+
+        def test_fast():
+            pass
+    """)
+    result = testdir.runpytest("-p", "plugins.timing_db",
+                               "--timing-db", path, "--run-label", "lbl")
+    assert result.ret == 0
+
+    db = TimingDB(path)
+    runs = db.get_runs(label='lbl')
+    assert len(runs) == 1
+    names = [x[0].split('::')[-1] for x in db.slowest()]
+    assert names == ['test_slow', 'test_fast']
+    assert dict(db.subsystems(runs[0]))['call'] >= 0.2
+
+
+def test_regressions_and_durations(tmpdir):
+    db = TimingDB(str(tmpdir.join('timings.db')))
+    history = [('run1', {'a': 10, 'b': 10}),
+               ('run2', {'a': 12, 'b': 10}),
+               ('run3', {'a': 11, 'b': 30})]
+    for started, (run, durations) in enumerate(history):
+        db.start_run(run, started=started)
+        for nodeid, duration in durations.items():
+            db.add_phase(run, nodeid, 'call', duration, 'passed')
+
+    assert db.regressions(last=2) == [('b', 10, 30)]
+    assert db.durations(last=2) == {'a': 11.5, 'b': 20}
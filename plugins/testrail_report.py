@@ -0,0 +1,283 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import OrderedDict
+import logging
+import os
+import re
+import time
+from xml.etree import ElementTree
+
+from plugins.env_pool import get_worker_input
+
+logger = logging.getLogger(__name__)
+
+__doc__ = """This module uploads tests results to TestRail during tests run.
+
+    py.test mos_tests --testrail-run-id 12345
+
+Tests are mapped to TestRail cases by `[(case_id)]` name suffix, added by
+`testrail_id` plugin. Results of parametrized variants of one case are
+merged (the worst status wins). Results are posted in batches of
+`--testrail-batch` cases (and at least every `--testrail-interval`
+seconds), so they appear in TestRail while tests are still running.
+
+Existing junit xml report can be uploaded in same way (with `--follow` it
+waits while report is being written):
+
+    python -m tools.report_results --junit-xml report.xml --run-id 12345
+"""
+
+CASE_ID_RE = re.compile(r'\[\((\d+)\)\]')
+
+# the worst status first
+STATUSES_ORDER = ('failed', 'blocked', 'passed', 'skipped')
+
+
+def pytest_addoption(parser):
+    parser.addoption("--testrail-run-id", action="store",
+                     help="Upload results of tests with testrail_id to "
+                          "TestRail run with this id")
+    parser.addoption("--testrail-batch", action="store", type=int,
+                     default=50,
+                     help="Count of cases results to upload at once")
+    parser.addoption("--testrail-interval", action="store", type=float,
+                     default=5 * 60,
+                     help="Max time (in seconds) to keep results before "
+                          "upload")
+
+
+def get_case_id(name):
+    """Return TestRail case id from test name suffix or None"""
+    ids = CASE_ID_RE.findall(name)
+    if not ids:
+        return None
+    return ids[-1]
+
+
+def format_elapsed(seconds):
+    """Return TestRail timespan (it doesn't accept 0)"""
+    return '{0}s'.format(max(int(round(seconds)), 1))
+
+
+class CaseResult(object):
+    """Merged results of all variants of one TestRail case
+
+    Has same attributes as `tools.test_result.TestResult`.
+    """
+
+    group = None
+    url = None
+    version = None
+    launchpad_bug = None
+    steps = None
+
+    def __init__(self, name):
+        self.name = name
+        self.status = None
+        self.seconds = 0
+        self.variants = OrderedDict()
+
+    def add(self, name, status, duration, message=None):
+        self.variants[name] = (status, message)
+        self.seconds += duration
+        statuses = [x[0] for x in self.variants.values()]
+        self.status = min(statuses, key=STATUSES_ORDER.index)
+
+    @property
+    def duration(self):
+        return format_elapsed(self.seconds)
+
+    @property
+    def description(self):
+        if len(self.variants) < 2:
+            return None
+        return '\n'.join('{0}: {1}'.format(name, status)
+                         for name, (status, _) in self.variants.items())
+
+    @property
+    def comments(self):
+        messages = ['{0}:\n{1}'.format(name, message)
+                    for name, (_, message) in self.variants.items()
+                    if message]
+        return '\n\n'.join(messages) or None
+
+
+class ResultsUploader(object):
+    """Collects cases results and uploads changed ones in batches
+
+    :param client: TestRailProject instance
+    :param run_id: TestRail run id
+    :param batch_size: count of changed cases to trigger upload
+    :param interval: max time (in seconds) between uploads
+    """
+
+    def __init__(self, client, run_id, batch_size=50, interval=5 * 60):
+        self.client = client
+        self.run_id = run_id
+        self.batch_size = batch_size
+        self.interval = interval
+        self.results = {}
+        self.changed = OrderedDict()
+        self.uploaded = 0
+        self._last_upload = time.time()
+
+    def add(self, name, status, duration, message=None):
+        """Add test result, test without case id in name is ignored"""
+        case_id = get_case_id(name)
+        if case_id is None:
+            return
+        if case_id not in self.results:
+            self.results[case_id] = CaseResult(CASE_ID_RE.sub('', name))
+        self.results[case_id].add(name, status, duration, message)
+        self.changed[case_id] = self.results[case_id]
+        if (len(self.changed) >= self.batch_size or
+                time.time() - self._last_upload >= self.interval):
+            self.flush()
+
+    def flush(self):
+        """Upload changed results (they are kept for retry on failure)"""
+        self._last_upload = time.time()
+        if not self.changed:
+            return
+        batch = list(self.changed.items())
+        try:
+            self.client.add_results_for_case_ids(self.run_id, batch)
+        except Exception as e:
+            logger.error('Results upload to TestRail failed: {0}'.format(e))
+            return
+        for case_id, _ in batch:
+            self.changed.pop(case_id, None)
+        self.uploaded += len(batch)
+        logger.info('{0} results uploaded to TestRail run {1}'.format(
+            len(batch), self.run_id))
+
+
+class FollowFile(object):
+    """Read-only file, which waits for data appended by other process
+
+    :param timeout: max time (in seconds) to wait for new data
+    """
+
+    def __init__(self, path, poll=5, timeout=60 * 60):
+        self.path = path
+        self.poll = poll
+        self.timeout = timeout
+        self._file = None
+
+    def read(self, size=-1):
+        start = time.time()
+        while True:
+            if self._file is None and os.path.exists(self.path):
+                self._file = open(self.path, 'rb')
+            if self._file is not None:
+                data = self._file.read(size)
+                if data:
+                    return data
+            if time.time() - start > self.timeout:
+                return b''
+            time.sleep(self.poll)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def iter_junit_cases(source):
+    """Yield (name, status, duration, message) from junit xml
+
+    Xml is parsed incrementally, so huge reports don't consume memory.
+    Parsing stops on root element end, so followed file (see `FollowFile`)
+    isn't waited for more data after report completion.
+
+    :param source: path or file-like object
+    """
+    root = None
+    for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+        if root is None:
+            root = elem
+        if event != 'end':
+            continue
+        if elem is root:
+            return
+        if elem.tag != 'testcase':
+            continue
+        status, message = 'passed', None
+        for child in elem:
+            if child.tag in ('failure', 'error'):
+                status = 'failed'
+            elif child.tag == 'skipped':
+                status = 'skipped'
+            else:
+                continue
+            message = child.get('message') or child.text
+        name = elem.get('name', '')
+        classname = elem.get('classname')
+        if classname:
+            name = '{0}.{1}'.format(classname, name)
+        yield name, status, float(elem.get('time') or 0), message
+        elem.clear()
+
+
+class TestRailReporter(object):
+    """Passes finished tests results to ResultsUploader"""
+
+    def __init__(self, uploader):
+        self.uploader = uploader
+        self._reports = {}
+
+    def pytest_runtest_logreport(self, report):
+        self._reports.setdefault(report.nodeid, []).append(report)
+        if report.when != 'teardown':
+            return
+        reports = self._reports.pop(report.nodeid)
+        status, message = 'passed', None
+        for rep in reports:
+            if rep.failed:
+                status = 'failed'
+                message = str(rep.longrepr)
+                break
+            if rep.skipped and status == 'passed':
+                status = 'skipped'
+                message = str(rep.longrepr)
+        duration = sum(x.duration for x in reports)
+        self.uploader.add(report.nodeid, status, duration, message)
+
+    def pytest_sessionfinish(self, session):
+        self.uploader.flush()
+        if self.uploader.changed:
+            logger.error('{0} results were not uploaded to TestRail'.format(
+                len(self.uploader.changed)))
+
+
+def get_testrail_client():
+    from tools.settings import TestRailSettings
+    from tools.testrail_client import TestRailProject
+    return TestRailProject(url=TestRailSettings.url,
+                           user=TestRailSettings.user,
+                           password=TestRailSettings.password,
+                           project=TestRailSettings.project)
+
+
+def pytest_configure(config):
+    run_id = config.getoption('--testrail-run-id')
+    # xdist workers reports are handled by master
+    if not run_id or get_worker_input(config) is not None:
+        return
+    uploader = ResultsUploader(get_testrail_client(), run_id,
+                               batch_size=config.getoption('--testrail-batch'),
+                               interval=config.getoption(
+                                   '--testrail-interval'))
+    config.pluginmanager.register(TestRailReporter(uploader),
+                                  'testrail_reporter')
@@ -0,0 +1,253 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import defaultdict
+import logging
+import sqlite3
+import time
+import uuid
+
+from plugins.env_pool import get_worker_input
+
+logger = logging.getLogger(__name__)
+
+__doc__ = """This module stores tests timings to SQLite database.
+
+    py.test mos_tests --timing-db ~/timings.db --run-label 9.0-vlan
+
+For each run it records setup/call/teardown durations, waits (from
+`mos_tests.functions.waiter`) and counters (ssh commands, API calls, time
+of snapshot revert, env readiness check and OSTF) of each test. Waits and
+counters are passed by conftest with `config.timing_recorder.record_test`.
+
+Reports (slowest tests, regressions, time by subsystems) and durations
+export for `--durations-file` option of env_pool plugin are available with
+`tools/timing_report.py` script.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id TEXT PRIMARY KEY, label TEXT, started REAL, duration REAL);
+CREATE TABLE IF NOT EXISTS phases (
+    run TEXT, nodeid TEXT, phase TEXT, duration REAL, outcome TEXT);
+CREATE TABLE IF NOT EXISTS waits (
+    run TEXT, nodeid TEXT, waiting_for TEXT, called_from TEXT,
+    elapsed REAL, status TEXT);
+CREATE TABLE IF NOT EXISTS counters (
+    run TEXT, nodeid TEXT, name TEXT, value REAL);
+CREATE INDEX IF NOT EXISTS phases_run ON phases (run);
+CREATE INDEX IF NOT EXISTS waits_run ON waits (run);
+CREATE INDEX IF NOT EXISTS counters_run ON counters (run);
+"""
+
+
+def pytest_addoption(parser):
+    parser.addoption("--timing-db", action="store",
+                     help="Path to SQLite database to store tests timings")
+    parser.addoption("--run-label", action="store",
+                     help="Label of run in timings database (env "
+                          "configuration, for example)")
+
+
+class TimingDB(object):
+    """Tests timings storage
+
+    :param path: path to SQLite database file (created if absent)
+    """
+
+    def __init__(self, path):
+        # xdist workers write to the same database
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def start_run(self, run, label=None, started=None):
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO runs VALUES (?, ?, ?, NULL)',
+                (run, label, time.time() if started is None else started))
+
+    def finish_run(self, run, duration):
+        with self.conn:
+            self.conn.execute('UPDATE runs SET duration = ? WHERE id = ?',
+                              (duration, run))
+
+    def add_phase(self, run, nodeid, phase, duration, outcome):
+        with self.conn:
+            self.conn.execute('INSERT INTO phases VALUES (?, ?, ?, ?, ?)',
+                              (run, nodeid, phase, duration, outcome))
+
+    def add_test_stats(self, run, nodeid, waits=(), counters=None):
+        """Store test waits (`WaitRecord` list) and counters dict"""
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO waits VALUES (?, ?, ?, ?, ?, ?)',
+                [(run, nodeid, x.waiting_for, x.called_from, x.elapsed,
+                  x.status) for x in waits])
+            self.conn.executemany(
+                'INSERT INTO counters VALUES (?, ?, ?, ?)',
+                [(run, nodeid, name, value)
+                 for name, value in sorted((counters or {}).items())])
+
+    def get_runs(self, limit=None, label=None):
+        """Return runs ids, latest first"""
+        query = 'SELECT id FROM runs'
+        args = []
+        if label is not None:
+            query += ' WHERE label = ?'
+            args.append(label)
+        query += ' ORDER BY started DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            args.append(limit)
+        return [x[0] for x in self.conn.execute(query, args)]
+
+    def get_tests_durations(self, run):
+        """Return dict {nodeid: total duration of all phases} for run"""
+        return dict(self.conn.execute(
+            'SELECT nodeid, SUM(duration) FROM phases WHERE run = ? '
+            'GROUP BY nodeid', (run,)))
+
+    def durations(self, last=5, label=None):
+        """Return dict {nodeid: average duration} over last runs"""
+        totals = defaultdict(list)
+        for run in self.get_runs(limit=last, label=label):
+            for nodeid, duration in self.get_tests_durations(run).items():
+                totals[nodeid].append(duration)
+        return {nodeid: sum(x) / len(x) for nodeid, x in totals.items()}
+
+    def slowest(self, limit=20, last=1, label=None):
+        """Return list of (nodeid, average duration), slowest first"""
+        durations = self.durations(last=last, label=label)
+        return sorted(durations.items(), key=lambda x: x[1],
+                      reverse=True)[:limit]
+
+    def regressions(self, last=5, threshold=1.5, min_delta=1.0,
+                    label=None):
+        """Compare latest run with average of `last` previous runs
+
+        :returns: list of (nodeid, baseline, latest) for tests, which are
+            `threshold` times and at least `min_delta` seconds slower, the
+            most slowed down first
+        """
+        runs = self.get_runs(limit=last + 1, label=label)
+        if len(runs) < 2:
+            return []
+        latest = self.get_tests_durations(runs[0])
+        baseline = defaultdict(list)
+        for run in runs[1:]:
+            for nodeid, duration in self.get_tests_durations(run).items():
+                baseline[nodeid].append(duration)
+        result = []
+        for nodeid, duration in latest.items():
+            if nodeid not in baseline:
+                continue
+            avg = sum(baseline[nodeid]) / len(baseline[nodeid])
+            if duration > avg * threshold and duration - avg >= min_delta:
+                result.append((nodeid, avg, duration))
+        return sorted(result, key=lambda x: x[2] - x[1], reverse=True)
+
+    def subsystems(self, run):
+        """Return list of (subsystem, seconds) for run, sorted by time
+
+        Subsystems are tests phases, waits, spans recorded with
+        `counters.span` (revert, env_ready, ostf) and API services.
+        """
+        totals = defaultdict(float)
+        for phase, duration in self.conn.execute(
+                'SELECT phase, SUM(duration) FROM phases WHERE run = ? '
+                'GROUP BY phase', (run,)):
+            totals[phase] = duration
+        waits = self.conn.execute(
+            'SELECT SUM(elapsed) FROM waits WHERE run = ?', (run,)).fetchone()
+        totals['waits'] = waits[0] or 0
+        for name, value in self.get_counters(run):
+            if name.startswith('time.'):
+                totals[name[len('time.'):]] += value
+            elif name.startswith('api_time.'):
+                totals['api.' + name[len('api_time.'):]] += value
+        return sorted(totals.items(), key=lambda x: x[1], reverse=True)
+
+    def get_counters(self, run):
+        """Return list of (counter name, total value) for run"""
+        return list(self.conn.execute(
+            'SELECT name, SUM(value) FROM counters WHERE run = ? '
+            'GROUP BY name ORDER BY name', (run,)))
+
+
+class TimingRecorder(object):
+    """Writes tests phases durations and stats to TimingDB
+
+    Phases are recorded by master process (xdist workers reports are
+    passed to it), waits and counters - by process, which runs test.
+    """
+
+    def __init__(self, db, run, label=None, is_worker=False):
+        self.db = db
+        self.run = run
+        self.label = label
+        self.is_worker = is_worker
+        self.started = time.time()
+
+    def pytest_sessionstart(self, session):
+        if not self.is_worker:
+            self.db.start_run(self.run, label=self.label,
+                              started=self.started)
+
+    def pytest_runtest_logreport(self, report):
+        if not self.is_worker:
+            self.db.add_phase(self.run, report.nodeid, report.when,
+                              report.duration, report.outcome)
+
+    def record_test(self, nodeid, waits=(), counters=None):
+        self.db.add_test_stats(self.run, nodeid, waits=waits,
+                               counters=counters)
+
+    def pytest_sessionfinish(self, session):
+        if not self.is_worker:
+            self.db.finish_run(self.run, time.time() - self.started)
+        self.db.close()
+
+
+class XdistTimingRun(object):
+    """Passes run id to xdist workers"""
+
+    def __init__(self, run):
+        self.run = run
+
+    def pytest_configure_node(self, node):
+        worker_input = getattr(node, 'workerinput',
+                               getattr(node, 'slaveinput', None))
+        worker_input['timing_db_run'] = self.run
+
+
+def pytest_configure(config):
+    path = config.getoption('--timing-db')
+    if not path:
+        return
+    worker_input = get_worker_input(config)
+    if worker_input is None:
+        run = str(uuid.uuid4())
+    else:
+        run = worker_input.get('timing_db_run', str(uuid.uuid4()))
+    recorder = TimingRecorder(TimingDB(path), run,
+                              label=config.getoption('--run-label'),
+                              is_worker=worker_input is not None)
+    config.timing_recorder = recorder
+    config.pluginmanager.register(recorder, 'timing_db_recorder')
+    if worker_input is None and config.pluginmanager.hasplugin('xdist'):
+        config.pluginmanager.register(XdistTimingRun(run), 'timing_db_xdist')
+    logger.info('Timings of run {0} are stored to {1}'.format(run, path))
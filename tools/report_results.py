@@ -40,6 +40,29 @@ def report_test_results_for_run(client, run_name, suite_id, case_name, case_stat
     client.add_results_for_cases(the_run['id'], suite_id, [TestResult(case_name, None, case_status, 0)])
 
 
+def report_junit_results(client, run_id, path, follow=False, batch_size=50):
+    """Upload results from junit xml to run incrementally
+
+    Tests are mapped to cases by `[(case_id)]` name suffix. Run as
+    `python -m tools.report_results` from repository root.
+    """
+    from plugins.testrail_report import FollowFile
+    from plugins.testrail_report import iter_junit_cases
+    from plugins.testrail_report import ResultsUploader
+
+    uploader = ResultsUploader(client, run_id, batch_size=batch_size)
+    source = FollowFile(path) if follow else path
+    try:
+        for name, status, duration, message in iter_junit_cases(source):
+            uploader.add(name, status, duration, message)
+    finally:
+        if follow:
+            source.close()
+        uploader.flush()
+    LOG.info('{0} results were uploaded, {1} failed to upload'.format(
+        uploader.uploaded, len(uploader.changed)))
+
+
 def main():
     parser = optparse.OptionParser(
         description='Publish the results of Automated Cloud Tests in TestRail')
@@ -52,9 +75,30 @@ def main():
                            'the test run')
     parser.add_option('-n', '--case_name', dest='test_case_name', default="SimpleTestCase",
                       help='Name of the test case')
+    parser.add_option('-j', '--junit-xml', dest='junit_xml',
+                      help='Upload results from junit xml report to run '
+                           'with --run-id (tests are matched to cases by '
+                           '[(case_id)] suffix)')
+    parser.add_option('--run-id', dest='run_id',
+                      help='Id of TestRail run to upload junit results to')
+    parser.add_option('-f', '--follow', dest='follow', action='store_true',
+                      help='Wait for junit xml report to be written')
+    parser.add_option('-b', '--batch', dest='batch', type='int', default=50,
+                      help='Count of results to upload at once')
 
     (options, args) = parser.parse_args()
 
+    if options.junit_xml is not None:
+        if options.run_id is None:
+            raise optparse.OptionValueError('No run id was specified!')
+        client = TestRailProject(url=TestRailSettings.url,
+                                 user=TestRailSettings.user,
+                                 password=TestRailSettings.password,
+                                 project=TestRailSettings.project)
+        report_junit_results(client, options.run_id, options.junit_xml,
+                             follow=options.follow, batch_size=options.batch)
+        return
+
     if options.run_name is None:
         raise optparse.OptionValueError('No run name was specified!')
 
@@ -10,15 +10,43 @@
 # Copyright Gurock Software GmbH. See license.md for details.
 #
 
-import urllib2, json, base64
+import base64, httplib, json, socket, time, urlparse
 
 class APIClient:
-    def __init__(self, base_url):
+    def __init__(self, base_url, retries=5, timeout=60):
         self.user = ''
         self.password = ''
         if not base_url.endswith('/'):
             base_url += '/'
         self.__url = base_url + 'index.php?/api/v2/'
+        url = urlparse.urlparse(self.__url)
+        self.__scheme = url.scheme
+        self.__netloc = url.netloc
+        self.__path = url.path + '?' + url.query
+        self.__connection = None
+        self.retries = retries
+        self.timeout = timeout
+
+    #
+    # Close
+    #
+    # Closes keep-alive connection to TestRail (it is reopened on next
+    # request).
+    #
+    def close(self):
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+
+    def __connect(self):
+        if self.__connection is None:
+            if self.__scheme == 'https':
+                connection_class = httplib.HTTPSConnection
+            else:
+                connection_class = httplib.HTTPConnection
+            self.__connection = connection_class(self.__netloc,
+                                                 timeout=self.timeout)
+        return self.__connection
 
     #
     # Send Get
@@ -50,33 +78,52 @@ class APIClient:
     def send_post(self, uri, data):
         return self.__send_request('POST', uri, data)
 
+    #
+    # All requests use one keep-alive connection. Rate limited (HTTP 429)
+    # and unavailable (HTTP 503) responses are retried after `Retry-After`
+    # seconds, broken connections are reopened.
+    #
     def __send_request(self, method, uri, data):
-        url = self.__url + uri
-        request = urllib2.Request(url)
+        body = None
         if (method == 'POST'):
-            request.add_data(json.dumps(data))
+            body = json.dumps(data)
         auth = base64.b64encode('%s:%s' % (self.user, self.password))
-        request.add_header('Authorization', 'Basic %s' % auth)
-        request.add_header('Content-Type', 'application/json')
+        headers = {'Authorization': 'Basic %s' % auth,
+                   'Content-Type': 'application/json',
+                   'Connection': 'keep-alive'}
 
-        e = None
-        try:
-            response = urllib2.urlopen(request).read()
-        except urllib2.HTTPError as e:
-            response = e.read()
+        for attempt in range(self.retries):
+            last = attempt == self.retries - 1
+            try:
+                connection = self.__connect()
+                connection.request(method, self.__path + uri, body, headers)
+                response = connection.getresponse()
+                content = response.read()
+            except (httplib.HTTPException, socket.error):
+                self.close()
+                if last:
+                    raise
+                time.sleep(2 ** attempt)
+                continue
+            if response.status in (429, 503) and not last:
+                delay = response.getheader('Retry-After')
+                time.sleep(int(delay) if delay and delay.isdigit()
+                           else 2 ** attempt)
+                continue
+            break
 
-        if response:
-            result = json.loads(response)
+        if content:
+            result = json.loads(content)
         else:
             result = {}
 
-        if e != None:
+        if response.status >= 300:
             if result and 'error' in result:
                 error = '"' + result['error'] + '"'
             else:
                 error = 'No additional error message received'
-            raise APIError('TestRail API returned HTTP %s (%s)' % 
-                (e.code, error))
+            raise APIError('TestRail API returned HTTP %s (%s)' %
+                (response.status, error))
 
         return result
 
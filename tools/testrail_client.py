@@ -18,14 +18,52 @@ from testrail import APIError
 
 
 class TestRailProject(object):
-    """TestRailProject."""  # TODO documentation
+    """TestRail project API
 
-    def __init__(self, url, user, password, project):
+    Statuses, milestones, configs and cases lists are fetched once and
+    cached (use `prefetch` to fill cache and `invalidate_cache` to reset it).
+    Cases and statuses are indexed for lookups by name.
+
+    :param results_chunk_size: max count of results in one
+        `add_results_for_cases` request
+    """
+
+    def __init__(self, url, user, password, project, results_chunk_size=250):
         self.client = APIClient(base_url=url)
         self.client.user = user
         self.client.password = password
+        self.results_chunk_size = results_chunk_size
+        self._cache = {}
         self.project = self._get_project(project)
 
+    def _cached(self, key, getter):
+        if key not in self._cache:
+            self._cache[key] = getter()
+        return self._cache[key]
+
+    def _index(self, key, items, field):
+        """Return dict {item[field]: item} (first item wins), cached"""
+        def build():
+            index = {}
+            for item in items():
+                index.setdefault(item.get(field), item)
+            return index
+        return self._cached(('index', field) + key, build)
+
+    def invalidate_cache(self, kind=None):
+        """Forget cached lists (all or only given kind, like 'cases')"""
+        for key in list(self._cache):
+            if kind is None or kind in key:
+                del self._cache[key]
+
+    def prefetch(self, suite_id=None):
+        """Fetch statuses, milestones, configs and suite cases to cache"""
+        self.get_statuses()
+        self.get_milestones()
+        self.get_configs()
+        if suite_id is not None:
+            self.get_cases(suite_id)
+
     def _get_project(self, project_name):
         projects_uri = 'get_projects'
         projects = self.client.send_get(uri=projects_uri)
@@ -68,7 +106,8 @@ class TestRailProject(object):
     def get_configs(self):
         configs_uri = 'get_configs/{project_id}'.format(
             project_id=self.project['id'])
-        return self.client.send_get(configs_uri)
+        return self._cached(('configs',),
+                            lambda: self.client.send_get(configs_uri))
 
     def get_config(self, config_id):
         for configs in self.get_configs():
@@ -88,7 +127,8 @@ class TestRailProject(object):
     def get_milestones(self):
         milestones_uri = 'get_milestones/{project_id}'.format(
             project_id=self.project['id'])
-        return self.client.send_get(uri=milestones_uri)
+        return self._cached(('milestones',),
+                            lambda: self.client.send_get(uri=milestones_uri))
 
     def get_milestone(self, milestone_id):
         milestone_uri = 'get_milestone/{milestone_id}'.format(
@@ -96,9 +136,8 @@ class TestRailProject(object):
         return self.client.send_get(uri=milestone_uri)
 
     def get_milestone_by_name(self, name):
-        for milestone in self.get_milestones():
-            if milestone['name'] == name:
-                return self.get_milestone(milestone_id=milestone['id'])
+        return self._index(('milestones',), self.get_milestones,
+                           'name').get(name)
 
     def get_suites(self):
         suites_uri = 'get_suites/{project_id}'.format(
@@ -151,27 +190,37 @@ class TestRailProject(object):
             cases_uri = '{0}&section_id={section_id}'.format(
                 cases_uri, section_id=section_id
             )
-        return self.client.send_get(cases_uri)
+        return self._cached(('cases', int(suite_id), section_id),
+                            lambda: self.client.send_get(cases_uri))
 
     def get_case(self, case_id):
         case_uri = 'get_case/{case_id}'.format(case_id=case_id)
         return self.client.send_get(case_uri)
 
+    def _find_case(self, suite_id, field, value, cases=None):
+        if cases:
+            for case in cases:
+                if case.get(field) == value:
+                    return case
+            return None
+        return self._index(('cases', int(suite_id)),
+                           lambda: self.get_cases(suite_id),
+                           field).get(value)
+
     def get_case_by_name(self, suite_id, name, cases=None):
-        for case in cases or self.get_cases(suite_id):
-            if case['title'] == name:
-                return self.get_case(case_id=case['id'])
+        return self._find_case(suite_id, 'title', name, cases=cases)
 
     def get_case_by_group(self, suite_id, group, cases=None):
-        for case in cases or self.get_cases(suite_id):
-            if case['custom_test_group'] == group:
-                return self.get_case(case_id=case['id'])
+        return self._find_case(suite_id, 'custom_test_group', group,
+                               cases=cases)
 
     def add_case(self, section_id, case):
         add_case_uri = 'add_case/{section_id}'.format(section_id=section_id)
+        self.invalidate_cache('cases')
         return self.client.send_post(add_case_uri, case)
 
     def delete_case(self, case_id):
+        self.invalidate_cache('cases')
         return self.client.send_post('delete_case/' + str(case_id), None)
 
     def get_plans(self):
@@ -301,12 +350,12 @@ class TestRailProject(object):
 
     def get_statuses(self):
         statuses_uri = 'get_statuses'
-        return self.client.send_get(statuses_uri)
+        return self._cached(('statuses',),
+                            lambda: self.client.send_get(statuses_uri))
 
     def get_status(self, name):
-        for status in self.get_statuses():
-            if status['name'] == name:
-                return status
+        return self._index(('statuses',), self.get_statuses,
+                           'name').get(name)
 
     def get_tests(self, run_id, status_id=None):
         tests_uri = 'get_tests/{run_id}'.format(run_id=run_id)
@@ -386,54 +435,79 @@ class TestRailProject(object):
             new_results['custom_step_results'] = test_results.steps
         return self.client.send_post(add_results_test_uri, new_results)
 
+    def _case_result(self, case, results):
+        result = {
+            'case_id': case['id'],
+            'status_id': self.get_status(results.status)['id'],
+            'comment': '\n'.join(filter(lambda x: x is not None,
+                                        [results.description,
+                                         results.url,
+                                         results.comments])),
+            'elapsed': results.duration,
+            'version': results.version,
+            'custom_launchpad_bug': results.launchpad_bug
+        }
+        if results.steps:
+            custom_step_results = []
+            steps = case.get('custom_test_case_steps', None)
+            if steps and len(steps) == len(results.steps):
+                steps = zip(steps, results.steps)
+                for s in steps:
+                    custom_step_results.append({
+                        "content": s[0]["content"],
+                        "expected": s[0]["expected"],
+                        "actual": s[1]['actual'],
+                        "status_id": self.get_status(s[1]['status'])['id']
+                    })
+            else:
+                for s in results.steps:
+                    custom_step_results.append({
+                        "content": s['name'],
+                        "expected": 'pass',
+                        "actual": s['actual'],
+                        "status_id": self.get_status(s['status'])['id']
+                    })
+            result['custom_test_case_steps_results'] = custom_step_results
+        return result
+
     def add_results_for_cases(self, run_id, suite_id, tests_results):
+        """Add results to run with requests of `results_chunk_size` results
+
+        Results for cases, which are absent in suite, are skipped.
+        """
         add_results_test_uri = 'add_results_for_cases/{run_id}'.format(
             run_id=run_id)
-        new_results = {'results': []}
-        tests_cases = self.get_cases(suite_id)
+        new_results = []
         for results in tests_results:
             if results.group is None:
                 case = self.get_case_by_name(suite_id, results.name)
             else:
                 case = self.get_case_by_group(suite_id=suite_id,
-                                              group=results.group,
-                                              cases=tests_cases)
-            case_id = case['id']
-            new_result = {
-                'case_id': case_id,
-                'status_id': self.get_status(results.status)['id'],
-                'comment': '\n'.join(filter(lambda x: x is not None,
-                                            [results.description,
-                                             results.url,
-                                             results.comments])),
-                'elapsed': results.duration,
-                'version': results.version,
-                'custom_launchpad_bug': results.launchpad_bug
-            }
-            if results.steps:
-                custom_step_results = []
-                steps = case.get('custom_test_case_steps', None)
-                if steps and len(steps) == len(results.steps):
-                    steps = zip(steps, results.steps)
-                    for s in steps:
-                        custom_step_results.append({
-                            "content": s[0]["content"],
-                            "expected": s[0]["expected"],
-                            "actual": s[1]['actual'],
-                            "status_id": self.get_status(s[1]['status'])['id']
-                        })
-                else:
-                    for s in results.steps:
-                        custom_step_results.append({
-                            "content": s['name'],
-                            "expected": 'pass',
-                            "actual": s['actual'],
-                            "status_id": self.get_status(s['status'])['id']
-                        })
-                new_result['custom_test_case_steps_results'] = \
-                    custom_step_results
-            new_results['results'].append(new_result)
-        return self.client.send_post(add_results_test_uri, new_results)
+                                              group=results.group)
+            if case is None:
+                logger.error('Case for result {0} is not found in suite '
+                             '{1}'.format(results, suite_id))
+                continue
+            new_results.append(self._case_result(case, results))
+        return self._post_results(add_results_test_uri, new_results)
+
+    def add_results_for_case_ids(self, run_id, tests_results):
+        """Add results to run by cases ids
+
+        :param tests_results: list of (case_id, TestResult) tuples
+        """
+        add_results_test_uri = 'add_results_for_cases/{run_id}'.format(
+            run_id=run_id)
+        new_results = [self._case_result({'id': int(case_id)}, results)
+                       for case_id, results in tests_results]
+        return self._post_results(add_results_test_uri, new_results)
+
+    def _post_results(self, uri, new_results):
+        added = []
+        for i in range(0, len(new_results), self.results_chunk_size):
+            chunk = new_results[i:i + self.results_chunk_size]
+            added.extend(self.client.send_post(uri, {'results': chunk}))
+        return added
 
     def add_results_for_tempest_cases(self, run_id, tests_results):
         add_results_test_uri = 'add_results_for_cases/{run_id}'.format(
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Reports on tests timings, stored by `--timing-db` pytest option
+
+Usage (from repository root):
+
+    python -m tools.timing_report -d timings.db slowest
+    python -m tools.timing_report -d timings.db regressions -l 5
+    python -m tools.timing_report -d timings.db subsystems
+    python -m tools.timing_report -d timings.db export -o durations.json
+"""
+
+import json
+import optparse
+import sys
+
+from plugins.timing_db import TimingDB
+
+COMMANDS = ('slowest', 'regressions', 'subsystems', 'export')
+
+
+def report_slowest(db, options):
+    for nodeid, duration in db.slowest(limit=options.limit,
+                                       last=options.last,
+                                       label=options.label):
+        print('{0:8.1f}s {1}'.format(duration, nodeid))
+
+
+def report_regressions(db, options):
+    regressions = db.regressions(last=options.last,
+                                 threshold=options.threshold,
+                                 label=options.label)
+    if not regressions:
+        print('No regressions found')
+    for nodeid, baseline, latest in regressions[:options.limit]:
+        print('{0:8.1f}s -> {1:8.1f}s (x{2:.1f}) {3}'.format(
+            baseline, latest, latest / baseline if baseline else 0, nodeid))
+
+
+def report_subsystems(db, options):
+    runs = db.get_runs(limit=1, label=options.label)
+    if not runs:
+        print('No runs found')
+        return
+    print('Run {0}'.format(runs[0]))
+    for name, seconds in db.subsystems(runs[0]):
+        print('{0:8.1f}s {1}'.format(seconds, name))
+    for name, value in db.get_counters(runs[0]):
+        if not (name.startswith('time.') or name.startswith('api_time.')):
+            print('{0:9.0f} {1}'.format(value, name))
+
+
+def export_durations(db, options):
+    durations = db.durations(last=options.last, label=options.label)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(durations, f, indent=2, sort_keys=True)
+    else:
+        json.dump(durations, sys.stdout, indent=2, sort_keys=True)
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage='%prog -d DB {0}'.format('|'.join(COMMANDS)),
+        description='Report tests timings history')
+    parser.add_option('-d', '--db', dest='db',
+                      help='Path to timings database')
+    parser.add_option('-l', '--last', dest='last', type='int', default=5,
+                      help='Count of runs to analyze (for `slowest` - '
+                           'count of latest runs to average)')
+    parser.add_option('-n', '--limit', dest='limit', type='int', default=20,
+                      help='Count of tests to show')
+    parser.add_option('-t', '--threshold', dest='threshold', type='float',
+                      default=1.5,
+                      help='Slowdown ratio to treat test as regressed')
+    parser.add_option('--label', dest='label',
+                      help='Analyze only runs with this label')
+    parser.add_option('-o', '--output', dest='output',
+                      help='Output file for `export` command')
+
+    (options, args) = parser.parse_args()
+
+    if options.db is None:
+        raise optparse.OptionValueError('No database was specified!')
+    if len(args) != 1 or args[0] not in COMMANDS:
+        parser.error('Command should be one of {0}'.format(COMMANDS))
+
+    db = TimingDB(options.db)
+    try:
+        {'slowest': report_slowest,
+         'regressions': report_regressions,
+         'subsystems': report_subsystems,
+         'export': export_durations}[args[0]](db, options)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()